@@ -2,14 +2,2460 @@
 """
 Flask - USB ISO Flashing Utility
 A simple utility to flash ISO images to USB drives
+
+Programs can import it and use FlashJob, or talk to "flask serve".
 """
 
 import os
 import sys
+import stat
+import errno
+import math
+import random
+import bisect
+import ctypes
+import struct
+import itertools
+import shutil
+import json
+import sqlite3
+import select
+import re
+import socket
+import mmap
+import queue
+import threading
 import subprocess
+import tempfile
 import argparse
+import asyncio
 import time
-from typing import List, Dict, Optional, Tuple
+import hashlib
+import http.client
+import urllib.error
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext, redirect_stdout
+from xml.etree import ElementTree
+from typing import List, Dict, Optional, Tuple, TextIO
+
+if sys.platform != "win32":
+    import fcntl
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_QUEUE_DEPTH = 4
+# direct: O_DIRECT, bypassing the page cache; dsync: every write waits for
+# the device; buffered: through the page cache, synced at the end.
+IO_MODES = ["direct", "dsync", "buffered"]
+# Buffered writes are pushed to the device in windows of this size, so at
+# most about two windows are ever waiting in the page cache.
+DEFAULT_SYNC_WINDOW = 32 * 1024 * 1024
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+# O_DIRECT needs buffers, offsets and lengths aligned to the logical block
+# size; 4 KiB covers both 512e and 4Kn drives.
+DIRECT_IO_ALIGNMENT = 4096
+O_DIRECT = getattr(os, "O_DIRECT", 0)
+F_NOCACHE = 48  # macOS fcntl to bypass the unified buffer cache
+# Granularity of zero detection and of generated block maps.
+BMAP_BLOCK_SIZE = 4096
+
+COMPRESSION_MAGIC = [
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bzip2"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+]
+# Decompressors in order of preference; parallel ones first.
+DECOMPRESSORS = {
+    "xz": [["xz", "-dc", "-T0"]],
+    "gzip": [["pigz", "-dc"], ["gzip", "-dc"]],
+    "bzip2": [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]],
+    "zstd": [["zstd", "-dcq"]],
+}
+PYTHON_DECOMPRESSORS = {"xz": "lzma", "gzip": "gzip", "bzip2": "bz2"}
+
+# Downloads are passed to the writers through a pipe of this size, which
+# bounds how far the network may run ahead of the devices.
+DOWNLOAD_READ_AHEAD = 8 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 30
+
+SIDECAR_SUFFIX = ".flaskhash"
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+DEFAULT_HASH = "blake2b"
+HASH_ALGORITHMS = ["blake2b", "sha256", "crc32"] + (["xxh64"] if xxhash else [])
+
+
+class FlashError(Exception):
+    """Raised when an image cannot be written to a device."""
+
+
+def parse_size(text: str) -> int:
+    """Parse a size such as '4M', '512K' or '1048576' into bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = text.strip().upper().rstrip("B").rstrip("I")
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+
+def format_size(num_bytes: float) -> str:
+    """Format a byte count the way dd does (binary units)."""
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TiB"
+
+
+class Crc32Hash:
+    """hashlib-style wrapper around zlib.crc32 for the non-crypto option."""
+
+    name = "crc32"
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self) -> str:
+        return f"{self.value:08x}"
+
+
+def new_hasher(algorithm: str = DEFAULT_HASH):
+    """Return a fresh hash object for one of HASH_ALGORITHMS."""
+    if algorithm == "crc32":
+        return Crc32Hash()
+    if algorithm == "xxh64" and xxhash:
+        return xxhash.xxh64()
+    if algorithm in ("blake2b", "sha256"):
+        return hashlib.new(algorithm)
+    raise ValueError(f"unsupported hash algorithm: {algorithm}")
+
+
+def open_uncached(path: str) -> Tuple[int, bool]:
+    """Open path for reading so that reads bypass the page cache.
+
+    Returns the descriptor and whether O_DIRECT is in effect. When it is
+    not, cached pages are dropped up front so stale data cannot satisfy
+    the reads.
+    """
+    if O_DIRECT:
+        try:
+            return os.open(path, os.O_RDONLY | O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    fd = os.open(path, os.O_RDONLY)
+    if sys.platform == "darwin":
+        fcntl.fcntl(fd, F_NOCACHE, 1)
+    elif hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    return fd, False
+
+
+class ProgressMeter:
+    """Print bytes written and throughput at a fixed interval.
+
+    A meter with a label prints whole prefixed lines, so that several
+    devices can report at once without overwriting each other. A JSON
+    meter prints one object per line, to file if one is given, and
+    leaves the timing to a ProgressTicker.
+    """
+
+    def __init__(self, total: Optional[int] = None, interval: float = 1.0, label: str = "",
+                 json_lines: bool = False, file: Optional[TextIO] = None):
+        self.total = total
+        self.interval = interval
+        self.label = label
+        self.json_lines = json_lines
+        self.file = file
+        self.done = 0
+        self.finished = False
+        self.start = time.monotonic()
+        self.last_print = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return max(time.monotonic() - self.start, 1e-9)
+
+    @property
+    def rate(self) -> float:
+        """Average throughput so far in bytes per second."""
+        return self.done / self.elapsed
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Seconds left at the average rate so far, if the total is known."""
+        if not self.total or not self.done:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+    def update(self, done: int):
+        self.done = done
+        if self.json_lines:
+            return
+        now = time.monotonic()
+        if now - self.last_print >= self.interval:
+            self.last_print = now
+            self.show(end="\n" if self.label else "\r")
+
+    def show(self, end: str = "\n"):
+        if self.json_lines:
+            eta = self.eta
+            print(json.dumps({
+                "device": self.label, "bytes": self.done, "total": self.total,
+                "elapsed": round(self.elapsed, 3), "rate": round(self.rate),
+                "eta": None if eta is None else round(eta, 1), "done": self.finished,
+            }), file=self.file, flush=True)
+            return
+        line = (f"{self.label + ': ' if self.label else ''}{self.done} bytes ({format_size(self.done)}) copied, "
+                f"{self.elapsed:.0f} s, {self.rate / 1e6:.1f} MB/s")
+        if self.total:
+            line += f" [{100 * self.done // self.total}%]"
+        print(line.ljust(79), end=end, flush=True)
+
+    def finish(self):
+        self.finished = True
+        self.show()
+
+
+class ProgressTicker:
+    """Show every meter at a fixed cadence from a background thread.
+
+    Used for JSON progress, so consumers keep getting lines while a
+    write is stalled.
+    """
+
+    def __init__(self, meters: List[ProgressMeter], interval: float = 1.0):
+        self.meters = meters
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for meter in self.meters:
+                if not meter.finished:
+                    meter.show()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def read_into(fd: int, buf: mmap.mmap, want: int, offset: Optional[int] = None) -> int:
+    """Read until want bytes are in buf or EOF, returning the count.
+
+    Reads sequentially, or from a fixed position when offset is given.
+    """
+    with memoryview(buf) as view:
+        filled = 0
+        while filled < want:
+            if offset is None:
+                n = os.readv(fd, [view[filled:want]])
+            else:
+                n = os.preadv(fd, [view[filled:want]], offset + filled)
+            if n == 0:
+                break
+            filled += n
+    return filled
+
+
+def data_ranges(data: bytes, granule: int = BMAP_BLOCK_SIZE) -> List[Tuple[int, int]]:
+    """Return the (start, end) ranges of data that are not all zeros.
+
+    Ranges are found at granule resolution and adjacent ones are merged.
+    """
+    if data == bytes(len(data)):
+        return []
+    zero = bytes(granule)
+    ranges: List[Tuple[int, int]] = []
+    for start in range(0, len(data), granule):
+        piece = data[start:start + granule]
+        if piece == zero[:len(piece)]:
+            continue
+        end = start + len(piece)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def intersect_ranges(a: List[Tuple[int, int]], b: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Intersect two sorted lists of (start, end) ranges."""
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+class BlockMap:
+    """Byte ranges of an image that hold data.
+
+    Reads and writes the XML block-map format used by bmaptool, so maps
+    made by either tool can be used with the other. Anything outside the
+    mapped ranges is treated as "don't care" when flashing.
+    """
+
+    def __init__(self, image_size: int, block_size: int = BMAP_BLOCK_SIZE):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.ranges: List[Tuple[int, int]] = []
+        self.checksums: List[str] = []  # sha256 per range, when known
+        self._starts: List[int] = []
+
+    def add(self, start: int, end: int):
+        """Append a data range; ranges must be added in increasing order."""
+        if self.ranges and self.ranges[-1][1] >= start:
+            self.ranges[-1] = (self.ranges[-1][0], max(end, self.ranges[-1][1]))
+        else:
+            self.ranges.append((start, end))
+            self._starts.append(start)
+
+    @property
+    def mapped_size(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    def within(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """Mapped ranges inside [start, end), relative to start."""
+        i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        result = []
+        while i < len(self.ranges) and self.ranges[i][0] < end:
+            lo, hi = max(self.ranges[i][0], start), min(self.ranges[i][1], end)
+            if lo < hi:
+                result.append((lo - start, hi - start))
+            i += 1
+        return result
+
+    @classmethod
+    def load(cls, path: str) -> "BlockMap":
+        """Read a bmap file."""
+        try:
+            root = ElementTree.parse(path).getroot()
+            block_map = cls(int(root.findtext("ImageSize")), int(root.findtext("BlockSize")))
+            for item in root.iter("Range"):
+                first, _, last = item.text.strip().partition("-")
+                last = last or first
+                block_map.add(int(first) * block_map.block_size,
+                              min((int(last) + 1) * block_map.block_size, block_map.image_size))
+                if item.get("chksum"):
+                    block_map.checksums.append(item.get("chksum"))
+        except (ElementTree.ParseError, TypeError, ValueError) as e:
+            raise FlashError(f"invalid bmap file {path}: {e}")
+        return block_map
+
+    def save(self, path: str):
+        """Write the map as a bmaptool-compatible (version 2.0) bmap file."""
+        bs = self.block_size
+        blocks = -(-self.image_size // bs)
+        mapped = sum(-(-end // bs) - start // bs for start, end in self.ranges)
+        lines = [
+            '<?xml version="1.0" ?>',
+            "<!-- Generated by flask. Data outside the listed ranges is not",
+            "     needed on the target device. -->",
+            '<bmap version="2.0">',
+            f"    <ImageSize> {self.image_size} </ImageSize>",
+            f"    <BlockSize> {bs} </BlockSize>",
+            f"    <BlocksCount> {blocks} </BlocksCount>",
+            f"    <MappedBlocksCount> {mapped} </MappedBlocksCount>",
+            "    <ChecksumType> sha256 </ChecksumType>",
+            "    <BmapFileChecksum> {file_checksum} </BmapFileChecksum>",
+            "    <BlockMap>",
+        ]
+        for i, (start, end) in enumerate(self.ranges):
+            first, last = start // bs, -(-end // bs) - 1
+            text = str(first) if first == last else f"{first}-{last}"
+            chksum = f' chksum="{self.checksums[i]}"' if i < len(self.checksums) else ""
+            lines.append(f"        <Range{chksum}> {text} </Range>")
+        lines += ["    </BlockMap>", "</bmap>", ""]
+        # bmaptool checksums the file with this field set to all zeros.
+        text = "\n".join(lines)
+        checksum = hashlib.sha256(text.replace("{file_checksum}", "0" * 64).encode()).hexdigest()
+        with open(path, "w") as f:
+            f.write(text.replace("{file_checksum}", checksum))
+
+    @classmethod
+    def scan(cls, image_path: str, chunk_size: int = DEFAULT_BLOCK_SIZE) -> "BlockMap":
+        """Build a map of image_path from its allocated extents and data.
+
+        SEEK_DATA/SEEK_HOLE skips unallocated parts of sparse files without
+        reading them; allocated parts are then read and zero blocks dropped.
+        Compressed images are scanned as their decompressed stream.
+        """
+        with ImageSource(image_path) as source:
+            block_map = cls(source.size or 0)
+            hasher = None
+            if source.seekable:
+                pieces = ((offset, os.pread(source.fd, min(chunk_size, end - offset), offset))
+                          for start, end in cls._extents(source.fd, source.size)
+                          for offset in range(start, end, chunk_size))
+            else:
+                pieces = cls._stream(source.fd, chunk_size)
+            for offset, data in pieces:
+                for start, end in data_ranges(data):
+                    if not block_map.ranges or block_map.ranges[-1][1] != offset + start:
+                        if hasher:
+                            block_map.checksums.append(hasher.hexdigest())
+                        hasher = hashlib.sha256()
+                    hasher.update(data[start:end])
+                    block_map.add(offset + start, offset + end)
+                if not source.seekable:
+                    block_map.image_size = offset + len(data)
+            if hasher:
+                block_map.checksums.append(hasher.hexdigest())
+        return block_map
+
+    @staticmethod
+    def _stream(fd: int, chunk_size: int):
+        """Yield (offset, data) chunks read sequentially from fd."""
+        buf = mmap.mmap(-1, chunk_size)
+        offset = 0
+        try:
+            while True:
+                length = read_into(fd, buf, chunk_size)
+                if length == 0:
+                    return
+                yield offset, buf[:length]
+                offset += length
+        finally:
+            buf.close()
+
+    @staticmethod
+    def _extents(fd: int, size: int) -> List[Tuple[int, int]]:
+        """Allocated (start, end) extents of a file, or all of it."""
+        if not hasattr(os, "SEEK_DATA"):
+            return [(0, size)]
+        extents = []
+        pos = 0
+        try:
+            while pos < size:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+                pos = os.lseek(fd, start, os.SEEK_HOLE)
+                # Extents are filesystem-block aligned; keep chunks aligned too.
+                extents.append((start - start % BMAP_BLOCK_SIZE, pos))
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return extents  # no data past pos
+            return [(0, size)]
+        return extents
+
+
+BLKDISCARD = 0x1277
+FALLOC_FL_KEEP_SIZE_PUNCH_HOLE = 0x03
+
+
+def discard_range(fd: int, start: int, end: int) -> bool:
+    """Discard [start, end) on a block device, or punch a hole in a file.
+
+    Only whole aligned blocks inside the range are discarded. Returns
+    False when the target does not support discarding.
+    """
+    start = -(-start // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+    end -= end % DIRECT_IO_ALIGNMENT
+    if end <= start:
+        return True
+    try:
+        if stat.S_ISBLK(os.fstat(fd).st_mode):
+            fcntl.ioctl(fd, BLKDISCARD, struct.pack("QQ", start, end - start))
+            return True
+        if sys.platform.startswith("linux"):
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            return libc.fallocate(fd, FALLOC_FL_KEEP_SIZE_PUNCH_HOLE, start, end - start) == 0
+    except OSError:
+        pass
+    return False
+
+
+def is_url(path: str) -> bool:
+    return path.startswith(("http://", "https://"))
+
+
+def detect_compression(path: str, head: Optional[bytes] = None) -> Optional[str]:
+    """Return the compression format of path (or of head) from its magic bytes."""
+    if head is None:
+        if is_url(path):
+            return None
+        with open(path, "rb") as f:
+            head = f.read(8)
+    for magic, name in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def parse_checksum(text: str) -> Tuple[str, str]:
+    """Parse "ALGORITHM:HEX", or bare hex with the algorithm guessed from its length."""
+    algorithm, _, value = text.rpartition(":")
+    value = value.strip().lower()
+    if not algorithm:
+        algorithm = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}.get(len(value), "")
+    algorithm = algorithm.lower()
+    if algorithm not in hashlib.algorithms_available:
+        raise ValueError(f"unknown checksum algorithm in {text!r}")
+    try:
+        bytes.fromhex(value)
+    except ValueError:
+        raise ValueError(f"checksum {value!r} is not hexadecimal") from None
+    return algorithm, value
+
+
+def file_checksum(path: str, algorithm: str) -> str:
+    """Hex digest of a whole file."""
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class HttpDownload:
+    """Stream an HTTP(S) download into a pipe, hashing it on the way.
+
+    A thread copies the response body into a pipe whose read end is
+    handed to the writers; the pipe is the bounded read-ahead buffer, so
+    the download never gets more than read_ahead bytes ahead of them.
+    The body is hashed as it arrives and checked against the expected
+    checksum, if one was given, when the download is closed.
+    """
+
+    def __init__(self, url: str, checksum: Optional[str] = None,
+                 read_ahead: int = DOWNLOAD_READ_AHEAD, timeout: float = DOWNLOAD_TIMEOUT):
+        self.url = url
+        self.expected = parse_checksum(checksum) if checksum else None
+        self.read_ahead = read_ahead
+        self.timeout = timeout
+        self.length = None  # from Content-Length, if the server sent it
+        self.received = 0
+        self.abandoned = False  # the reader closed the pipe before the end
+        self.head = b""
+        self.error = None
+        self._hasher = hashlib.new(self.expected[0]) if self.expected else None
+        self._response = None
+        self._thread = None
+        self._write_fd = None
+
+    def open(self) -> int:
+        """Start the download; returns the read end of the pipe."""
+        request = urllib.request.Request(self.url, headers={"User-Agent": "flask"})
+        try:
+            self._response = urllib.request.urlopen(request, timeout=self.timeout)
+            length = self._response.headers.get("Content-Length")
+            if length and length.isdigit() and not self._response.headers.get("Content-Encoding"):
+                self.length = int(length)
+            # Peek at the start so the caller can detect compression.
+            self.head = self._response.read(64 * 1024)
+        except (OSError, http.client.HTTPException) as e:
+            if self._response:
+                self._response.close()
+            raise FlashError(f"downloading {self.url} failed: {e}") from None
+        read_fd, self._write_fd = os.pipe()
+        if hasattr(fcntl, "F_SETPIPE_SZ"):
+            for size in (self.read_ahead, 1024 * 1024):
+                try:
+                    fcntl.fcntl(read_fd, fcntl.F_SETPIPE_SZ, size)
+                    break
+                except OSError:
+                    continue  # above /proc/sys/fs/pipe-max-size
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return read_fd
+
+    def _run(self):
+        chunk = self.head
+        try:
+            while chunk:
+                if self._hasher:
+                    self._hasher.update(chunk)
+                self.received += len(chunk)
+                with memoryview(chunk) as view:
+                    done = 0
+                    while done < len(view):
+                        done += os.write(self._write_fd, view[done:])
+                chunk = self._response.read(1024 * 1024)
+        except BrokenPipeError:
+            self.abandoned = True  # the reader gave up; its own error says why
+        except (OSError, http.client.HTTPException) as e:
+            self.error = e
+        finally:
+            os.close(self._write_fd)
+            self._response.close()
+
+    def close(self, check: bool = True):
+        """Wait for the download; raise FlashError if it failed or does not match.
+
+        Nothing is checked when the reader stopped early on purpose: the
+        download was cut short by it, not by the server.
+        """
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if not check or self.abandoned:
+            return
+        if self.error:
+            raise FlashError(f"downloading {self.url} failed: {self.error}")
+        if self.length is not None and self.received != self.length:
+            raise FlashError(f"download of {self.url} ended after {self.received} "
+                             f"of {self.length} bytes")
+        if self.expected:
+            algorithm, value = self.expected
+            actual = self._hasher.hexdigest()
+            if actual != value:
+                raise FlashError(f"{algorithm} of {self.url} is {actual}, expected {value}")
+
+
+class ImageSource:
+    """An image opened for reading, decompressed on the fly if needed.
+
+    Compressed images are decompressed by a child process (the native
+    tool when installed, otherwise Python's own module), so decompression
+    runs on its own core while the parent writes; fd is then the read end
+    of its output pipe and size is None. An HTTP(S) URL is downloaded
+    while it is read and is likewise a stream of unknown size; its
+    compression is only known once it has been opened.
+    """
+
+    def __init__(self, path: str, checksum: Optional[str] = None):
+        self.path = path
+        self.download = HttpDownload(path, checksum) if is_url(path) else None
+        self.compression = detect_compression(path)
+        self.process = None
+        self.fd = None
+        self.size = None if self.compression or self.download else os.path.getsize(path)
+
+    @property
+    def seekable(self) -> bool:
+        return self.compression is None and self.download is None
+
+    @property
+    def length_hint(self) -> Optional[int]:
+        """Expected bytes of image data, where known before reading it."""
+        if self.download and not self.compression:
+            return self.download.length
+        return self.size
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close(check=exc[0] is None)
+
+    def _decompressor(self) -> List[str]:
+        # Downloads are fed to the decompressor on stdin.
+        path = [] if self.download else [self.path]
+        for command in DECOMPRESSORS[self.compression]:
+            if shutil.which(command[0]):
+                return command + path
+        module = PYTHON_DECOMPRESSORS.get(self.compression)
+        if not module:
+            raise FlashError(f"{self.path} is {self.compression}-compressed, "
+                             f"but no {self.compression} decompressor is installed")
+        source = "sys.argv[1]" if path else "sys.stdin.buffer"
+        return [sys.executable, "-c",
+                f"import shutil, sys, {module}; "
+                f"shutil.copyfileobj({module}.open({source}), sys.stdout.buffer, 1 << 20)"] + path
+
+    def open(self) -> int:
+        stdin = None
+        if self.download:
+            stdin = self.download.open()
+            self.compression = detect_compression(self.path, self.download.head)
+            if not self.compression:
+                self.fd = stdin
+                return self.fd
+        elif not self.compression:
+            self.fd = os.open(self.path, os.O_RDONLY)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            return self.fd
+        try:
+            self.process = subprocess.Popen(self._decompressor(), stdin=stdin,
+                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        finally:
+            if stdin is not None:
+                os.close(stdin)  # the decompressor holds its own copy
+        self.fd = self.process.stdout.fileno()
+        if hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                # A bigger pipe means fewer wakeups per block handed over.
+                fcntl.fcntl(self.fd, fcntl.F_SETPIPE_SZ, 1024 * 1024)
+            except OSError:
+                pass
+        return self.fd
+
+    def close(self, check: bool = True):
+        """Close the source; raise FlashError if the download or decompressor failed."""
+        if self.process is None:
+            if self.fd is not None:
+                os.close(self.fd)
+            self.fd = None
+            if self.download:
+                self.download.close(check)
+            return
+        process, self.process = self.process, None
+        if not check:
+            process.kill()
+        process.stdout.close()
+        error = process.stderr.read().decode(errors="replace").strip()
+        process.stderr.close()
+        process.wait()
+        if self.download:
+            # A failed download explains a failed decompressor, so check it first.
+            self.download.close(check)
+        if check and process.returncode != 0:
+            raise FlashError(f"decompressing {self.path} failed: {error or process.returncode}")
+
+
+class ReadAhead:
+    """Read a file descriptor into a pool of aligned buffers on a thread.
+
+    Iterating yields a memoryview per filled buffer, in order. The buffer
+    goes back to the reader as soon as the consumer asks for the next one,
+    so with a depth of N up to N-1 blocks are read ahead of the consumer.
+    Blocks are read sequentially (so pipes work too), or only at the
+    given offsets.
+    """
+
+    def __init__(self, fd: int, block_size: int, depth: int,
+                 limit: Optional[int] = None, offsets: Optional[List[int]] = None):
+        self.fd = fd
+        self.block_size = block_size
+        self.limit = limit
+        self.offsets = offsets
+        self.error = None
+        self._buffers = [mmap.mmap(-1, block_size) for _ in range(depth)]
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for index in range(depth):
+            self._free.put(index)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        self._free.put(None)
+        if self._thread.is_alive():
+            self._thread.join()
+        for buf in self._buffers:
+            try:
+                buf.close()
+            except BufferError:
+                pass  # a consumer still holds a view; let GC reclaim it
+
+    def _run(self):
+        if self.offsets is not None:
+            offsets = iter(self.offsets)
+        elif self.limit is not None:
+            offsets = iter(range(0, self.limit, self.block_size))
+        else:
+            offsets = itertools.count(0, self.block_size)
+        try:
+            for offset in offsets:
+                index = self._free.get()
+                if index is None or self._stop.is_set():
+                    return
+                want = self.block_size
+                if self.limit is not None:
+                    want = min(want, self.limit - offset)
+                # Round the last read up so it stays O_DIRECT-aligned; the
+                # surplus is cut off below.
+                aligned = -(-want // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+                position = offset if self.offsets is not None else None
+                length = min(read_into(self.fd, self._buffers[index], aligned, position), want)
+                if length == 0:
+                    break
+                self._filled.put((index, offset, length))
+                if length < want:
+                    break
+        except OSError as e:
+            self.error = e
+        finally:
+            self._filled.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self._filled.get()
+            if item is None:
+                return
+            index, _, length = item
+            with memoryview(self._buffers[index]) as view:
+                block = view[:length]
+                yield block
+                block.release()
+            self._free.put(index)
+
+    def held(self):
+        """Yield (index, offset, view) that stay valid until release(index).
+
+        Lets a consumer hand blocks to worker threads without copying them.
+        """
+        while True:
+            item = self._filled.get()
+            if item is None:
+                return
+            index, offset, length = item
+            yield index, offset, memoryview(self._buffers[index])[:length]
+
+    def release(self, index: int):
+        self._free.put(index)
+
+
+class ImageDigest:
+    """Digests of an image taken chunk by chunk.
+
+    Keeping one digest per chunk lets a verification pinpoint which part
+    of a device differs; the digest over the whole list stands in for a
+    single image checksum. When only parts of a chunk are mapped (sparse
+    flashing), just those parts are hashed.
+    """
+
+    def __init__(self, algorithm: str = DEFAULT_HASH, chunk_size: int = DEFAULT_BLOCK_SIZE):
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.chunks: List[str] = []
+
+    def add(self, data, ranges: Optional[List[Tuple[int, int]]] = None,
+            length: Optional[int] = None):
+        """Hash the next chunk of the image, or only the given ranges of it."""
+        hasher = new_hasher(self.algorithm)
+        if ranges is None:
+            hasher.update(data)
+        else:
+            for start, end in ranges:
+                hasher.update(data[start:end])
+        self.chunks.append(hasher.hexdigest())
+        self.size += len(data) if length is None else length
+
+    @property
+    def digest(self) -> str:
+        hasher = new_hasher(self.algorithm)
+        for chunk in self.chunks:
+            hasher.update(bytes.fromhex(chunk))
+        return hasher.hexdigest()
+
+    def mismatches(self, other: "ImageDigest") -> List[int]:
+        """Indices of chunks that differ between two digests of one size."""
+        return [i for i, (a, b) in enumerate(zip(self.chunks, other.chunks)) if a != b]
+
+    def save(self, path: str, stamp: Tuple[int, ...], mode: str):
+        """Store the digests in a sidecar file next to the image.
+
+        stamp identifies the image file (see file_stamp) and mode how its
+        chunks were hashed, so a later load can tell if they still apply.
+        """
+        data = {"algorithm": self.algorithm, "chunk_size": self.chunk_size,
+                "size": self.size, "stamp": list(stamp), "mode": mode,
+                "chunks": self.chunks}
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, stamp: Tuple[int, ...], mode: str, algorithm: str,
+             chunk_size: int) -> Optional["ImageDigest"]:
+        """Load sidecar digests, or None if missing or stale."""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        expected = {"algorithm": algorithm, "chunk_size": chunk_size,
+                    "stamp": list(stamp), "mode": mode}
+        if any(data.get(key) != value for key, value in expected.items()):
+            return None
+        digest = cls(algorithm, chunk_size)
+        digest.size = data["size"]
+        digest.chunks = data["chunks"]
+        return digest
+
+
+def file_stamp(path: str) -> Tuple[int, int, int, int]:
+    """(device, inode, size, mtime_ns) of a file; changes when it does."""
+    st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class DigestCache:
+    """Persistent cache of image chunk digests under XDG_CACHE_HOME.
+
+    Entries are keyed by the image file's (device, inode, size, mtime_ns)
+    plus how it was hashed, so any change to the file is a miss. Once the
+    stored digests exceed max_bytes the least recently used are evicted.
+    The cache is best effort: any error reading or writing it is a miss.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.path = path or self.default_path()
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def default_path() -> str:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        return os.path.join(base, "flask", "digests.sqlite")
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=10)
+        db.execute("""CREATE TABLE IF NOT EXISTS digests (
+            dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+            algorithm TEXT, chunk_size INTEGER, mode TEXT,
+            image_size INTEGER, digest TEXT, chunks TEXT,
+            bytes INTEGER, last_used REAL,
+            PRIMARY KEY (dev, ino, size, mtime_ns, algorithm, chunk_size, mode))""")
+        return db
+
+    def get(self, image_path: str, algorithm: str, chunk_size: int,
+            mode: str) -> Optional[ImageDigest]:
+        key = file_stamp(image_path) + (algorithm, chunk_size, mode)
+        try:
+            with closing(self._connect()) as db, db:
+                row = db.execute(
+                    "SELECT image_size, chunks FROM digests WHERE dev=? AND ino=? AND size=? "
+                    "AND mtime_ns=? AND algorithm=? AND chunk_size=? AND mode=?", key).fetchone()
+                if row is None:
+                    return None
+                db.execute(
+                    "UPDATE digests SET last_used=? WHERE dev=? AND ino=? AND size=? "
+                    "AND mtime_ns=? AND algorithm=? AND chunk_size=? AND mode=?",
+                    (time.time(),) + key)
+        except (sqlite3.Error, OSError):
+            return None
+        digest = ImageDigest(algorithm, chunk_size)
+        digest.size = row[0]
+        digest.chunks = row[1].split(",") if row[1] else []
+        return digest
+
+    def put(self, image_path: str, digest: ImageDigest, mode: str):
+        chunks = ",".join(digest.chunks)
+        row = file_stamp(image_path) + (digest.algorithm, digest.chunk_size, mode,
+                                        digest.size, digest.digest, chunks,
+                                        len(chunks), time.time())
+        try:
+            with closing(self._connect()) as db, db:
+                db.execute("INSERT OR REPLACE INTO digests VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", row)
+                total = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM digests").fetchone()[0]
+                for rowid, size in db.execute(
+                        "SELECT rowid, bytes FROM digests ORDER BY last_used").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    db.execute("DELETE FROM digests WHERE rowid=?", (rowid,))
+                    total -= size
+        except (sqlite3.Error, OSError):
+            pass
+
+
+class TuningStore:
+    """Best writer settings per device, as found by flask bench --auto-tune.
+
+    Stored as JSON under XDG_CONFIG_HOME, keyed by the device's model and
+    serial number. Like the digest cache it is best effort.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or self.default_path()
+
+    @staticmethod
+    def default_path() -> str:
+        base = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+        return os.path.join(base, "flask", "tuning.json")
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def get(self, key: str) -> Optional[Dict]:
+        settings = self._load().get(key)
+        try:
+            return {"block_size": int(settings["block_size"]),
+                    "queue_depth": int(settings["queue_depth"]),
+                    "io_mode": IO_MODES[IO_MODES.index(settings["io_mode"])]}
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def put(self, key: str, settings: Dict) -> bool:
+        entries = self._load()
+        entries[key] = settings
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError:
+            return False
+        return True
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of values (0 if there are none)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(fraction * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def chunk_digests(path: str, size: Optional[int] = None, algorithm: str = DEFAULT_HASH,
+                  chunk_size: int = DEFAULT_BLOCK_SIZE, depth: int = DEFAULT_QUEUE_DEPTH,
+                  uncached: bool = False, workers: Optional[int] = None,
+                  block_map: Optional[BlockMap] = None,
+                  decompress: bool = False) -> ImageDigest:
+    """Hash exactly size bytes of path (all of it if None) chunk by chunk.
+
+    One thread reads ahead while a pool hashes the chunks in parallel;
+    hashlib releases the GIL, so this scales across cores. With a block
+    map only mapped data is hashed and unmapped chunks are not read.
+    With decompress, a compressed image is hashed as its decompressed
+    stream.
+    """
+    workers = workers or os.cpu_count() or 1
+    source = None
+    if uncached:
+        fd, _ = open_uncached(path)
+    elif decompress:
+        source = ImageSource(path)
+        fd = source.open()
+    else:
+        fd = os.open(path, os.O_RDONLY)
+    result = ImageDigest(algorithm, chunk_size)
+    complete = False
+    offsets = None
+    if block_map and not (source and not source.seekable):
+        size = block_map.image_size
+        offsets = [offset for offset in range(0, size, chunk_size)
+                   if block_map.within(offset, offset + chunk_size)]
+    futures = {}
+
+    def hash_chunk(reader, index, offset, view):
+        try:
+            hasher = new_hasher(algorithm)
+            if block_map:
+                for start, end in block_map.within(offset, offset + len(view)):
+                    hasher.update(view[start:end])
+            else:
+                hasher.update(view)
+            return hasher.hexdigest(), len(view)
+        finally:
+            view.release()
+            reader.release(index)
+
+    try:
+        with ReadAhead(fd, chunk_size, max(depth, workers + 1), size, offsets) as reader, \
+                ThreadPoolExecutor(max_workers=workers) as pool:
+            for index, offset, view in reader.held():
+                futures[offset] = pool.submit(hash_chunk, reader, index, offset, view)
+            if reader.error:
+                raise reader.error
+            empty = new_hasher(algorithm).hexdigest()
+            for offset in (range(0, size, chunk_size) if offsets is not None else sorted(futures)):
+                if offset in futures:
+                    digest, length = futures[offset].result()
+                else:
+                    digest, length = empty, min(chunk_size, size - offset)
+                result.chunks.append(digest)
+                result.size += length
+        complete = True
+    finally:
+        if source:
+            source.close(check=complete)
+        else:
+            os.close(fd)
+    if size is not None and result.size != size:
+        raise FlashError(f"{path}: expected {size} bytes, read {result.size}")
+    return result
+
+
+def first_difference(path_a: str, path_b: str, offset: int, length: int,
+                     ranges: Optional[List[Tuple[int, int]]] = None) -> Optional[int]:
+    """Return the absolute offset of the first differing byte in a range.
+
+    If ranges (relative to offset) are given, only those are compared.
+    """
+    with open(path_a, "rb") as a, open(path_b, "rb") as b:
+        a.seek(offset)
+        b.seek(offset)
+        data_a, data_b = a.read(length), b.read(length)
+    step = DIRECT_IO_ALIGNMENT
+    for range_start, range_end in ranges or [(0, max(len(data_a), len(data_b)))]:
+        for start in range(range_start, range_end, step):
+            stop = min(start + step, range_end)
+            piece_a, piece_b = data_a[start:stop], data_b[start:stop]
+            if piece_a != piece_b:
+                for i, (x, y) in enumerate(zip(piece_a, piece_b)):
+                    if x != y:
+                        return offset + start + i
+                return offset + start + min(len(piece_a), len(piece_b))
+    return None
+
+
+class BufferRing:
+    """Ring of aligned buffers filled once and drained by several writers.
+
+    The producer may run at most len(slots) blocks ahead of the slowest
+    active consumer, so one slow stick only holds back the others once
+    the ring is full. A consumer that fails is detached and stops
+    counting towards that limit. Each slot carries the offset of its
+    block, the ranges in it that need writing and its chunk digest.
+    """
+
+    def __init__(self, block_size: int, slots: int, consumers: int):
+        self.block_size = block_size
+        self.buffers = [mmap.mmap(-1, block_size) for _ in range(slots)]
+        # (offset, length, ranges to write, chunk digest or None) per slot
+        self.slots: List[tuple] = [(0, 0, [], None)] * slots
+        self.produced = 0
+        self.size = 0
+        self.eof = False
+        self.error = None
+        self.consumed = [0] * consumers
+        self.active = set(range(consumers))
+        self.cancelled = False
+        self.cond = threading.Condition()
+        # Ranges actually handed to the writers, when writing sparsely.
+        self.written_map: Optional[BlockMap] = None
+
+    def _low_water(self) -> int:
+        return min((self.consumed[c] for c in self.active), default=self.produced)
+
+    def fill(self, fd: int, size: Optional[int], digest: Optional[ImageDigest] = None,
+             block_map: Optional[BlockMap] = None, skip_zeros: bool = False,
+             known: Optional[ImageDigest] = None):
+        """Producer loop: read size bytes of fd into the ring.
+
+        A size of None means fd is a stream (such as a decompressor's
+        output) that is read sequentially until EOF. With a block map only
+        mapped ranges are published, and on a seekable source unmapped
+        blocks are not even read; with skip_zeros all-zero blocks are
+        dropped as well. Every block, skipped or not, is hashed into
+        digest; if the chunk digests are already known they are passed on
+        to the writers instead and nothing is hashed.
+        """
+        stream = size is None
+        if block_map or skip_zeros:
+            self.written_map = BlockMap(size or 0)
+        offset = 0
+        try:
+            while stream or offset < size:
+                want = self.block_size if stream else min(self.block_size, size - offset)
+                if block_map and not stream and not block_map.within(offset, offset + want):
+                    if digest and not known:
+                        digest.add(b"", [], want)
+                    offset += want
+                    self.size = offset
+                    continue
+                with self.cond:
+                    while self.active and self.produced - self._low_water() >= len(self.buffers):
+                        self.cond.wait()
+                    if not self.active:
+                        return
+                    slot = self.produced % len(self.buffers)
+                length = read_into(fd, self.buffers[slot], want, None if stream else offset)
+                if length == 0 and stream:
+                    break
+                if length < want and not stream:
+                    raise OSError(errno.EIO, f"image ended early at byte {offset + length}")
+                ranges = block_map.within(offset, offset + length) if block_map else [(0, length)]
+                if skip_zeros and ranges:
+                    ranges = intersect_ranges(ranges, data_ranges(self.buffers[slot][:length]))
+                if self.written_map:
+                    for start, end in ranges:
+                        self.written_map.add(offset + start, offset + end)
+                chunk = None
+                if known:
+                    index = offset // self.block_size
+                    chunk = known.chunks[index] if index < len(known.chunks) else None
+                elif digest:
+                    with memoryview(self.buffers[slot]) as view:
+                        digest.add(view[:length], ranges, length)
+                    chunk = digest.chunks[-1]
+                if ranges:
+                    with self.cond:
+                        self.slots[slot] = (offset, length, ranges, chunk)
+                        self.produced += 1
+                        self.cond.notify_all()
+                offset += length
+                self.size = offset
+                if length < want:
+                    break
+        except OSError as e:
+            self.error = e
+        finally:
+            if self.written_map:
+                self.written_map.image_size = self.size
+            with self.cond:
+                self.eof = True
+                self.cond.notify_all()
+
+    def blocks(self, consumer: int):
+        """Yield this consumer's (offset, view, ranges, chunk) blocks in order."""
+        while True:
+            with self.cond:
+                seq = self.consumed[consumer]
+                while seq >= self.produced and not self.eof and not self.cancelled:
+                    self.cond.wait()
+                if self.cancelled:
+                    raise OSError(errno.ECANCELED, "cancelled")
+                if seq >= self.produced:
+                    return
+                slot = seq % len(self.buffers)
+                offset, length, ranges, chunk = self.slots[slot]
+            with memoryview(self.buffers[slot]) as view:
+                block = view[:length]
+                yield offset, block, ranges, chunk
+                block.release()
+            with self.cond:
+                self.consumed[consumer] += 1
+                self.cond.notify_all()
+
+    def cancel(self, error: Exception):
+        """Stop the producer and every consumer, failing the write with error."""
+        with self.cond:
+            self.error = error
+            self.cancelled = True
+            self.active.clear()
+            self.cond.notify_all()
+
+    def detach(self, consumer: int):
+        with self.cond:
+            self.active.discard(consumer)
+            self.cond.notify_all()
+
+    def close(self):
+        for buf in self.buffers:
+            try:
+                buf.close()
+            except BufferError:
+                pass
+
+
+class WritebackWindow:
+    """Push buffered writes to the device in bounded windows.
+
+    Once a window's worth has been written, writeback of it is started
+    with sync_file_range and the previous window is waited for and
+    dropped from the page cache, so dirty data never piles up and the
+    flushed offset tracks what is really on the device. Where
+    sync_file_range is missing each window is fdatasync'ed instead (fsync'ed
+    where there is no fdatasync either, as on macOS).
+    """
+
+    def __init__(self, fd: int, window: int = DEFAULT_SYNC_WINDOW):
+        self.fd = fd
+        self.window = window
+        self.started = 0  # writeback has been started up to here
+        self.flushed = 0  # everything below this offset is on the device
+        self._sync_file_range = None
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                self._sync_file_range = libc.sync_file_range
+                self._sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                                  ctypes.c_int64, ctypes.c_uint]
+            except (AttributeError, OSError):
+                pass
+
+    def _sync_range(self, start: int, end: int, flags: int):
+        if self._sync_file_range(self.fd, start, end - start, flags) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def wrote(self, end: int) -> int:
+        """Note that everything below end has been written; returns the flushed offset."""
+        if end - self.started >= self.window:
+            self.flush(end, wait=False)
+        return self.flushed
+
+    def flush(self, end: int, wait: bool = True):
+        """Start writeback up to end, waiting for all of it if wait is set."""
+        if self._sync_file_range is None:
+            getattr(os, "fdatasync", os.fsync)(self.fd)
+            self.started = self.flushed = end
+            return
+        self._sync_range(self.started, end, SYNC_FILE_RANGE_WRITE)
+        # Waiting one window behind keeps the device busy with the
+        # current window while the previous one completes.
+        settled = end if wait else self.started
+        if settled > self.flushed:
+            self._sync_range(self.flushed, settled, SYNC_FILE_RANGE_WAIT_BEFORE |
+                             SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(self.fd, self.flushed, settled - self.flushed,
+                                 os.POSIX_FADV_DONTNEED)
+            self.flushed = settled
+        self.started = end
+
+
+class BlockWriter:
+    """Pipelined image writer for one or more devices.
+
+    A reader thread fills a ring of page-aligned buffers from the image
+    while one writer thread per device drains it, so the source and every
+    USB bus are kept busy at the same time instead of alternating like dd
+    does. The image is read once no matter how many devices are written.
+    Writes use O_DIRECT where a device allows it and O_DSYNC otherwise,
+    unless another I/O mode is asked for; buffered writes are flushed in
+    windows of sync_window bytes.
+
+    In sparse mode only mapped (bmap) or non-zero ranges are written and
+    the rest of the device keeps its old contents; with discard, the
+    skipped ranges are discarded where the device supports it. In delta
+    mode each writer first reads its device's copy of a block and only
+    writes the block if its digest differs from the image's.
+    """
+
+    def __init__(self, block_size: int = DEFAULT_BLOCK_SIZE,
+                 queue_depth: int = DEFAULT_QUEUE_DEPTH, io_mode: str = "direct",
+                 skip_zeros: bool = False, discard: bool = False, delta: bool = False,
+                 record_latency: bool = False, sync_window: int = DEFAULT_SYNC_WINDOW):
+        if block_size <= 0 or block_size % DIRECT_IO_ALIGNMENT:
+            raise ValueError(f"block size must be a multiple of {DIRECT_IO_ALIGNMENT}")
+        if queue_depth < 2:
+            raise ValueError("queue depth must be at least 2")
+        if io_mode not in IO_MODES:
+            raise ValueError(f"I/O mode must be one of {', '.join(IO_MODES)}")
+        self.block_size = block_size
+        self.queue_depth = queue_depth
+        self.io_mode = io_mode
+        self.sync_window = sync_window
+        self.skip_zeros = skip_zeros
+        self.discard = discard
+        self.delta = delta
+        self.modes: Dict[str, str] = {}  # device -> I/O mode actually used
+        # device -> seconds taken by each write call, when record_latency
+        self.latencies: Optional[Dict[str, List[float]]] = {} if record_latency else None
+        self.unchanged: Dict[str, int] = {}  # device -> bytes delta mode kept
+        self.undiscarded: List[str] = []  # devices that could not discard skipped ranges
+        self.image_size = 0  # bytes of (decompressed) image last written
+        self.written_map: Optional[BlockMap] = None
+        self.cancelled = False
+        self._ring: Optional[BufferRing] = None
+
+    @property
+    def mode(self) -> Optional[str]:
+        """I/O mode of the most recently opened device."""
+        return list(self.modes.values())[-1] if self.modes else None
+
+    def cancel(self):
+        """Abort the write in progress (from another thread); every device fails."""
+        self.cancelled = True
+        ring = self._ring
+        if ring:
+            ring.cancel(FlashError("cancelled"))
+
+    def open_device(self, device: str) -> int:
+        """Open the target for writing in the requested I/O mode.
+
+        Direct I/O falls back to O_DSYNC where O_DIRECT is unsupported.
+        """
+        if self.io_mode == "buffered":
+            self.modes[device] = "buffered"
+            return os.open(device, os.O_WRONLY)
+        if self.io_mode == "direct" and O_DIRECT:
+            try:
+                fd = os.open(device, os.O_WRONLY | O_DIRECT)
+                self.modes[device] = "direct"
+                return fd
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+        fd = os.open(device, os.O_WRONLY | os.O_DSYNC)
+        if sys.platform == "darwin" and self.io_mode == "direct":
+            fcntl.fcntl(fd, F_NOCACHE, 1)
+        self.modes[device] = "dsync"
+        return fd
+
+    def _reopen_dsync(self, fd: int, device: str) -> int:
+        """Fall back to O_DSYNC when the device rejects direct writes."""
+        os.close(fd)
+        fd = os.open(device, os.O_WRONLY | os.O_DSYNC)
+        self.modes[device] = "dsync"
+        return fd
+
+    def _write_block(self, fd: int, device: str, view: memoryview, offset: int) -> int:
+        """Write one buffer at offset, returning the (possibly reopened) fd."""
+        if O_DIRECT and len(view) % DIRECT_IO_ALIGNMENT:
+            # The unaligned tail of the image cannot go through O_DIRECT;
+            # drop the flag for this last write and fsync afterwards.
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            if flags & O_DIRECT:
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~O_DIRECT)
+        done = 0
+        while done < len(view):
+            try:
+                done += os.pwrite(fd, view[done:], offset + done)
+            except OSError as e:
+                direct = O_DIRECT and fcntl.fcntl(fd, fcntl.F_GETFL) & O_DIRECT
+                if e.errno != errno.EINVAL or not direct:
+                    raise
+                fd = self._reopen_dsync(fd, device)
+        return fd
+
+    def _unchanged(self, fd: int, scratch: mmap.mmap, algorithm: str, offset: int,
+                   block: memoryview, ranges: List[Tuple[int, int]], chunk: str) -> bool:
+        """Whether the device already holds this block's ranges."""
+        want = -(-len(block) // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+        length = read_into(fd, scratch, want, offset)
+        if length < len(block):
+            return False
+        hasher = new_hasher(algorithm)
+        with memoryview(scratch) as view:
+            for start, end in ranges:
+                hasher.update(view[start:end])
+        return hasher.hexdigest() == chunk
+
+    def _drain(self, ring: BufferRing, consumer: int, device: str,
+               progress: Optional[ProgressMeter], algorithm: str = DEFAULT_HASH) -> int:
+        written = 0
+        unchanged = 0
+        discard = self.discard
+        latencies = None
+        if self.latencies is not None:
+            latencies = self.latencies.setdefault(device, [])
+        position = 0  # end of the last range written or discarded
+        reader = scratch = None
+        try:
+            dst = self.open_device(device)
+            window = WritebackWindow(dst, self.sync_window) if self.io_mode == "buffered" else None
+            if self.delta:
+                reader, _ = open_uncached(device)
+                scratch = mmap.mmap(-1, self.block_size)
+            try:
+                for offset, block, ranges, chunk in ring.blocks(consumer):
+                    if reader is not None and chunk is not None and \
+                            self._unchanged(reader, scratch, algorithm, offset, block, ranges, chunk):
+                        unchanged += sum(end - start for start, end in ranges)
+                        ranges = []
+                        # Nothing up to here may be discarded: it holds the unchanged data.
+                        position = offset + len(block)
+                    for start, end in ranges:
+                        if discard and offset + start > position:
+                            discard = discard_range(dst, position, offset + start)
+                        if latencies is None:
+                            dst = self._write_block(dst, device, block[start:end], offset + start)
+                        else:
+                            began = time.perf_counter()
+                            dst = self._write_block(dst, device, block[start:end], offset + start)
+                            latencies.append(time.perf_counter() - began)
+                        written += end - start
+                        position = offset + end
+                    done = offset + len(block)
+                    if window:
+                        # Only count what has reached the device.
+                        done = window.wrote(done)
+                    if progress:
+                        progress.update(done)
+                if discard and ring.size > position:
+                    discard = discard_range(dst, position, ring.size)
+                if self.discard and not discard:
+                    self.undiscarded.append(device)
+                if window:
+                    window.flush(ring.size)
+                os.fsync(dst)
+                if progress:
+                    progress.update(ring.size)
+            finally:
+                os.close(dst)
+                if reader is not None:
+                    os.close(reader)
+                    scratch.close()
+        except BaseException:
+            ring.detach(consumer)
+            raise
+        self.unchanged[device] = unchanged
+        return written
+
+    def write_many(self, image_path: str, devices: List[str],
+                   progress: Optional[Dict[str, ProgressMeter]] = None,
+                   digest: Optional[ImageDigest] = None,
+                   block_map: Optional[BlockMap] = None,
+                   known: Optional[ImageDigest] = None,
+                   checksum: Optional[str] = None) -> Dict[str, object]:
+        """Copy image_path to every device concurrently.
+
+        Returns a mapping from device to the number of bytes written, or
+        to the FlashError that stopped that device. If digest is given,
+        every block is hashed into it on the reader thread as it is read,
+        so the source digest comes with the write. If block_map is given,
+        only its mapped ranges are read and written. Compressed images are
+        decompressed on the fly and the digest covers the decompressed data.
+        If the image's chunk digests are already known (from a cache), pass
+        them as known and the image is not hashed again. An HTTP(S) URL is
+        streamed straight from the network; checksum ("sha256:HEX") is the
+        expected digest of the download and a mismatch fails every device.
+        """
+        if self.delta and not (digest or known):
+            digest = ImageDigest(chunk_size=self.block_size)
+        for chunks in (digest, known):
+            if chunks and chunks.chunk_size != self.block_size:
+                raise ValueError("digest chunk size must match the block size")
+        algorithm = (known or digest).algorithm if (known or digest) else DEFAULT_HASH
+        progress = progress or {}
+        source = ImageSource(image_path, checksum)
+        if block_map and source.size is not None and block_map.image_size != source.size:
+            raise FlashError(f"bmap is for a {block_map.image_size} byte image, "
+                             f"{image_path} has {source.size} bytes")
+
+        ring = BufferRing(self.block_size, self.queue_depth, len(devices))
+        self._ring = ring
+        if self.cancelled:
+            ring.cancel(FlashError("cancelled"))
+        results: Dict[str, object] = {}
+
+        def run(consumer, device):
+            try:
+                results[device] = self._drain(ring, consumer, device,
+                                              progress.get(device), algorithm)
+            except OSError as e:
+                results[device] = FlashError(f"error writing {device}: {e}")
+            except Exception as e:
+                # Whatever stops a writer is that device's failure, never the caller's.
+                results[device] = FlashError(f"error writing {device}: {type(e).__name__}: {e}")
+
+        writers = [threading.Thread(target=run, args=(i, device), daemon=True)
+                   for i, device in enumerate(devices)]
+        for thread in writers:
+            thread.start()
+        source_error = None
+        try:
+            source.open()
+            read_all = False
+            try:
+                for meter in progress.values():
+                    meter.total = meter.total or source.length_hint
+                ring.fill(source.fd, source.size, digest, block_map, self.skip_zeros, known)
+                read_all = True
+            finally:
+                # Once every writer has failed the source is abandoned part
+                # read, so a short download or a decompressor killed by
+                # SIGPIPE says nothing about the image.
+                source.close(check=read_all and bool(ring.active))
+            if block_map and ring.size != block_map.image_size:
+                source_error = FlashError(f"bmap is for a {block_map.image_size} byte image, "
+                                          f"{image_path} has {ring.size} bytes")
+        except (FlashError, OSError) as e:
+            source_error = e
+            ring.error = ring.error or e
+        finally:
+            with ring.cond:
+                ring.eof = True
+                ring.cond.notify_all()
+            for thread in writers:
+                thread.join()
+            ring.close()
+        self.image_size = ring.size
+        self.written_map = ring.written_map
+        if ring.error or source_error:
+            error = ring.error or source_error
+            if not isinstance(error, FlashError):
+                error = FlashError(f"error reading {image_path}: {error}")
+            for device in devices:
+                # A device that already failed keeps its own reason.
+                if ring.cancelled or not isinstance(results.get(device), Exception):
+                    results[device] = error
+        return results
+
+    def write(self, image_path: str, device: str,
+              progress: Optional[ProgressMeter] = None,
+              digest: Optional[ImageDigest] = None,
+              block_map: Optional[BlockMap] = None,
+              known: Optional[ImageDigest] = None,
+              checksum: Optional[str] = None) -> int:
+        """Copy image_path to a single device, returning the bytes written."""
+        result = self.write_many(image_path, [device],
+                                 {device: progress} if progress else None,
+                                 digest, block_map, known, checksum)[device]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class WriteBenchmark:
+    """Time the write pipeline against a target for a grid of settings.
+
+    A temporary file of random data is written to the target once for
+    every combination of block size, queue depth and I/O mode. Each run
+    records its throughput and the latency of every write call. The
+    target is overwritten, so point it at a scratch file, a loop device
+    or a drive whose contents can be lost.
+    """
+
+    def __init__(self, target: str, size: int, block_sizes: List[int],
+                 queue_depths: List[int], io_modes: List[str]):
+        self.target = target
+        self.size = size
+        self.block_sizes = block_sizes
+        self.queue_depths = queue_depths
+        self.io_modes = io_modes
+
+    def measure(self, source: str, block_size: int, queue_depth: int, io_mode: str) -> Dict:
+        """Write source to the target once with the given settings."""
+        result = {"block_size": block_size, "queue_depth": queue_depth, "io_mode": io_mode}
+        try:
+            writer = BlockWriter(block_size, queue_depth, io_mode, record_latency=True)
+            start = time.monotonic()
+            writer.write(source, self.target)
+            seconds = time.monotonic() - start
+        except (FlashError, OSError, ValueError) as e:
+            result["error"] = str(e)
+            return result
+        latencies = writer.latencies.get(self.target, [])
+        result.update({
+            "actual_mode": writer.modes.get(self.target, io_mode),
+            "seconds": round(seconds, 4),
+            "mb_per_s": round(self.size / seconds / 1e6, 2) if seconds > 0 else 0.0,
+            "writes": len(latencies),
+            "latency_ms": {name: round(percentile(latencies, fraction) * 1000, 3)
+                           for name, fraction in (("p50", 0.5), ("p90", 0.9),
+                                                  ("p99", 0.99), ("max", 1.0))},
+        })
+        return result
+
+    def run(self, report=None) -> Dict:
+        """Run every combination; report is called with each result as it completes."""
+        results = []
+        with tempfile.NamedTemporaryFile(prefix="flask-bench-") as source:
+            remaining = self.size
+            while remaining:
+                remaining -= source.write(os.urandom(min(remaining, 1024 * 1024)))
+            source.flush()
+            for io_mode, block_size, queue_depth in itertools.product(
+                    self.io_modes, self.block_sizes, self.queue_depths):
+                results.append(self.measure(source.name, block_size, queue_depth, io_mode))
+                if report:
+                    report(results[-1])
+        completed = [result for result in results if "error" not in result]
+        return {
+            "target": self.target,
+            "size": self.size,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "results": results,
+            "best": max(completed, key=lambda result: result["mb_per_s"]) if completed else None,
+        }
+
+
+PROBE_SECONDS = 6.0
+PROBE_SAMPLE_SIZE = 64 * 1024
+PROBE_SAMPLES = 64
+DEFAULT_MIN_SPEED = 2.0  # MB/s of sequential writes below which probe rejects a drive
+
+
+class DeviceProbe:
+    """Measure a drive's speed and check that it holds what it claims.
+
+    Writes and reads back a stretch at the start of the drive
+    sequentially, then small blocks at offsets spread over the whole
+    claimed capacity (including every power of two, where drives that
+    drop high address bits wrap around) in random order. Every 4 KiB
+    sector is stamped with a per-probe nonce and its own offset, so data
+    that turns up somewhere else, or not at all, gives a counterfeit
+    drive away. The probed blocks are overwritten.
+    """
+
+    def __init__(self, device: str, seconds: float = PROBE_SECONDS,
+                 block_size: int = 1024 * 1024, sample_size: int = PROBE_SAMPLE_SIZE,
+                 samples: int = PROBE_SAMPLES):
+        self.device = device
+        self.seconds = seconds
+        self.block_size = block_size
+        self.sample_size = sample_size
+        self.samples = samples
+        self.nonce = os.urandom(8)
+        self._random = random.Random(self.nonce)
+        self._fill = os.urandom(block_size)
+
+    def pattern(self, buf: mmap.mmap, offset: int, length: int):
+        """Fill buf with the data this probe writes at offset."""
+        buf[:length] = self._fill[:length]
+        for sector in range(0, length, DIRECT_IO_ALIGNMENT):
+            buf[sector:sector + 16] = struct.pack("<8sQ", self.nonce, offset + sector)
+
+    def check(self, data: memoryview, expected: mmap.mmap, offset: int) -> Optional[int]:
+        """None if data is what was written at offset, else the offset it came from (-1 if unknown)."""
+        self.pattern(expected, offset, len(data))
+        if data == memoryview(expected)[:len(data)]:
+            return None
+        for sector in range(0, len(data), DIRECT_IO_ALIGNMENT):
+            nonce, found = struct.unpack("<8sQ", data[sector:sector + 16])
+            if nonce != self.nonce:
+                return -1
+            if found != offset + sector:
+                return found - sector
+        return -1
+
+    def sample_offsets(self, capacity: int) -> List[int]:
+        last = (capacity - self.sample_size) // DIRECT_IO_ALIGNMENT * DIRECT_IO_ALIGNMENT
+        offsets = {last * i // (self.samples - 1) // DIRECT_IO_ALIGNMENT * DIRECT_IO_ALIGNMENT
+                   for i in range(self.samples)}
+        power = self.sample_size
+        while power <= last:
+            offsets.add(power)
+            power *= 2
+        return sorted(offsets)
+
+    def _write(self, fd: int, buf: mmap.mmap, offset: int, length: int):
+        with memoryview(buf) as view:
+            done = 0
+            while done < length:
+                done += os.pwrite(fd, view[done:length], offset + done)
+
+    def _sequential(self, capacity: int, result: Dict, bad: List[Tuple[int, int]]):
+        deadline = time.monotonic() + self.seconds / 2
+        limit = capacity // self.block_size * self.block_size
+        buf = mmap.mmap(-1, self.block_size)
+        expected = mmap.mmap(-1, self.block_size)
+        writer = BlockWriter(self.block_size, io_mode="direct")
+        fd = writer.open_device(self.device)
+        result["io_mode"] = writer.modes[self.device]
+        written = 0
+        seconds = 0.0  # only the I/O is timed, not making or checking patterns
+        try:
+            while written < limit and (written == 0 or time.monotonic() < deadline):
+                self.pattern(buf, written, self.block_size)
+                start = time.perf_counter()
+                self._write(fd, buf, written, self.block_size)
+                seconds += time.perf_counter() - start
+                written += self.block_size
+            start = time.perf_counter()
+            os.fsync(fd)
+            seconds += time.perf_counter() - start
+        finally:
+            os.close(fd)
+        result["sequential_bytes"] = written
+        result["sequential_write"] = written / seconds
+        fd, _ = open_uncached(self.device)
+        try:
+            seconds = 0.0
+            for offset in range(0, written, self.block_size):
+                start = time.perf_counter()
+                length = read_into(fd, buf, self.block_size, offset)
+                seconds += time.perf_counter() - start
+                with memoryview(buf) as view:
+                    found = self.check(view[:length], expected, offset)
+                if length < self.block_size or found is not None:
+                    bad.append((offset, -1 if found is None else found))
+            result["sequential_read"] = written / seconds
+        finally:
+            os.close(fd)
+            buf.close()
+            expected.close()
+
+    def _random_io(self, capacity: int, result: Dict, bad: List[Tuple[int, int]]):
+        offsets = self.sample_offsets(capacity)
+        # Offset 0 goes first, so a wrapped write over it shows up when it is read back.
+        order = offsets[1:]
+        self._random.shuffle(order)
+        order.insert(0, offsets[0])
+        buf = mmap.mmap(-1, self.sample_size)
+        expected = mmap.mmap(-1, self.sample_size)
+        writer = BlockWriter(self.block_size, io_mode="direct")
+        fd = writer.open_device(self.device)
+        seconds = 0.0
+        try:
+            for offset in order:
+                self.pattern(buf, offset, self.sample_size)
+                start = time.perf_counter()
+                self._write(fd, buf, offset, self.sample_size)
+                seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            os.fsync(fd)
+            seconds += time.perf_counter() - start
+        finally:
+            os.close(fd)
+        result["random_writes"] = len(order)
+        result["random_write_iops"] = len(order) / seconds
+        self._random.shuffle(order)
+        fd, _ = open_uncached(self.device)
+        try:
+            seconds = 0.0
+            for offset in order:
+                start = time.perf_counter()
+                length = read_into(fd, buf, self.sample_size, offset)
+                seconds += time.perf_counter() - start
+                with memoryview(buf) as view:
+                    found = self.check(view[:length], expected, offset)
+                if length < self.sample_size or found is not None:
+                    bad.append((offset, -1 if found is None else found))
+            result["random_read_iops"] = len(order) / seconds
+        finally:
+            os.close(fd)
+            buf.close()
+            expected.close()
+
+    def run(self) -> Dict:
+        """Probe the drive; raises OSError if it cannot be opened or written."""
+        fd = os.open(self.device, os.O_RDONLY)
+        try:
+            capacity = os.lseek(fd, 0, os.SEEK_END)
+        finally:
+            os.close(fd)
+        if capacity < max(self.block_size, self.sample_size):
+            raise OSError(errno.ENOSPC, f"{self.device} is too small to probe ({capacity} bytes)")
+        result = {"device": self.device, "capacity": capacity,
+                  "sample_size": self.sample_size, "block_size": self.block_size}
+        bad: List[Tuple[int, int]] = []
+        self._sequential(capacity, result, bad)
+        self._random_io(capacity, result, bad)
+        result["bad_blocks"] = [{"offset": offset, "found": found} for offset, found in sorted(bad)]
+        # Data written above the real capacity vanishes, or lands on the
+        # same place as data for other offsets: of the offsets sharing a
+        # place only the lowest can really exist.
+        limits = [offset for offset, found in bad if found < 0]
+        aliases: Dict[int, set] = {}
+        for offset, found in bad:
+            if found >= 0:
+                aliases.setdefault(found, {found}).add(offset)
+        for offsets in aliases.values():
+            limits.extend(sorted(offsets)[1:])
+        result["usable_capacity"] = min(limits) if limits else (0 if bad else capacity)
+        return result
+
+
+def parse_mountinfo(path: str = "/proc/self/mountinfo") -> List[Dict[str, str]]:
+    """Parse a mountinfo file into one dict per mount.
+
+    Each dict has the mount's "dev" (major:minor), "mountpoint", "fstype"
+    and "source". Octal escapes such as \\040 in paths are decoded.
+    """
+    def unescape(field: str) -> str:
+        return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+    mounts = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            try:
+                separator = fields.index("-", 6)
+            except ValueError:
+                continue
+            mounts.append({
+                "dev": fields[2],
+                "mountpoint": unescape(fields[4]),
+                "fstype": fields[separator + 1],
+                "source": unescape(fields[separator + 2]) if len(fields) > separator + 2 else "",
+            })
+    return mounts
+
+
+class DeviceEnumerator:
+    """Describe block devices from sysfs and mountinfo without forking.
+
+    The sysfs and mountinfo locations can be pointed at a fake tree for
+    testing.
+    """
+
+    def __init__(self, sysfs_root: str = "/sys", mountinfo: str = "/proc/self/mountinfo"):
+        self.sysfs_root = sysfs_root
+        self.mountinfo = mountinfo
+
+    def _read(self, *parts: str) -> str:
+        try:
+            with open(os.path.join(self.sysfs_root, "block", *parts)) as f:
+                return f.read().strip()
+        except OSError:
+            return ""
+
+    def disks(self) -> List[str]:
+        try:
+            return sorted(os.listdir(os.path.join(self.sysfs_root, "block")))
+        except OSError:
+            return []
+
+    def is_removable(self, name: str) -> bool:
+        return self._read(name, "removable") == "1"
+
+    def size(self, name: str) -> int:
+        """Size in bytes; sysfs always counts 512-byte sectors."""
+        sectors = self._read(name, "size")
+        return int(sectors) * 512 if sectors.isdigit() else 0
+
+    def model(self, name: str) -> str:
+        vendor = self._read(name, "device", "vendor")
+        model = self._read(name, "device", "model")
+        return " ".join(part for part in (vendor, model) if part) or "Unknown"
+
+    def serial(self, name: str) -> str:
+        """Serial number of the disk, or of the USB device it sits on."""
+        serial = self._read(name, "device", "serial")
+        if serial:
+            return serial
+        # USB mass storage only exposes the serial on the USB device,
+        # a few levels above the SCSI device in sysfs.
+        path = os.path.realpath(os.path.join(self.sysfs_root, "block", name, "device"))
+        for _ in range(6):
+            path = os.path.dirname(path)
+            try:
+                with open(os.path.join(path, "serial")) as f:
+                    return f.read().strip()
+            except OSError:
+                continue
+        return ""
+
+    def partitions(self, name: str) -> List[str]:
+        try:
+            entries = os.listdir(os.path.join(self.sysfs_root, "block", name))
+        except OSError:
+            return []
+        return sorted(entry for entry in entries
+                      if os.path.exists(os.path.join(self.sysfs_root, "block", name,
+                                                     entry, "partition")))
+
+    def dev_number(self, name: str, partition: Optional[str] = None) -> str:
+        """The "major:minor" of a disk or one of its partitions."""
+        return self._read(name, partition, "dev") if partition else self._read(name, "dev")
+
+    def controller(self, name: str) -> str:
+        """sysfs path of the USB host controller a disk hangs off ("" if not on USB)."""
+        path = os.path.realpath(os.path.join(self.sysfs_root, "block", name, "device"))
+        parts = path.split(os.sep)
+        for index, part in enumerate(parts):
+            # usbN is a controller's root hub; its parent is the controller
+            # itself, shared by the USB 2 and USB 3 hubs of an xHCI.
+            if re.fullmatch(r"usb\d+", part):
+                return os.sep.join(parts[:index])
+        return ""
+
+    def mounts(self) -> Dict[str, List[str]]:
+        """Map "major:minor" to the mountpoints of that device."""
+        result: Dict[str, List[str]] = {}
+        try:
+            for mount in parse_mountinfo(self.mountinfo):
+                result.setdefault(mount["dev"], []).append(mount["mountpoint"])
+        except OSError:
+            pass
+        return result
+
+    def dev_numbers(self, device: str) -> List[str]:
+        """The "major:minor" of a device node and, for a disk, of its partitions."""
+        st = os.stat(device)
+        if not stat.S_ISBLK(st.st_mode):
+            return []
+        number = f"{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}"
+        for name in self.disks():
+            if self.dev_number(name) == number:
+                return [number] + [self.dev_number(name, part) for part in self.partitions(name)]
+        return [number]
+
+    def devices(self, removable_only: bool = True) -> List[Dict[str, str]]:
+        """Describe each (removable) disk like list_available_devices does."""
+        mounts = self.mounts()
+        devices = []
+        for name in self.disks():
+            if removable_only and not self.is_removable(name):
+                continue
+            numbers = [self.dev_number(name)] + [self.dev_number(name, part)
+                                                 for part in self.partitions(name)]
+            mountpoints = [point for number in numbers for point in mounts.get(number, [])]
+            devices.append({
+                "device": f"/dev/{name}",
+                "size": format_size(self.size(name)),
+                "model": self.model(name),
+                "mountpoint": ", ".join(mountpoints),
+            })
+        return devices
+
+
+NETLINK_KOBJECT_UEVENT = 15
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+
+def unmount_order(mounts: List[Dict[str, str]]) -> List[List[Dict[str, str]]]:
+    """Split mounts (in mountinfo order) into waves that can be unmounted concurrently.
+
+    A mount can only go once nothing is mounted on top of it: neither
+    below its mountpoint nor later over the same mountpoint.
+    """
+    def on_top(upper, lower):
+        if upper["mountpoint"] == lower["mountpoint"]:
+            return mounts.index(upper) > mounts.index(lower)
+        return upper["mountpoint"].startswith(lower["mountpoint"].rstrip("/") + "/")
+
+    waves = []
+    remaining = list(mounts)
+    while remaining:
+        wave = [mount for mount in remaining
+                if not any(other is not mount and on_top(other, mount) for other in remaining)]
+        waves.append(wave)
+        remaining = [mount for mount in remaining if mount not in wave]
+    return waves
+
+
+def unmount(mountpoint: str) -> Optional[OSError]:
+    """umount2() a mountpoint without forking umount; returns the error, if any."""
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.umount2(os.fsencode(mountpoint), 0) != 0:
+        err = ctypes.get_errno()
+        return OSError(err, os.strerror(err), mountpoint)
+    return None
+
+
+def unmount_targets(devices: List[str], enumerator: "DeviceEnumerator") -> \
+        List[Tuple[str, Optional[Dict[str, str]], Optional[OSError]]]:
+    """Unmount every partition of every device, all at once.
+
+    Returns (device, mount, error) for each mount found, with a mount of
+    None for a device that could not be opened. Raises OSError if
+    mountinfo cannot be read.
+    """
+    mounts = parse_mountinfo(enumerator.mountinfo)
+    report = []
+    owners = {}  # major:minor -> device
+    for device in devices:
+        try:
+            for number in enumerator.dev_numbers(device):
+                owners[number] = device
+        except OSError as e:
+            report.append((device, None, e))
+    targets = [mount for mount in mounts if mount["dev"] in owners]
+    with ThreadPoolExecutor(max_workers=max(len(targets), 1)) as pool:
+        for wave in unmount_order(targets):
+            for mount, error in zip(wave, pool.map(lambda m: unmount(m["mountpoint"]), wave)):
+                report.append((owners[mount["dev"]], mount, error))
+    return report
+
+
+class DeviceWatcher:
+    """Block until block devices may have been added or removed.
+
+    Listens to kernel uevents on a netlink socket; where that is not
+    available it watches /dev with inotify, and failing that it polls.
+    """
+
+    def __init__(self, dev_root: str = "/dev", poll_interval: float = 1.0):
+        self.poll_interval = poll_interval
+        self.fd = None
+        self.method = "poll"
+        self._sock = None
+        try:
+            self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                       NETLINK_KOBJECT_UEVENT)
+            self._sock.bind((0, 1))  # multicast group 1: kernel uevents
+            self.fd = self._sock.fileno()
+            self.method = "uevent"
+            return
+        except (AttributeError, OSError):
+            if self._sock:
+                self._sock.close()
+            self._sock = None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0 and libc.inotify_add_watch(fd, dev_root.encode(), IN_CREATE | IN_DELETE) >= 0:
+                self.fd = fd
+                self.method = "inotify"
+            elif fd >= 0:
+                os.close(fd)
+        except (AttributeError, OSError):
+            pass
+
+    def _relevant(self, message: bytes) -> bool:
+        if self.method != "uevent":
+            return True
+        fields = message.split(b"\0")
+        return b"SUBSYSTEM=block" in fields and fields[0].split(b"@")[0] in (b"add", b"remove", b"change")
+
+    def wait(self, timeout: Optional[float] = None, settle: float = 0.2) -> bool:
+        """Wait for a device change; returns False on timeout.
+
+        Events arriving within settle seconds of the first (a disk and
+        then its partitions, say) are folded into one change.
+        """
+        if self.fd is None:
+            time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+            return True
+        changed = False
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if changed:
+                wait = settle
+            else:
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+            ready, _, _ = select.select([self.fd], [], [], wait)
+            if not ready:
+                return changed
+            message = os.read(self.fd, 65536)
+            changed = changed or self._relevant(message)
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+        elif self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+
+class EventMeter(ProgressMeter):
+    """Progress meter that reports through a callback instead of printing."""
+
+    def __init__(self, emit, job_id, total: Optional[int] = None,
+                 interval: float = 1.0, label: str = ""):
+        super().__init__(total, interval, label)
+        self.emit = emit
+        self.job_id = job_id
+
+    def show(self, end: str = "\n"):
+        eta = self.eta
+        self.emit({"type": "progress", "job": self.job_id, "device": self.label,
+                   "bytes": self.done, "total": self.total, "rate": round(self.rate),
+                   "eta": None if eta is None else round(eta, 1), "done": self.finished})
+
+
+class FlashJob:
+    """Flash one image to one or more devices, for use as a library.
+
+    Unlike the command line it neither prints nor exits. run() blocks
+    and returns the per-device results; while it runs, on_event (if
+    given) is called from the writer threads with plain dicts:
+
+        {"type": "started", "job", "image", "devices"}
+        {"type": "progress", "job", "device", "bytes", "total", "rate", "eta", "done"}
+        {"type": "unmounted", "job", "device", "mountpoint", "error"}
+        {"type": "verifying", "job", "device"}
+        {"type": "finished", "job", "state", "results"}
+
+    where results maps each device to {"ok", "bytes", "verified", "error"}
+    and state is "done" or "cancelled". cancel() may be called from any
+    thread.
+    """
+
+    def __init__(self, image: str, devices: List[str], block_size: int = DEFAULT_BLOCK_SIZE,
+                 queue_depth: int = DEFAULT_QUEUE_DEPTH, io_mode: str = "direct",
+                 verify: bool = False, checksum: Optional[str] = None, sparse: bool = False,
+                 bmap: Optional[str] = None, hash_algorithm: str = DEFAULT_HASH,
+                 unmount: bool = True, progress_interval: float = 1.0, job_id=None,
+                 enumerator: Optional["DeviceEnumerator"] = None):
+        if not devices:
+            raise ValueError("no devices given")
+        if hash_algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"hash must be one of {', '.join(HASH_ALGORITHMS)}")
+        if checksum:
+            parse_checksum(checksum)
+        self.image = image
+        self.devices = list(devices)
+        self.id = job_id
+        self.verify = verify
+        self.checksum = checksum
+        self.bmap = bmap
+        self.hash_algorithm = hash_algorithm
+        self.unmount = unmount and sys.platform.startswith("linux")
+        self.progress_interval = progress_interval
+        self.enumerator = enumerator or DeviceEnumerator()
+        # Validates the block size, queue depth and I/O mode up front.
+        self.writer = BlockWriter(block_size, queue_depth, io_mode, skip_zeros=sparse)
+        self.state = "pending"
+        self.results: Dict[str, Dict] = {}
+
+    def cancel(self):
+        self.writer.cancel()
+
+    def run(self, on_event=None) -> Dict[str, Dict]:
+        emit = on_event or (lambda event: None)
+        writer = self.writer
+        self.state = "running"
+        results = {device: {"ok": False, "bytes": 0, "verified": None, "error": None}
+                   for device in self.devices}
+        self.results = results
+        emit({"type": "started", "job": self.id, "image": self.image, "devices": self.devices})
+        try:
+            targets = self.devices
+            if self.unmount:
+                for device, mount, error in unmount_targets(self.devices, self.enumerator):
+                    if error:
+                        results[device]["error"] = f"cannot unmount {device}: {error}"
+                    if mount:
+                        emit({"type": "unmounted", "job": self.id, "device": device,
+                              "mountpoint": mount["mountpoint"],
+                              "error": str(error) if error else None})
+                targets = [device for device in self.devices if not results[device]["error"]]
+            if targets:
+                self._write(targets, emit)
+        except (FlashError, OSError, ValueError) as e:
+            for result in results.values():
+                if not result["ok"] and not result["error"]:
+                    result["error"] = str(e)
+        self.state = "cancelled" if writer.cancelled else "done"
+        emit({"type": "finished", "job": self.id, "state": self.state, "results": results})
+        return results
+
+    def _write(self, targets: List[str], emit):
+        writer = self.writer
+        results = self.results
+        block_map = BlockMap.load(self.bmap) if self.bmap else None
+        total = None if is_url(self.image) or detect_compression(self.image) \
+            else os.path.getsize(self.image)
+        meters = {device: EventMeter(emit, self.id, total, self.progress_interval, device)
+                  for device in targets}
+        digest = ImageDigest(self.hash_algorithm, writer.block_size)
+        written = writer.write_many(self.image, targets, meters, digest, block_map,
+                                    checksum=self.checksum)
+        flashed = []
+        for device in targets:
+            if isinstance(written[device], Exception):
+                results[device]["error"] = str(written[device])
+                continue
+            meters[device].finish()
+            results[device].update(ok=True, bytes=written[device])
+            flashed.append(device)
+        if not self.verify:
+            return
+
+        def check(device):
+            emit({"type": "verifying", "job": self.id, "device": device})
+            try:
+                actual = chunk_digests(device, digest.size, self.hash_algorithm,
+                                       writer.block_size, writer.queue_depth, uncached=True,
+                                       block_map=writer.written_map)
+            except OSError as e:
+                return f"error verifying {device}: {e}"
+            bad = digest.mismatches(actual)
+            if bad:
+                return f"verification failed: {len(bad)} chunks differ, " \
+                       f"the first at byte {bad[0] * writer.block_size}"
+            return None
+
+        with ThreadPoolExecutor(max_workers=max(len(flashed), 1)) as pool:
+            for device, error in zip(flashed, pool.map(check, flashed)):
+                results[device].update(verified=error is None, ok=error is None, error=error)
+
+
+DEFAULT_SOCKET = "/run/flask.sock"
+
+
+class FlashServer:
+    """Run flash jobs for clients on a Unix socket.
+
+    Clients send one JSON request per line and read JSON lines back:
+
+        {"op": "submit", "image": ..., "devices": [...], ...options}
+            -> {"ok": true, "job": ID}
+        {"op": "status"}             -> {"ok": true, "jobs": [...]}
+        {"op": "cancel", "job": ID}  -> {"ok": true}
+        {"op": "subscribe", "job": ID}
+            -> {"ok": true}, then FlashJob events (plus "queued") as they
+               happen; without a job, events of every job until the
+               client disconnects.
+
+    Submit options are block_size, queue_depth, io_mode, verify,
+    checksum, sparse, bmap and hash. Jobs start in the order they were
+    submitted as soon as their devices are free and every USB host
+    controller involved has fewer than per_controller writers; devices
+    not on USB, such as file-backed targets, count as one controller.
+    A job needing more writers on one controller than the limit runs
+    once that controller is idle.
+    """
+
+    SUBSCRIBER_BACKLOG = 1024
+
+    def __init__(self, socket_path: str, per_controller: int = 1,
+                 enumerator: Optional["DeviceEnumerator"] = None):
+        if per_controller < 1:
+            raise ValueError("per_controller must be at least 1")
+        self.socket_path = socket_path
+        self.per_controller = per_controller
+        self.enumerator = enumerator or DeviceEnumerator()
+        self.jobs: Dict[int, FlashJob] = {}
+        self.pending: List[FlashJob] = []
+        self.busy: Dict[str, int] = {}  # controller -> writers running
+        self.subscribers: List[Tuple[Optional[int], asyncio.Queue]] = []
+        self._ids = itertools.count(1)
+        self._loop = None
+
+    def controller(self, device: str) -> str:
+        path = os.path.realpath(device)
+        if path.startswith("/dev/"):
+            return self.enumerator.controller(os.path.basename(path))
+        return ""
+
+    def submit(self, request: Dict) -> FlashJob:
+        options = {"block_size": parse_size, "queue_depth": int, "io_mode": str,
+                   "verify": bool, "checksum": str, "sparse": bool, "bmap": str,
+                   "hash": str}
+        unknown = set(request) - set(options) - {"op", "image", "devices"}
+        if unknown:
+            raise ValueError(f"unknown option {sorted(unknown)[0]!r}")
+        image, devices = request.get("image"), request.get("devices")
+        if not isinstance(image, str) or not isinstance(devices, list) or \
+                not all(isinstance(device, str) for device in devices):
+            raise ValueError("submit needs an image and a list of devices")
+        kwargs = {}
+        for name, convert in options.items():
+            if request.get(name) is not None:
+                value = request[name]
+                kwargs["hash_algorithm" if name == "hash" else name] = \
+                    parse_size(str(value)) if convert is parse_size else convert(value)
+        job = FlashJob(image, devices, job_id=next(self._ids), enumerator=self.enumerator,
+                       **kwargs)
+        job.state = "queued"
+        self.jobs[job.id] = job
+        self.pending.append(job)
+        self._publish({"type": "queued", "job": job.id, "image": image, "devices": devices})
+        self._schedule()
+        return job
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None or job.state not in ("queued", "running"):
+            return False
+        if job in self.pending:
+            self.pending.remove(job)
+            job.state = "cancelled"
+            self._publish({"type": "finished", "job": job.id, "state": "cancelled",
+                           "results": {}})
+        else:
+            job.cancel()
+        return True
+
+    def _controllers(self, job: FlashJob) -> Dict[str, int]:
+        needed: Dict[str, int] = {}
+        for device in job.devices:
+            controller = self.controller(device)
+            needed[controller] = needed.get(controller, 0) + 1
+        return needed
+
+    def _schedule(self):
+        running = {device for job in self.jobs.values() if job.state == "running"
+                   for device in job.devices}
+        for job in list(self.pending):
+            if running & set(job.devices):
+                continue
+            needed = self._controllers(job)
+            if any(self.busy.get(controller, 0) and
+                   self.busy[controller] + count > self.per_controller
+                   for controller, count in needed.items()):
+                continue
+            self.pending.remove(job)
+            running |= set(job.devices)
+            for controller, count in needed.items():
+                self.busy[controller] = self.busy.get(controller, 0) + count
+            job.state = "running"
+            threading.Thread(target=self._run, args=(job, needed), daemon=True).start()
+
+    def _run(self, job: FlashJob, needed: Dict[str, int]):
+        def emit(event):
+            self._loop.call_soon_threadsafe(self._publish, event)
+        try:
+            job.run(emit)
+        finally:
+            self._loop.call_soon_threadsafe(self._finished, needed)
+
+    def _finished(self, needed: Dict[str, int]):
+        for controller, count in needed.items():
+            self.busy[controller] -= count
+        self._schedule()
+
+    def _publish(self, event: Dict):
+        for job_id, events in self.subscribers:
+            if job_id is not None and event.get("job") != job_id:
+                continue
+            if events.full():
+                if event["type"] == "progress":
+                    continue  # a slow subscriber misses progress, never outcomes
+                events.get_nowait()
+            events.put_nowait(event)
+
+    def status(self) -> List[Dict]:
+        return [{"job": job.id, "state": job.state, "image": job.image,
+                 "devices": job.devices, "results": job.results}
+                for job in self.jobs.values()]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def send(message):
+            writer.write(json.dumps(message).encode() + b"\n")
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    op = request.get("op")
+                    if op == "submit":
+                        send({"ok": True, "job": self.submit(request).id})
+                    elif op == "status":
+                        send({"ok": True, "jobs": self.status()})
+                    elif op == "cancel":
+                        send({"ok": self.cancel(request.get("job"))})
+                    elif op == "subscribe":
+                        await self._subscribe(request.get("job"), send, writer)
+                        if request.get("job") is not None:
+                            break
+                    else:
+                        send({"ok": False, "error": f"unknown op {op!r}"})
+                except (ValueError, TypeError, AttributeError) as e:
+                    send({"ok": False, "error": str(e)})
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _subscribe(self, job_id: Optional[int], send, writer: asyncio.StreamWriter):
+        job = self.jobs.get(job_id) if job_id is not None else None
+        if job_id is not None and job is None:
+            raise ValueError(f"no job {job_id}")
+        send({"ok": True})
+        if job and job.state in ("done", "cancelled"):
+            send({"type": "finished", "job": job.id, "state": job.state, "results": job.results})
+            return
+        events: asyncio.Queue = asyncio.Queue(self.SUBSCRIBER_BACKLOG)
+        entry = (job_id, events)
+        self.subscribers.append(entry)
+        try:
+            while True:
+                event = await events.get()
+                send(event)
+                await writer.drain()
+                if job_id is not None and event["type"] == "finished":
+                    return
+        finally:
+            self.subscribers.remove(entry)
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle, self.socket_path)
+        os.chmod(self.socket_path, 0o660)
+        async with server:
+            await server.serve_forever()
 
 
 class Flask:
@@ -17,6 +2463,32 @@ class Flask:
         self.version = "1.0.0"
         self.supported_platforms = ["linux", "darwin"]
         self.platform = sys.platform
+        self.block_size = DEFAULT_BLOCK_SIZE
+        self.queue_depth = DEFAULT_QUEUE_DEPTH
+        self.io_mode = "direct"
+        self.sync_window = DEFAULT_SYNC_WINDOW
+        self.progress_format = "text"
+        self.progress_interval = 1.0
+        # Where JSON progress goes; main() keeps it on stdout and sends
+        # every other message to stderr.
+        self.progress_file: Optional[TextIO] = None
+        self.hash_algorithm = DEFAULT_HASH
+        self.sparse = False
+        self.discard = False
+        self.bmap_path = None
+        self.delta = False
+        self.hash_sidecar = False
+        self.checksum = None  # expected "ALGORITHM:HEX" digest of the image file
+        self.cache = DigestCache()
+        self.devices = DeviceEnumerator()
+        # Settings stored by "flask bench --auto-tune"; used unless the
+        # block size, queue depth or I/O mode are given on the command line.
+        self.tuning = TuningStore()
+        self.use_tuning = True
+        # (path, ImageDigest, BlockMap or None) of the last image written,
+        # so verification does not need to read the image a second time
+        # and knows which ranges a sparse write skipped.
+        self.last_written = None
         self.check_platform()
 
     def check_platform(self):
@@ -31,24 +2503,9 @@ class Flask:
         devices = []
 
         if self.platform == "linux":
-            # Get list of block devices
-            lsblk_output = subprocess.check_output(
-                ["lsblk", "-d", "-o", "NAME,SIZE,MODEL,MOUNTPOINT", "--json"],
-                text=True
-            )
-            import json
-            blockdevices = json.loads(lsblk_output)["blockdevices"]
-            
-            for device in blockdevices:
-                # Only include removable devices (typically USB drives)
-                if self.is_removable_linux(device["name"]):
-                    devices.append({
-                        "device": f"/dev/{device['name']}",
-                        "size": device.get("size", "Unknown"),
-                        "model": device.get("model", "Unknown"),
-                        "mountpoint": device.get("mountpoint", "")
-                    })
-                    
+            # Only include removable devices (typically USB drives)
+            devices = self.devices.devices(removable_only=True)
+
         elif self.platform == "darwin":
             
             diskutil_output = subprocess.check_output(
@@ -82,11 +2539,7 @@ class Flask:
 
     def is_removable_linux(self, device_name: str) -> bool:
         """Check if a Linux device is removable."""
-        try:
-            with open(f"/sys/block/{device_name}/removable", "r") as f:
-                return f.read().strip() == "1"
-        except FileNotFoundError:
-            return False
+        return self.devices.is_removable(device_name)
 
     def print_devices(self, devices: List[Dict[str, str]]):
         """Print available devices in a formatted way."""
@@ -101,22 +2554,42 @@ class Flask:
         for i, device in enumerate(devices, 1):
             print(f"{device['device']:<15} {device['size']:<10} {device['model']:<20} {device['mountpoint']:<15}")
 
+    def watch_devices(self):
+        """Keep the device list on screen, refreshing it as drives come and go."""
+        watcher = DeviceWatcher() if self.platform == "linux" else None
+        previous = None
+        try:
+            while True:
+                devices = self.list_available_devices()
+                names = {device["device"] for device in devices}
+                if previous is not None and sys.stdout.isatty():
+                    print("\033[H\033[2J", end="")
+                self.print_devices(devices)
+                if previous is not None:
+                    for name in sorted(names - previous):
+                        print(f"+ {name} connected")
+                    for name in sorted(previous - names):
+                        print(f"- {name} removed")
+                previous = names
+                print(f"\nWatching for devices ({watcher.method if watcher else 'poll'}); "
+                      "press Ctrl+C to stop.", flush=True)
+                if watcher:
+                    while not watcher.wait():
+                        pass
+                else:
+                    time.sleep(1)
+        except KeyboardInterrupt:
+            print()
+        finally:
+            if watcher:
+                watcher.close()
+
     def unmount_device(self, device: str) -> bool:
         """Unmount a device before flashing."""
+        if self.platform == "linux":
+            return self.unmount_devices([device])[device]
         try:
-            if self.platform == "linux":
-                
-                mounted = subprocess.run(
-                    ["findmnt", device], 
-                    capture_output=True
-                ).returncode == 0
-                
-                if mounted:
-                    subprocess.check_call(["umount", device])
-                    print(f"Unmounted {device}")
-                return True
-                
-            elif self.platform == "darwin":
+            if self.platform == "darwin":
                 # On macOS, use diskutil
                 subprocess.check_call(["diskutil", "unmountDisk", device])
                 print(f"Unmounted {device}")
@@ -128,77 +2601,445 @@ class Flask:
             
         return True
 
+    def unmount_devices(self, devices: List[str]) -> Dict[str, bool]:
+        """Unmount every partition of every device, all at once.
+
+        mountinfo is read a single time and matched against the disks and
+        their partitions by device number; the mounts are then unmounted
+        concurrently with umount2(), innermost first. Prints one line per
+        mount and returns whether each device is now free.
+        """
+        if self.platform != "linux":
+            return {device: self.unmount_device(device) for device in devices}
+        try:
+            report = unmount_targets(devices, self.devices)
+        except OSError as e:
+            print(f"Error reading {self.devices.mountinfo}: {e}")
+            return {device: False for device in devices}
+        results = {device: True for device in devices}
+        for device, mount, error in report:
+            if mount is None:
+                print(f"Error: cannot open {device}: {error.strerror}")
+            elif error:
+                print(f"Failed to unmount {mount['mountpoint']} ({mount['source']}): "
+                      f"{error.strerror}")
+            else:
+                print(f"Unmounted {mount['mountpoint']} ({mount['source']})")
+            if error:
+                results[device] = False
+        return results
+
     def flash_iso(self, iso_path: str, device: str) -> bool:
         """Flash ISO image to USB device."""
-        if not os.path.exists(iso_path):
+        return self.flash_devices(iso_path, [device]).get(device, False)
+
+    def flash_devices(self, iso_path: str, devices: List[str]) -> Dict[str, bool]:
+        """Flash one ISO image to several USB devices at once.
+
+        The image is read a single time; each device gets its own writer,
+        progress line and result. An HTTP(S) URL is downloaded while it is
+        written, and checked against self.checksum at the end.
+        """
+        url = is_url(iso_path)
+        if not url and not os.path.exists(iso_path):
             print(f"Error: ISO file '{iso_path}' does not exist.")
+            return {}
+        if self.checksum and not url:
+            # A local file can be checked before anything is written.
+            try:
+                algorithm, expected = parse_checksum(self.checksum)
+                actual = file_checksum(iso_path, algorithm)
+            except (OSError, ValueError) as e:
+                print(f"Error checking {iso_path}: {e}")
+                return {}
+            if actual != expected:
+                print(f"Error: {algorithm} of {iso_path} is {actual}, expected {expected}.")
+                return {}
+
+        results = {device: False for device in devices}
+        unmounted = self.unmount_devices(devices)
+        targets = [device for device in devices if unmounted[device]]
+        if not targets:
+            return results
+
+        print(f"Flashing {iso_path} to {', '.join(targets)}...")
+        print("This may take several minutes. Please do not remove the USB drive.")
+
+        compression = detect_compression(iso_path)
+        if compression:
+            print(f"Decompressing {compression} image on the fly.")
+        elif url:
+            print("Streaming the image from the network; compressed images are "
+                  "decompressed on the fly.")
+        iso_size = None if compression or url else os.path.getsize(iso_path)
+        label = len(targets) > 1
+        json_lines = self.progress_format == "json"
+        progress = {device: ProgressMeter(iso_size, self.progress_interval,
+                                          label=device if label or json_lines else "",
+                                          json_lines=json_lines, file=self.progress_file)
+                    for device in targets}
+        tuned = self.tuned_settings(targets) if self.use_tuning else None
+        if tuned:
+            self.block_size = tuned["block_size"]
+            self.queue_depth = tuned["queue_depth"]
+            self.io_mode = tuned["io_mode"]
+            print(f"Using tuned settings: {format_size(self.block_size)} blocks, "
+                  f"queue depth {self.queue_depth}, {self.io_mode} I/O.")
+        try:
+            block_map = BlockMap.load(self.bmap_path) if self.bmap_path else None
+            writer = BlockWriter(self.block_size, self.queue_depth, self.io_mode,
+                                 skip_zeros=self.sparse, discard=self.discard, delta=self.delta,
+                                 sync_window=self.sync_window)
+            known = self.cached_digest(iso_path)
+            digest = known or ImageDigest(self.hash_algorithm, self.block_size)
+            with ProgressTicker(list(progress.values()), self.progress_interval) \
+                    if json_lines else nullcontext():
+                written = writer.write_many(iso_path, targets, progress,
+                                            None if known else digest, block_map, known,
+                                            self.checksum)
+        except (FlashError, OSError, ValueError) as e:
+            print(f"\nError flashing ISO: {e}")
+            return results
+        self.last_written = (iso_path, digest, writer.written_map)
+        if not known and not all(isinstance(result, Exception) for result in written.values()):
+            self.store_digest(iso_path, digest)
+
+        for device in targets:
+            meter = progress[device]
+            if isinstance(written[device], Exception):
+                print(f"\nError flashing {device}: {written[device]}")
+                continue
+            meter.finish()
+            print(f"Flashing {device} completed successfully! "
+                  f"({format_size(meter.done)} at {meter.rate / 1e6:.1f} MB/s, "
+                  f"{writer.modes[device]} I/O)")
+            if self.delta:
+                print(f"Delta: {format_size(writer.unchanged.get(device, 0))} unchanged, "
+                      f"{format_size(written[device])} rewritten.")
+            elif writer.written_map:
+                kept = not self.discard or device in writer.undiscarded
+                print(f"Sparse write: {format_size(written[device])} written, "
+                      f"{format_size(writer.image_size - written[device])} skipped"
+                      + (" (left as they were on the device)." if kept else " and discarded."))
+                if self.discard and kept:
+                    print(f"Warning: {device} does not support discarding; "
+                          f"the skipped ranges keep their old contents.")
+            results[device] = True
+        if any(results.values()):
+            print("Done. You can safely remove the USB drive.")
+        return results
+
+    def device_key(self, device: str) -> str:
+        """Identify a drive by model and serial number across reconnects.
+
+        Files, and devices sysfs knows nothing about, are keyed by path.
+        """
+        path = os.path.realpath(device)
+        name = os.path.basename(path)
+        if self.platform == "linux" and path.startswith("/dev/") and self.devices.dev_number(name):
+            model = self.devices.model(name)
+            serial = self.devices.serial(name)
+            if serial or model != "Unknown":
+                return f"{model} {serial}".strip()
+        return "path:" + path
+
+    def tuned_settings(self, devices: List[str]) -> Optional[Dict]:
+        """Stored settings shared by all the devices, if any.
+
+        Devices written together share one buffer ring, so tuned settings
+        only apply when every device was tuned to the same ones.
+        """
+        if not self.tuning or not devices:
+            return None
+        settings = [self.tuning.get(self.device_key(device)) for device in devices]
+        if settings[0] and all(entry == settings[0] for entry in settings):
+            return settings[0]
+        return None
+
+    def bench(self, target: str, size: int, block_sizes: List[int], queue_depths: List[int],
+              io_modes: List[str], output: str, auto_tune: bool = False) -> bool:
+        """Benchmark writing to target and optionally remember the best settings."""
+        try:
+            if os.path.exists(target) and stat.S_ISBLK(os.stat(target).st_mode):
+                if not self.unmount_device(target):
+                    return False
+                fd = os.open(target, os.O_RDONLY)
+                try:
+                    capacity = os.lseek(fd, 0, os.SEEK_END)
+                finally:
+                    os.close(fd)
+                if size > capacity:
+                    print(f"Error: {target} only holds {format_size(capacity)}.")
+                    return False
+            elif not os.path.exists(target):
+                open(target, "wb").close()
+        except OSError as e:
+            print(f"Error opening {target}: {e}")
             return False
-            
+
+        runs = len(block_sizes) * len(queue_depths) * len(io_modes)
+        print(f"Benchmarking {target}: {runs} runs of {format_size(size)} each. "
+              f"Its contents will be overwritten.")
+        print(f"{'Block':>9} {'Depth':>5} {'Mode':<9} {'MB/s':>8} {'p50 ms':>8} "
+              f"{'p99 ms':>8} {'max ms':>8}")
+
+        def report(result):
+            label = (f"{format_size(result['block_size']):>9} {result['queue_depth']:>5} "
+                     f"{result['io_mode']:<9}")
+            if "error" in result:
+                print(f"{label} error: {result['error']}", flush=True)
+                return
+            latency = result["latency_ms"]
+            print(f"{label} {result['mb_per_s']:>8.1f} {latency['p50']:>8.2f} "
+                  f"{latency['p99']:>8.2f} {latency['max']:>8.2f}", flush=True)
+
+        benchmark = WriteBenchmark(target, size, block_sizes, queue_depths, io_modes)
+        try:
+            summary = benchmark.run(report)
+        except OSError as e:
+            print(f"Error preparing benchmark data: {e}")
+            return False
+        summary["device_key"] = self.device_key(target)
+        best = summary["best"]
+        try:
+            with open(output, "w") as f:
+                json.dump(summary, f, indent=2)
+                f.write("\n")
+            print(f"Wrote {output}")
+        except OSError as e:
+            print(f"Error writing {output}: {e}")
+        if not best:
+            print("No run completed.")
+            return False
+        print(f"Best: {format_size(best['block_size'])} blocks, queue depth "
+              f"{best['queue_depth']}, {best['actual_mode']} I/O at {best['mb_per_s']:.1f} MB/s.")
+        if auto_tune:
+            settings = {"block_size": best["block_size"], "queue_depth": best["queue_depth"],
+                        "io_mode": best["actual_mode"], "mb_per_s": best["mb_per_s"],
+                        "time": summary["time"]}
+            if self.tuning.put(summary["device_key"], settings):
+                print(f"Saved as the default for {summary['device_key']}.")
+            else:
+                print(f"Warning: could not write {self.tuning.path}")
+        return True
+
+    def probe(self, device: str, image: Optional[str] = None, seconds: float = PROBE_SECONDS,
+              min_speed: float = DEFAULT_MIN_SPEED, as_json: bool = False) -> bool:
+        """Check a drive's speed and capacity; returns False if it should not be used."""
         if not self.unmount_device(device):
             return False
-            
-        print(f"Flashing {iso_path} to {device}...")
-        print("This may take several minutes. Please do not remove the USB drive.")
-        
+        image_size = None
+        if image and not is_url(image) and not detect_compression(image):
+            image_size = os.path.getsize(image)
+        if not as_json:
+            print(f"Probing {device} for about {seconds:.0f} s; the probed blocks are overwritten.")
         try:
-            if self.platform == "linux" or self.platform == "darwin":
-                # Use dd command for both Linux and macOS
-                process = subprocess.Popen(
-                    ["dd", f"if={iso_path}", f"of={device}", "bs=4M", "status=progress"],
-                    stderr=subprocess.PIPE,
-                    universal_newlines=True
-                )
-                
-                # Show progress
-                for line in process.stderr:
-                    print(line, end="")
-                    
-                process.wait()
-                if process.returncode != 0:
-                    print("Error: Failed to flash ISO.")
-                    return False
-                    
-                print("\nFlashing completed successfully!")
-                print("Syncing file system...")
-                subprocess.check_call(["sync"])
-                print("Done. You can safely remove the USB drive.")
-                return True
-                
-        except subprocess.CalledProcessError as e:
-            print(f"Error flashing ISO: {e}")
+            result = DeviceProbe(device, seconds).run()
+        except OSError as e:
+            print(f"Error probing {device}: {e}")
             return False
-            
-        return False
+
+        problems = []
+        if result["bad_blocks"]:
+            problems.append(f"data written to the drive did not read back; it appears to hold "
+                            f"only {format_size(result['usable_capacity'])} of the "
+                            f"{format_size(result['capacity'])} it claims")
+        if result["sequential_write"] / 1e6 < min_speed:
+            problems.append(f"sequential writes run at {result['sequential_write'] / 1e6:.1f} MB/s, "
+                            f"below the {min_speed:g} MB/s minimum")
+        if image_size is not None:
+            result["image_size"] = image_size
+            result["predicted_seconds"] = image_size / result["sequential_write"]
+            if image_size > result["usable_capacity"]:
+                problems.append(f"{image} does not fit")
+        result["problems"] = problems
+        result["ok"] = not problems
+        if as_json:
+            print(json.dumps(result, indent=2))
+            return not problems
+
+        random_rate = result["sample_size"] / 1e6
+        print(f"Capacity:         {format_size(result['capacity'])} claimed")
+        print(f"Sequential write: {result['sequential_write'] / 1e6:.1f} MB/s "
+              f"({format_size(result['sequential_bytes'])}, {result['io_mode']} I/O)")
+        print(f"Sequential read:  {result['sequential_read'] / 1e6:.1f} MB/s")
+        print(f"Random write:     {result['random_write_iops']:.0f} IOPS, "
+              f"{result['random_write_iops'] * random_rate:.1f} MB/s "
+              f"({format_size(result['sample_size'])} blocks)")
+        print(f"Random read:      {result['random_read_iops']:.0f} IOPS, "
+              f"{result['random_read_iops'] * random_rate:.1f} MB/s")
+        if result["bad_blocks"]:
+            first = result["bad_blocks"][0]
+            where = (f"holds the data written at byte {first['found']}" if first["found"] >= 0
+                     else "did not hold what was written")
+            print(f"Capacity check:   FAILED, {len(result['bad_blocks'])} blocks; "
+                  f"byte {first['offset']} {where}")
+        else:
+            print(f"Capacity check:   OK ({result['random_writes']} blocks across the drive)")
+        if "predicted_seconds" in result:
+            minutes, secs = divmod(round(result["predicted_seconds"]), 60)
+            print(f"Predicted time to flash {os.path.basename(image)} "
+                  f"({format_size(image_size)}): {minutes} min {secs} s")
+        for problem in problems:
+            print(f"Rejected: {problem}.")
+        if not problems:
+            print(f"{device} looks fine.")
+        return not problems
+
+    def hash_mode(self, sparse: Optional[bool] = None) -> str:
+        """Describe how chunks are hashed with the current sparse options."""
+        modes = []
+        if self.bmap_path:
+            with open(self.bmap_path, "rb") as f:
+                modes.append("bmap:" + hashlib.sha256(f.read()).hexdigest())
+        if self.sparse if sparse is None else sparse:
+            modes.append("zeros")
+        return "+".join(modes) or "full"
+
+    def cached_digest(self, iso_path: str, sparse: Optional[bool] = None) -> Optional[ImageDigest]:
+        """Chunk digests of the image from the cache or its sidecar file."""
+        if is_url(iso_path):
+            return None
+        mode = self.hash_mode(sparse)
+        digest = None
+        if self.cache:
+            digest = self.cache.get(iso_path, self.hash_algorithm, self.block_size, mode)
+        if digest is None and self.hash_sidecar:
+            digest = ImageDigest.load(iso_path + SIDECAR_SUFFIX, file_stamp(iso_path),
+                                      mode, self.hash_algorithm, self.block_size)
+            if digest and self.cache:
+                self.cache.put(iso_path, digest, mode)
+        if digest:
+            print("Using cached chunk digests of the image.")
+        return digest
+
+    def store_digest(self, iso_path: str, digest: ImageDigest, sparse: Optional[bool] = None):
+        """Remember the image's chunk digests for later runs."""
+        if is_url(iso_path):
+            return
+        mode = self.hash_mode(sparse)
+        if self.cache:
+            self.cache.put(iso_path, digest, mode)
+        if self.hash_sidecar:
+            try:
+                digest.save(iso_path + SIDECAR_SUFFIX, file_stamp(iso_path), mode)
+            except OSError as e:
+                print(f"Warning: could not write {iso_path + SIDECAR_SUFFIX}: {e}")
+
+    def expected_digest(self, iso_path: str) -> Tuple[ImageDigest, Optional[BlockMap]]:
+        """Chunk digests of the image and the block map they cover.
+
+        Reuses the digests taken while flashing or cached by an earlier run.
+        """
+        streamed = is_url(iso_path) or detect_compression(iso_path) is not None
+        if self.last_written and self.last_written[0] == iso_path:
+            _, digest, block_map = self.last_written
+            if ((streamed or digest.size == os.path.getsize(iso_path))
+                    and digest.algorithm == self.hash_algorithm):
+                return digest, block_map
+        if is_url(iso_path):
+            raise FlashError("an image downloaded from a URL can only be verified "
+                             "right after flashing it")
+        block_map = BlockMap.load(self.bmap_path) if self.bmap_path else None
+        digest = self.cached_digest(iso_path, sparse=False)
+        if digest is None:
+            digest = chunk_digests(iso_path, None, self.hash_algorithm,
+                                   self.block_size, self.queue_depth, block_map=block_map,
+                                   decompress=True)
+            self.store_digest(iso_path, digest, sparse=False)
+        self.last_written = (iso_path, digest, block_map)
+        return digest, block_map
 
     def verify_iso(self, iso_path: str, device: str) -> bool:
-        """Verify the flashed ISO by comparing checksums."""
-        print("Verifying flashed USB drive (this may take a while)...")
-        
+        """Verify the flashed ISO by comparing checksums chunk by chunk.
+
+        Exactly the image's size is read back from the device, bypassing
+        the page cache. The chunk digests recorded while flashing are reused
+        when available, and the first differing byte is reported on failure.
+        After a sparse write only the ranges that were written are compared,
+        and the success message and digest say so: the skipped ranges hold
+        whatever the device held before.
+        """
+        print(f"Verifying {device} (this may take a while)...")
+
         try:
-            # Calculate ISO checksum
-            iso_md5 = subprocess.check_output(
-                ["md5sum", iso_path], 
-                text=True
-            ).split()[0]
-            
-            # Calculate flashed device checksum (limited to ISO size)
-            iso_size = os.path.getsize(iso_path)
-            device_md5 = subprocess.check_output(
-                f"dd if={device} bs=4M count={iso_size // (4 * 1024 * 1024) + 1} | md5sum",
-                shell=True,
-                text=True
-            ).split()[0]
-            
-            if iso_md5 == device_md5:
-                print("Verification successful! The USB drive matches the ISO image.")
+            expected, block_map = self.expected_digest(iso_path)
+            actual = chunk_digests(device, expected.size, self.hash_algorithm,
+                                   expected.chunk_size, self.queue_depth, uncached=True,
+                                   block_map=block_map)
+
+            bad = expected.mismatches(actual)
+            if not bad:
+                if block_map:
+                    print(f"Verification successful! The written ranges of {device} "
+                          f"({format_size(block_map.mapped_size)} of {format_size(expected.size)}) "
+                          f"match the ISO image; skipped ranges were not checked.")
+                    print(f"{self.hash_algorithm} of the written ranges: {actual.digest}")
+                else:
+                    print(f"Verification successful! {device} matches the ISO image.")
+                    print(f"{self.hash_algorithm}: {actual.digest}")
                 return True
-            else:
-                print("Verification failed. The USB drive does not match the ISO image.")
-                return False
-                
-        except subprocess.CalledProcessError as e:
+
+            chunk = expected.chunk_size
+            ranges = block_map.within(bad[0] * chunk, (bad[0] + 1) * chunk) if block_map else None
+            offset = None
+            if not is_url(iso_path) and not detect_compression(iso_path):
+                offset = first_difference(iso_path, device, bad[0] * chunk, chunk, ranges)
+            if offset is None:
+                # Compressed images cannot be re-read at an offset cheaply;
+                # report the start of the first bad chunk instead.
+                offset = bad[0] * chunk
+            print(f"Verification failed. {device} does not match the ISO image.")
+            print(f"First difference at byte {offset} ({format_size(offset)}); "
+                  f"{len(bad)} of {len(expected.chunks)} chunks of {format_size(chunk)} differ.")
+            return False
+
+        except (FlashError, OSError) as e:
+            print(f"Error verifying {device}: {e}")
+            return False
+
+    def verify_devices(self, iso_path: str, devices: List[str]) -> Dict[str, bool]:
+        """Verify several devices concurrently against one image."""
+        try:
+            self.expected_digest(iso_path)
+        except (FlashError, OSError) as e:
             print(f"Error during verification: {e}")
+            return {device: False for device in devices}
+        with ThreadPoolExecutor(max_workers=len(devices)) as pool:
+            outcomes = pool.map(lambda device: self.verify_iso(iso_path, device), devices)
+            return dict(zip(devices, outcomes))
+
+    def make_bmap(self, image_path: str, bmap_path: Optional[str] = None) -> bool:
+        """Generate a bmap file listing the data ranges of an image."""
+        bmap_path = bmap_path or image_path + ".bmap"
+        try:
+            block_map = BlockMap.scan(image_path, self.block_size)
+            block_map.save(bmap_path)
+        except (FlashError, OSError) as e:
+            print(f"Error creating bmap: {e}")
             return False
+        print(f"Wrote {bmap_path}: {format_size(block_map.mapped_size)} of "
+              f"{format_size(block_map.image_size)} mapped in {len(block_map.ranges)} ranges.")
+        return True
+
+    def flash_command(self, args: argparse.Namespace):
+        """Flash, and optionally verify, the devices given on the command line."""
+        # Check if user is root (required for raw device writes)
+        if os.geteuid() != 0:
+            print("Error: Flask requires root privileges to flash drives.")
+            print("Please run with sudo or as root.")
+            return
+
+        results = self.flash_devices(args.iso, args.device)
+        flashed = [device for device, ok in results.items() if ok]
+
+        if flashed and args.verify:
+            results.update(self.verify_devices(args.iso, flashed))
+
+        if len(args.device) > 1:
+            print("\nSummary:")
+            for device in args.device:
+                print(f"  {device:<15} {'OK' if results.get(device) else 'FAILED'}")
 
     def main(self):
         """Main entry point for the application."""
@@ -209,38 +3050,197 @@ class Flask:
         
         parser.add_argument("-l", "--list", action="store_true", 
                             help="List available USB devices")
+        parser.add_argument("-w", "--watch", action="store_true",
+                            help="Show available USB devices and update the list as they change")
         parser.add_argument("-i", "--iso", type=str, 
-                            help="Path to the ISO image file")
-        parser.add_argument("-d", "--device", type=str, 
-                            help="Device to flash (e.g., /dev/sdb)")
+                            help="Path or HTTP(S) URL of the ISO image (.xz, .gz, .bz2 "
+                                 "and .zst images are decompressed on the fly)")
+        parser.add_argument("--checksum", type=str, metavar="[ALGORITHM:]HEX",
+                            help="Expected digest of the image file, e.g. sha256:abc...; "
+                                 "a URL is checked as it downloads")
+        parser.add_argument("-d", "--device", type=str, nargs="+",
+                            help="Device(s) to flash (e.g., /dev/sdb /dev/sdc)")
         parser.add_argument("-v", "--verify", action="store_true", 
                             help="Verify the flashed USB drive after writing")
+        parser.add_argument("--block-size", type=parse_size,
+                            help="Write block size, e.g. 1M or 4M (default: 4M, or as tuned)")
+        parser.add_argument("--queue-depth", type=int,
+                            help="Number of buffers in flight; with several devices this is "
+                                 "how far the fastest may run ahead of the slowest "
+                                 "(default: 4, or as tuned)")
+        parser.add_argument("--io-mode", choices=IO_MODES,
+                            help="Write through O_DIRECT, O_DSYNC or the page cache "
+                                 "(default: direct, or as tuned)")
+        parser.add_argument("--no-direct", action="store_true",
+                            help="Use O_DSYNC writes instead of O_DIRECT (same as --io-mode dsync)")
+        parser.add_argument("--sync-window", type=parse_size, default=DEFAULT_SYNC_WINDOW,
+                            help="With buffered I/O, flush to the device every this many "
+                                 "bytes (default: 32M)")
+        parser.add_argument("--progress", choices=["text", "json"], default="text",
+                            help="Progress format; json prints one object per line with "
+                                 "bytes, rate and ETA")
+        parser.add_argument("--progress-interval", type=float, default=1.0,
+                            help="Seconds between progress updates (default: 1)")
+        parser.add_argument("--hash", choices=HASH_ALGORITHMS, default=DEFAULT_HASH,
+                            help="Hash used for verification (default: blake2b)")
+        parser.add_argument("--sparse", action="store_true",
+                            help="Skip writing all-zero blocks")
+        parser.add_argument("--bmap", type=str, metavar="FILE",
+                            help="Only write the ranges listed in this bmap file "
+                                 "(or the output path for --make-bmap)")
+        parser.add_argument("--discard", action="store_true",
+                            help="Discard skipped ranges on the device (with --sparse or --bmap)")
+        parser.add_argument("--delta", action="store_true",
+                            help="Read the device first and only rewrite chunks that differ")
+        parser.add_argument("--hash-sidecar", action="store_true",
+                            help=f"Cache the image's chunk digests in IMAGE{SIDECAR_SUFFIX} "
+                                 "so later runs skip hashing it")
+        parser.add_argument("--no-cache", action="store_true",
+                            help="Do not use the image digest cache in $XDG_CACHE_HOME/flask")
+        parser.add_argument("--cache-size", type=parse_size, default=DEFAULT_CACHE_BYTES,
+                            help="Evict least recently used digests beyond this size (default: 64M)")
+        parser.add_argument("--make-bmap", type=str, metavar="IMAGE",
+                            help="Generate IMAGE.bmap listing the data ranges of IMAGE")
         parser.add_argument("--version", action="store_true", 
                             help="Show Flask version")
-        
+
+        commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+        bench = commands.add_parser(
+            "bench", help="Measure write throughput to a target (overwrites it)",
+            description="Write random data to TARGET with every combination of the "
+                        "given settings and report MB/s and write latency percentiles.")
+        bench.add_argument("target", help="Scratch file, loop device or drive to overwrite")
+        bench.add_argument("--size", type=parse_size, default=64 * 1024 * 1024,
+                           help="Bytes written per run (default: 64M)")
+        bench.add_argument("--block-sizes", type=lambda text: [parse_size(t) for t in text.split(",")],
+                           default=[256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2],
+                           help="Comma-separated block sizes (default: 256K,1M,4M,16M)")
+        bench.add_argument("--queue-depths", type=lambda text: [int(t) for t in text.split(",")],
+                           default=[2, 4, 8],
+                           help="Comma-separated queue depths (default: 2,4,8)")
+        bench.add_argument("--io-modes", type=lambda text: text.split(","),
+                           default=["direct", "buffered"],
+                           help=f"Comma-separated I/O modes out of {','.join(IO_MODES)} "
+                                "(default: direct,buffered)")
+        bench.add_argument("-o", "--output", default="flask-bench.json",
+                           help="JSON report path (default: flask-bench.json)")
+        bench.add_argument("--auto-tune", action="store_true",
+                           help="Remember the fastest settings for this drive and use "
+                                "them when flashing it")
+
+        serve = commands.add_parser(
+            "serve", help="Run a job server for flashing stations on a Unix socket",
+            description="Queue flash jobs submitted as JSON lines on a Unix socket and "
+                        "stream their progress to subscribers.")
+        serve.add_argument("--socket", default=DEFAULT_SOCKET,
+                           help=f"Socket path (default: {DEFAULT_SOCKET})")
+        serve.add_argument("--per-controller", type=int, default=1,
+                           help="Concurrent writers allowed per USB host controller (default: 1)")
+
+        probe = commands.add_parser(
+            "probe", help="Check a drive's speed and real capacity before flashing it",
+            description="Write and read back a few seconds' worth of sequential and "
+                        "scattered blocks to measure the drive and catch fake capacity. "
+                        "The probed blocks are overwritten. Exits with status 1 if the "
+                        "drive is rejected.")
+        probe.add_argument("-d", "--device", required=True,
+                           help="Drive (or file-backed target) to probe")
+        probe.add_argument("-i", "--iso", help="Image to predict the flash time for")
+        probe.add_argument("--seconds", type=float, default=PROBE_SECONDS,
+                           help=f"Rough duration of the probe (default: {PROBE_SECONDS:g})")
+        probe.add_argument("--min-speed", type=float, default=DEFAULT_MIN_SPEED,
+                           help="Reject drives writing slower than this many MB/s "
+                                f"(default: {DEFAULT_MIN_SPEED:g})")
+        probe.add_argument("--json", action="store_true", help="Print the results as JSON")
+
         args = parser.parse_args()
+        io_mode = args.io_mode or ("dsync" if args.no_direct else None)
+        self.use_tuning = args.block_size is None and args.queue_depth is None and io_mode is None
+        self.block_size = args.block_size or DEFAULT_BLOCK_SIZE
+        self.queue_depth = args.queue_depth or DEFAULT_QUEUE_DEPTH
+        self.io_mode = io_mode or "direct"
+        self.sync_window = args.sync_window
+        self.progress_format = args.progress
+        self.progress_interval = args.progress_interval
+        self.hash_algorithm = args.hash
+        self.sparse = args.sparse
+        self.discard = args.discard
+        self.delta = args.delta
+        self.hash_sidecar = args.hash_sidecar
+        if args.checksum:
+            try:
+                parse_checksum(args.checksum)
+            except ValueError as e:
+                parser.error(str(e))
+            self.checksum = args.checksum
+        self.cache = None if args.no_cache else DigestCache(max_bytes=args.cache_size)
         
         if args.version:
             print(f"Flask USB ISO Flashing Utility v{self.version}")
             return
             
+        if args.make_bmap:
+            self.make_bmap(args.make_bmap, args.bmap)
+            return
+
+        if args.command == "bench":
+            unknown = [mode for mode in args.io_modes if mode not in IO_MODES]
+            if unknown:
+                bench.error(f"unknown I/O mode {unknown[0]!r}")
+            if os.path.exists(args.target) and stat.S_ISBLK(os.stat(args.target).st_mode) \
+                    and os.geteuid() != 0:
+                print("Error: Flask requires root privileges to benchmark drives.")
+                print("Please run with sudo or as root.")
+                return
+            self.bench(args.target, args.size, args.block_sizes, args.queue_depths,
+                       args.io_modes, args.output, args.auto_tune)
+            return
+
+        if args.command == "serve":
+            if os.geteuid() != 0:
+                print("Warning: not running as root; only writable targets can be flashed.")
+            try:
+                server = FlashServer(args.socket, args.per_controller, self.devices)
+            except ValueError as e:
+                serve.error(str(e))
+            print(f"Listening on {args.socket}")
+            try:
+                asyncio.run(server.serve())
+            except KeyboardInterrupt:
+                print()
+            except OSError as e:
+                print(f"Error: cannot listen on {args.socket}: {e}")
+                sys.exit(1)
+            return
+
+        if args.command == "probe":
+            if os.path.exists(args.device) and stat.S_ISBLK(os.stat(args.device).st_mode) \
+                    and os.geteuid() != 0:
+                print("Error: Flask requires root privileges to probe drives.")
+                print("Please run with sudo or as root.")
+                sys.exit(1)
+            if not self.probe(args.device, args.iso, args.seconds, args.min_speed, args.json):
+                sys.exit(1)
+            return
+
+        if args.bmap:
+            self.bmap_path = args.bmap
+
+        if args.watch:
+            self.watch_devices()
+            return
+
         if args.list:
             devices = self.list_available_devices()
             self.print_devices(devices)
             return
             
         if args.iso and args.device:
-            # Check if user is root (required for dd operations)
-            if os.geteuid() != 0:
-                print("Error: Flask requires root privileges to flash drives.")
-                print("Please run with sudo or as root.")
-                return
-                
-            success = self.flash_iso(args.iso, args.device)
-            
-            if success and args.verify:
-                self.verify_iso(args.iso, args.device)
-                
+            if self.progress_format == "json":
+                # Keep stdout to JSON progress objects only.
+                self.progress_file = sys.stdout
+            with redirect_stdout(sys.stderr) if self.progress_file else nullcontext():
+                self.flash_command(args)
             return
             
         # If no valid arguments provided, show help
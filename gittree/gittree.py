@@ -4,11 +4,18 @@ GitTree - A terminal animation showing a growing tree
 """
 
 import os
+import pty
 import random
 import time
 import curses
 import signal
+import struct
+import fcntl
+import termios
+import argparse
+import subprocess
 import sys
+from array import array
 from math import sin, cos, pi
 
 # Terminal colors
@@ -28,14 +35,84 @@ class TreeParts:
     LEAF = ["*", "o", "•", "✿", "✽", "❀", "✸", "♠", "✧"]
     FRUIT = ["@", "O", "●", "○", "◍", "◉"]
 
+class CellGrid:
+    """One kind of tree part, at most one per screen cell.
+
+    cells holds the part at every position (0 for none, else its index
+    in parts plus one) and occupied lists the filled positions densely,
+    with slots pointing back into it. Placing, removing, and picking a
+    random part are O(1), a part placed on an occupied cell replaces it,
+    and memory is fixed by the screen size however long the tree grows.
+    Iterating yields (y, x, char) like the lists this replaced.
+    """
+    def __init__(self, height, width, parts):
+        self.height = max(0, height)
+        self.width = max(0, width)
+        self.parts = parts
+        self.codes = {char: code for code, char in enumerate(parts, 1)}
+        self.cells = array("B", bytes(self.height * self.width))
+        self.slots = array("i", [-1]) * (self.height * self.width)
+        self.occupied = array("i")
+
+    def __len__(self):
+        return len(self.occupied)
+
+    def __iter__(self):
+        for index in self.occupied:
+            y, x = divmod(index, self.width)
+            yield y, x, self.parts[self.cells[index] - 1]
+
+    def place(self, y, x, char):
+        """Put char at (y, x); returns False if that is off the grid."""
+        if not (0 <= y < self.height and 0 <= x < self.width):
+            return False
+        index = y * self.width + x
+        if not self.cells[index]:
+            self.slots[index] = len(self.occupied)
+            self.occupied.append(index)
+        self.cells[index] = self.codes[char]
+        return True
+
+    def remove(self, y, x):
+        index = y * self.width + x
+        slot = self.slots[index]
+        if slot < 0:
+            return
+        # Move the last occupied position into the freed slot
+        last = self.occupied.pop()
+        if last != index:
+            self.occupied[slot] = last
+            self.slots[last] = slot
+        self.slots[index] = -1
+        self.cells[index] = 0
+
+    def choice(self):
+        """A random (y, x, char); the grid must not be empty."""
+        index = self.occupied[random.randrange(len(self.occupied))]
+        y, x = divmod(index, self.width)
+        return y, x, self.parts[self.cells[index] - 1]
+
+    def clear(self):
+        for index in self.occupied:
+            self.cells[index] = 0
+            self.slots[index] = -1
+        del self.occupied[:]
+
+    def resize(self, height, width):
+        """Change size, keeping the parts that still fit."""
+        kept = list(self)
+        self.__init__(height, width, self.parts)
+        for y, x, char in kept:
+            self.place(y, x, char)
+
 class Tree:
     def __init__(self, max_height=20, max_width=60):
         self.max_height = max_height
         self.max_width = max_width
-        self.trunk = []
-        self.branches = []
-        self.leaves = []
-        self.fruits = []
+        self.trunk = []  # one piece per row, at most max_height
+        self.branches = CellGrid(max_height, max_width, TreeParts.BRANCH)
+        self.leaves = CellGrid(max_height, max_width, TreeParts.LEAF)
+        self.fruits = CellGrid(max_height, max_width, TreeParts.FRUIT)
         self.growth_stage = 0
         self.max_growth = 100
         self.season = 0  # 0: spring, 1: summer, 2: fall, 3: winter
@@ -76,49 +153,142 @@ class Tree:
                     branch_y = y - random.randint(0, 1)
                     branch_x = x + (i * direction)
                     
-                    # Don't branch outside screen
-                    if 0 <= branch_x < self.max_width:
-                        self.branches.append((branch_y, branch_x, random.choice(TreeParts.BRANCH)))
+                    # Parts outside the screen are not placed
+                    self.branches.place(branch_y, branch_x, random.choice(TreeParts.BRANCH))
         
         # Add leaves
         if self.growth_stage > 20 and self.season != 3:  # No leaves in winter
             if random.random() < 0.3:
                 if len(self.branches) > 0:
                     # Add leaves near branches
-                    branch = random.choice(self.branches)
-                    y, x, _ = branch
+                    y, x, _ = self.branches.choice()
                     
                     leaf_y = y + random.randint(-1, 1)
                     leaf_x = x + random.randint(-1, 1)
                     
-                    # Don't place leaves outside screen
-                    if 0 <= leaf_y < self.max_height and 0 <= leaf_x < self.max_width:
-                        leaf_char = random.choice(TreeParts.LEAF)
-                        self.leaves.append((leaf_y, leaf_x, leaf_char))
+                    self.leaves.place(leaf_y, leaf_x, random.choice(TreeParts.LEAF))
         
         # Add fruits in summer
         if self.season == 1 and self.growth_stage > 50:
             if random.random() < 0.05:
                 if len(self.branches) > 0:
-                    branch = random.choice(self.branches)
-                    y, x, _ = branch
+                    y, x, _ = self.branches.choice()
                     
                     fruit_y = y + random.randint(-1, 1)
                     fruit_x = x + random.randint(-1, 1)
                     
-                    if 0 <= fruit_y < self.max_height and 0 <= fruit_x < self.max_width:
-                        fruit_char = random.choice(TreeParts.FRUIT)
-                        self.fruits.append((fruit_y, fruit_x, fruit_char))
+                    self.fruits.place(fruit_y, fruit_x, random.choice(TreeParts.FRUIT))
         
         # Fall season - randomly remove leaves
         if self.season == 2 and len(self.leaves) > 0:
             if random.random() < 0.1:
-                self.leaves.pop(random.randint(0, len(self.leaves) - 1))
+                y, x, _ = self.leaves.choice()
+                self.leaves.remove(y, x)
         
         # Winter - clear leaves and fruits
         if self.season == 3:
-            self.leaves = []
-            self.fruits = []
+            self.leaves.clear()
+            self.fruits.clear()
+
+    def resize(self, max_height, max_width):
+        """Fit the tree to a new screen size, dropping what no longer fits."""
+        self.max_height = max_height
+        self.max_width = max_width
+        self.trunk = [(y, x, c) for y, x, c in self.trunk if y < max_height and x < max_width]
+        for grid in (self.branches, self.leaves, self.fruits):
+            grid.resize(max_height, max_width)
+
+class FrameBuffer:
+    """Off-screen copy of the terminal, one (char, attr) cell per position.
+
+    Frames are drawn into it with the same getmaxyx/addstr calls as a
+    curses window. flush() then hands curses only the cells that differ
+    from the last frame and sends them with one doupdate(), so a mostly
+    still picture costs a few bytes a frame instead of a full repaint.
+    """
+    BLANK = (" ", 0)
+
+    def __init__(self, height, width):
+        self.resize(height, width)
+
+    def resize(self, height, width):
+        """Start over at a new size; the terminal is assumed blank."""
+        self.height, self.width = height, width
+        self.cells = [self.BLANK] * (height * width)
+        self.shown = list(self.cells)
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def erase(self):
+        self.cells = [self.BLANK] * (self.height * self.width)
+
+    def addstr(self, y, x, text, attr=0):
+        if not 0 <= y < self.height:
+            return
+        row = y * self.width
+        for i, char in enumerate(text, x):
+            if 0 <= i < self.width:
+                self.cells[row + i] = (char, attr)
+
+    def flush(self, stdscr):
+        """Write the changed cells to the terminal; returns how many there were."""
+        changed = 0
+        for index, (cell, old) in enumerate(zip(self.cells, self.shown)):
+            if cell != old:
+                y, x = divmod(index, self.width)
+                try:
+                    stdscr.addstr(y, x, cell[0], cell[1])
+                except curses.error:
+                    pass  # Ignore errors
+                changed += 1
+        self.shown = self.cells
+        stdscr.noutrefresh()
+        curses.doupdate()
+        return changed
+
+class OutputMeter:
+    """Bytes sent to the terminal per frame.
+
+    Read from the process's wchar counter in /proc/self/io where there
+    is one; otherwise estimated from the cells written, at BYTES_PER_CELL
+    for the character, cursor movement and attribute changes.
+    """
+    BYTES_PER_CELL = 8
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.cells = 0
+        self.source = "wchar" if self.wchar() is not None else "estimate"
+        self._start = None
+
+    @staticmethod
+    def wchar():
+        try:
+            with open("/proc/self/io") as io:
+                for line in io:
+                    if line.startswith("wchar:"):
+                        return int(line.split()[1])
+        except OSError:
+            return None
+        return None
+
+    def start(self):
+        self._start = self.wchar() if self.source == "wchar" else None
+
+    def stop(self, cells):
+        self.frames += 1
+        self.cells += cells
+        if self._start is not None:
+            self.bytes += self.wchar() - self._start
+        else:
+            self.bytes += cells * self.BYTES_PER_CELL
+
+    def summary(self):
+        frames = max(1, self.frames)
+        return (f"{self.frames} frames, {self.bytes / frames:.0f} bytes/frame ({self.source}), "
+                f"{self.cells / frames:.0f} cells/frame")
 
 def init_colors():
     curses.start_color()
@@ -131,8 +301,12 @@ def init_colors():
     curses.init_pair(Colors.CYAN, curses.COLOR_CYAN, -1)
     curses.init_pair(Colors.MAGENTA, curses.COLOR_MAGENTA, -1)
 
-def get_color_for_season(element_type, season):
-    """Return appropriate color based on season and element type"""
+def get_color_for_season(element_type, season, position=0):
+    """Return appropriate color based on season and element type
+
+    Mixed colors are picked by position rather than at random, so an
+    element keeps its color from frame to frame.
+    """
     if element_type == "trunk" or element_type == "branch":
         return Colors.BROWN
     
@@ -142,12 +316,12 @@ def get_color_for_season(element_type, season):
         elif season == 1:  # Summer
             return Colors.GREEN
         elif season == 2:  # Fall
-            return random.choice([Colors.YELLOW, Colors.RED])
+            return [Colors.YELLOW, Colors.RED][position % 2]
         else:  # Winter
             return Colors.CYAN
     
     if element_type == "fruit":
-        return random.choice([Colors.RED, Colors.YELLOW, Colors.MAGENTA])
+        return [Colors.RED, Colors.YELLOW, Colors.MAGENTA][position % 3]
     
     return Colors.GREEN
 
@@ -179,11 +353,11 @@ def draw_tree(stdscr, tree):
     
     # Draw leaves
     for y, x, char in tree.leaves:
-        safe_addstr(stdscr, y, x, char, curses.color_pair(get_color_for_season("leaf", tree.season)))
+        safe_addstr(stdscr, y, x, char, curses.color_pair(get_color_for_season("leaf", tree.season, y + x)))
     
     # Draw fruits
     for y, x, char in tree.fruits:
-        safe_addstr(stdscr, y, x, char, curses.color_pair(get_color_for_season("fruit", tree.season)))
+        safe_addstr(stdscr, y, x, char, curses.color_pair(get_color_for_season("fruit", tree.season, y + x)))
 
 def draw_ground(stdscr, width, height):
     """Draw ground at the bottom of the screen"""
@@ -202,26 +376,25 @@ def draw_info(stdscr, height, width):
 def handle_resize(stdscr, tree):
     """Handle terminal resize"""
     height, width = stdscr.getmaxyx()
-    tree.max_height = height - 4  # Leave more room for info and ground
-    tree.max_width = width - 1  # Stay away from the right edge
-    
-    # Adjust tree if terminal gets smaller
-    tree.trunk = [(y, x, c) for y, x, c in tree.trunk if y < height - 4 and x < width - 1]
-    tree.branches = [(y, x, c) for y, x, c in tree.branches if y < height - 4 and x < width - 1]
-    tree.leaves = [(y, x, c) for y, x, c in tree.leaves if y < height - 4 and x < width - 1]
-    tree.fruits = [(y, x, c) for y, x, c in tree.fruits if y < height - 4 and x < width - 1]
+    # Leave more room for info and ground, and stay away from the right edge
+    tree.resize(height - 4, width - 1)
 
-def main(stdscr):
+def main(stdscr, options):
     # Setup
     curses.curs_set(0)  # Hide cursor
-    stdscr.timeout(100)  # Set getch timeout
+    stdscr.timeout(int(options.delay * 1000))  # Set getch timeout
     stdscr.clear()
     
     init_colors()
+    if options.seed is not None:
+        random.seed(options.seed)
     
     # Get terminal size
     height, width = stdscr.getmaxyx()
     tree = Tree(height - 4, width - 1)  # Leave room for info and stay away from edges
+    # Frames are drawn off screen and only the differences reach the terminal
+    frame = FrameBuffer(height, width)
+    meter = OutputMeter()
     
     # Handle signals
     def handle_sigint(sig, frame):
@@ -231,13 +404,14 @@ def main(stdscr):
     signal.signal(signal.SIGINT, handle_sigint)
     
     # Main loop
-    while True:
+    while options.frames is None or meter.frames < options.frames:
         # Check for terminal resize
         new_height, new_width = stdscr.getmaxyx()
         if new_height != height or new_width != width:
             height, width = new_height, new_width
             handle_resize(stdscr, tree)
             stdscr.clear()
+            frame.resize(height, width)
         
         # Handle input
         try:
@@ -254,29 +428,99 @@ def main(stdscr):
             for _ in range(5):
                 tree.grow()
         
-        try:
-            stdscr.clear()
-        except curses.error:
-            pass  # Ignore clear errors
-        
         # Grow the tree
         tree.grow()
         
         # Draw everything
-        draw_ground(stdscr, width, height)
-        draw_tree(stdscr, tree)
-        draw_info(stdscr, height, width)
+        if options.full_redraw:
+            target = stdscr
+            try:
+                stdscr.clear()
+            except curses.error:
+                pass  # Ignore clear errors
+        else:
+            target = frame
+            frame.erase()
+        draw_ground(target, width, height)
+        draw_tree(target, tree)
+        draw_info(target, height, width)
         
+        meter.start()
         try:
-            stdscr.refresh()
+            if options.full_redraw:
+                stdscr.refresh()
+                cells = height * width
+            else:
+                cells = frame.flush(stdscr)
         except curses.error:
-            pass  # Ignore refresh errors
+            cells = 0  # Ignore refresh errors
+        meter.stop(cells)
             
-        time.sleep(0.1)
+        time.sleep(options.delay)
+    return meter
+
+def bench(options):
+    """Count the bytes each way of drawing sends to a terminal.
+
+    Runs this script twice in a pseudo-terminal of the given size, once
+    repainting every frame and once drawing only the differences, for
+    the same frames from the same seed, and reads everything it writes.
+    """
+    columns, lines = (int(n) for n in options.size.lower().split("x"))
+    results = {}
+    for mode, extra in (("full redraw", ["--full-redraw"]), ("diff", [])):
+        master, slave = pty.openpty()
+        fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", lines, columns, 0, 0))
+        command = [sys.executable, os.path.abspath(__file__), "--frames", str(options.bench),
+                   "--delay", "0", "--seed", str(options.seed or 1)] + extra
+        child = subprocess.Popen(command, stdin=slave, stdout=slave, stderr=slave,
+                                 env=dict(os.environ, TERM=os.environ.get("TERM", "xterm-256color")),
+                                 start_new_session=True)
+        os.close(slave)
+        total = 0
+        while True:
+            try:
+                data = os.read(master, 65536)
+            except OSError:
+                break  # EIO once the child has exited
+            if not data:
+                break
+            total += len(data)
+        os.close(master)
+        child.wait()
+        results[mode] = total / options.bench
+        print(f"{mode:12} {results[mode]:10.0f} bytes/frame")
+    if results["diff"]:
+        print(f"{columns}x{lines}, {options.bench} frames: "
+              f"{results['full redraw'] / results['diff']:.1f}x fewer bytes with diff rendering")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="GitTree - A terminal animation showing a growing tree")
+    parser.add_argument("--delay", type=float, default=0.1,
+                        help="seconds between frames (default: 0.1)")
+    parser.add_argument("--frames", type=int, default=None,
+                        help="stop after this many frames")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed, to grow the same tree again")
+    parser.add_argument("--full-redraw", action="store_true",
+                        help="clear and repaint the whole screen every frame")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the bytes sent to the terminal per frame on exit")
+    parser.add_argument("--bench", type=int, metavar="FRAMES", default=None,
+                        help="compare bytes per frame of full and diff rendering over FRAMES frames")
+    parser.add_argument("--size", default="300x80",
+                        help="terminal size for --bench, COLUMNSxLINES (default: 300x80)")
+    return parser.parse_args()
 
 if __name__ == "__main__":
+    options = parse_args()
+    if options.bench:
+        bench(options)
+        sys.exit(0)
     try:
-        curses.wrapper(main)
+        meter = curses.wrapper(main, options)
+        if options.stats:
+            print(meter.summary())
     except KeyboardInterrupt:
         print("Exiting GitTree...")
         sys.exit(0)
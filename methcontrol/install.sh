@@ -3,13 +3,15 @@
 # Create package directory
 mkdir -p /usr/local/share/meth-packages/methcontrol
 
-# Copy Python script to package directory
-cp methcontrol.py /usr/local/share/meth-packages/methcontrol/
+# Copy Python scripts to package directory
+cp methcontrol.py methcontrol_gui.py methcontrol_ctl.py /usr/local/share/meth-packages/methcontrol/
 
-# Make it executable
+# Make them executable
 chmod +x /usr/local/share/meth-packages/methcontrol/methcontrol.py
+chmod +x /usr/local/share/meth-packages/methcontrol/methcontrol_ctl.py
 
 # Create symlink in PATH
 ln -sf /usr/local/share/meth-packages/methcontrol/methcontrol.py /usr/local/bin/methcontrol
+ln -sf /usr/local/share/meth-packages/methcontrol/methcontrol_ctl.py /usr/local/bin/methcontrol-ctl
 
 echo "Package MethControl installed successfully"
@@ -2,255 +2,1752 @@
 """
 NOX - Volume Control Application
 A simple Kivy-based volume control application for desktop systems.
+"methcontrol get|set|up|down|mute" answers from the command line without
+loading Kivy; the window (methcontrol_gui) is imported only when opened.
 """
 
 import os
+import re
+import sys
+import json
+import shutil
+import signal
+import socket
+import struct
+import contextlib
+import importlib
+import argparse
+import tempfile
 import subprocess
+import socketserver
 import platform
-from kivy.app import App
-from kivy.uix.boxlayout import BoxLayout
-from kivy.uix.slider import Slider
-from kivy.uix.label import Label
-from kivy.uix.button import Button
-from kivy.core.window import Window
-from kivy.uix.image import Image
-from kivy.clock import Clock
+import threading
+import time
+import select
+import ctypes
+import ctypes.util
+
+class MixerBackend:
+    """A connection to the system mixer used by VolumeControl.
+
+    Backends keep whatever session they need open between calls, so
+    reading or setting the volume does not start a process each time.
+    This base class is also the backend for unsupported systems: it
+    reports 50% and refuses every change.
+    """
+
+    name = "none"
+    # Whether set_volume() honours fractions of a percent; fades use them.
+    fine_volume = False
+    # Whether every call starts a process; fades step such backends less often.
+    forks = False
+
+    def get_volume(self):
+        """Current volume (0-100)."""
+        return 50
+
+    def set_volume(self, value):
+        """Set the volume (0-100); returns whether it worked."""
+        return False
+
+    def is_muted(self):
+        return False
+
+    def set_muted(self, muted):
+        return False
+
+    def toggle_mute(self):
+        return self.set_muted(not self.is_muted())
+
+    def channels(self):
+        """Separately controllable outputs and streams, for backends that have them.
+
+        Each is a dict with "kind", "index", "label", "volume" and "muted".
+        """
+        return []
+
+    def set_channel_volume(self, kind, index, value):
+        return False
+
+    def toggle_channel_mute(self, kind, index):
+        return False
+
+    def change_fds(self):
+        """File descriptors that become readable when the mixer changes.
+
+        An empty list means the backend has no change events and must be
+        polled.
+        """
+        return []
+
+    def handle_change(self):
+        """Consume the pending change events once a change fd is readable."""
+
+    def close(self):
+        pass
+
+
+class FakeBackend(MixerBackend):
+    """In-memory mixer for tests and for machines without a sound card."""
+
+    name = "fake"
+
+    def __init__(self, volume=50, muted=False):
+        self.volume = volume
+        self.muted = muted
+        self.calls = 0  # mixer operations performed, for tests
+        self.lock = threading.Lock()
+        self._events = None  # pipe signalled on every change once watched
+
+    def _changed(self):
+        if self._events:
+            os.write(self._events[1], b"x")
+
+    def change_fds(self):
+        if self._events is None:
+            self._events = os.pipe()
+            os.set_blocking(self._events[0], False)
+        return [self._events[0]]
+
+    def handle_change(self):
+        try:
+            while os.read(self._events[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self._events:
+            for fd in self._events:
+                os.close(fd)
+            self._events = None
+
+    def get_volume(self):
+        with self.lock:
+            self.calls += 1
+            return self.volume
+
+    def set_volume(self, value):
+        with self.lock:
+            self.calls += 1
+            self.volume = max(0, min(100, int(value)))
+        self._changed()
+        return True
+
+    def is_muted(self):
+        with self.lock:
+            self.calls += 1
+            return self.muted
+
+    def set_muted(self, muted):
+        with self.lock:
+            self.calls += 1
+            self.muted = bool(muted)
+        self._changed()
+        return True
+
+
+class AlsaBackend(MixerBackend):
+    """One open ALSA mixer session through libasound, via ctypes.
+
+    The mixer is opened once; afterwards a read just processes pending
+    mixer events and returns the cached value, and a write is a single
+    library call, so neither forks. Percentages map linearly onto the
+    control's raw range, like amixer does by default. Raises OSError if
+    libasound or the control is missing. streams, a backend such as
+    PactlBackend, supplies channels() for per-sink and per-application
+    sliders; the master volume never goes through it.
+    """
+
+    name = "alsa"
+    fine_volume = True
+    FRONT_LEFT = 0  # SND_MIXER_SCHN_FRONT_LEFT
+
+    def __init__(self, card="default", control="Master", streams=None):
+        self.streams = streams
+        path = ctypes.util.find_library("asound")
+        if not path:
+            raise OSError("libasound is not installed")
+        self.lib = lib = ctypes.CDLL(path)
+        handle, long_p, int_p = ctypes.c_void_p, ctypes.POINTER(ctypes.c_long), ctypes.POINTER(ctypes.c_int)
+        lib.snd_mixer_find_selem.restype = handle
+        lib.snd_mixer_find_selem.argtypes = [handle, handle]
+        lib.snd_mixer_selem_get_playback_volume_range.argtypes = [handle, long_p, long_p]
+        lib.snd_mixer_selem_get_playback_volume.argtypes = [handle, ctypes.c_int, long_p]
+        lib.snd_mixer_selem_set_playback_volume_all.argtypes = [handle, ctypes.c_long]
+        lib.snd_mixer_selem_has_playback_switch.argtypes = [handle]
+        lib.snd_mixer_selem_get_playback_switch.argtypes = [handle, ctypes.c_int, int_p]
+        lib.snd_mixer_selem_set_playback_switch_all.argtypes = [handle, ctypes.c_int]
+        self.lock = threading.Lock()
+        self.handle = ctypes.c_void_p()
+        self._check(lib.snd_mixer_open(ctypes.byref(self.handle), 0), "open mixer")
+        try:
+            self._check(lib.snd_mixer_attach(self.handle, card.encode()), f"attach {card}")
+            self._check(lib.snd_mixer_selem_register(self.handle, None, None), "register")
+            self._check(lib.snd_mixer_load(self.handle), "load mixer")
+            selem_id = ctypes.c_void_p()
+            self._check(lib.snd_mixer_selem_id_malloc(ctypes.byref(selem_id)), "allocate id")
+            lib.snd_mixer_selem_id_set_index(selem_id, 0)
+            lib.snd_mixer_selem_id_set_name(selem_id, control.encode())
+            self.elem = lib.snd_mixer_find_selem(self.handle, selem_id)
+            lib.snd_mixer_selem_id_free(selem_id)
+            if not self.elem:
+                raise OSError(f"no {control} control on {card}")
+            low, high = ctypes.c_long(), ctypes.c_long()
+            lib.snd_mixer_selem_get_playback_volume_range(self.elem, ctypes.byref(low),
+                                                          ctypes.byref(high))
+            self.low, self.high = low.value, high.value
+            self.has_switch = bool(lib.snd_mixer_selem_has_playback_switch(self.elem))
+        except OSError:
+            lib.snd_mixer_close(self.handle)
+            raise
 
-class VolumeControl:
-    """Handles system volume operations across different platforms."""
-    
     @staticmethod
-    def get_current_volume():
-        """Get the current system volume level (0-100)."""
-        system = platform.system()
-        
-        if system == "Linux":
-            try:
-                output = subprocess.check_output(["amixer", "sget", "Master"]).decode()
-                volume = int(output.split("[")[1].split("%")[0])
-                return volume
-            except Exception:
+    def _check(result, action):
+        if result < 0:
+            raise OSError(-result, f"ALSA: cannot {action}: {os.strerror(-result)}")
+
+    def get_volume(self):
+        with self.lock:
+            self.lib.snd_mixer_handle_events(self.handle)
+            value = ctypes.c_long()
+            if self.lib.snd_mixer_selem_get_playback_volume(self.elem, self.FRONT_LEFT,
+                                                            ctypes.byref(value)) < 0:
                 return 50
-        
-        elif system == "Darwin":  # macOS
+        span = self.high - self.low
+        return round((value.value - self.low) * 100 / span) if span > 0 else 0
+
+    def set_volume(self, value):
+        raw = self.low + round((self.high - self.low) * max(0, min(100, float(value))) / 100)
+        with self.lock:
+            return self.lib.snd_mixer_selem_set_playback_volume_all(self.elem, raw) >= 0
+
+    def is_muted(self):
+        if not self.has_switch:
+            return False
+        with self.lock:
+            self.lib.snd_mixer_handle_events(self.handle)
+            on = ctypes.c_int()
+            self.lib.snd_mixer_selem_get_playback_switch(self.elem, self.FRONT_LEFT,
+                                                         ctypes.byref(on))
+        return not on.value
+
+    def set_muted(self, muted):
+        if not self.has_switch:
+            return False
+        with self.lock:
+            return self.lib.snd_mixer_selem_set_playback_switch_all(self.elem,
+                                                                     0 if muted else 1) >= 0
+
+    def channels(self):
+        return self.streams.channels() if self.streams else []
+
+    def set_channel_volume(self, kind, index, value):
+        return bool(self.streams) and self.streams.set_channel_volume(kind, index, value)
+
+    def toggle_channel_mute(self, kind, index):
+        return bool(self.streams) and self.streams.toggle_channel_mute(kind, index)
+
+    def change_fds(self):
+        class PollFd(ctypes.Structure):
+            _fields_ = [("fd", ctypes.c_int), ("events", ctypes.c_short),
+                        ("revents", ctypes.c_short)]
+
+        with self.lock:
+            count = self.lib.snd_mixer_poll_descriptors_count(self.handle)
+            fds = (PollFd * max(count, 0))()
+            if count > 0:
+                count = self.lib.snd_mixer_poll_descriptors(self.handle, fds, count)
+        result = [fds[i].fd for i in range(max(count, 0))]
+        if self.streams and result:
+            # Both only ever read what is pending, so either firing can wake both.
             try:
-                output = subprocess.check_output(["osascript", "-e", "output volume of (get volume settings)"]).decode()
-                return int(output.strip())
-            except Exception:
-                return 50
-                
-        elif system == "Windows":
+                result += self.streams.change_fds()
+            except (OSError, ValueError):
+                pass  # the mixer's own events still work
+        return result
+
+    def handle_change(self):
+        with self.lock:
+            self.lib.snd_mixer_handle_events(self.handle)
+        if self.streams and self.streams.monitor is not None:
             try:
-                from ctypes import cast, POINTER
-                from comtypes import CLSCTX_ALL
-                from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
-                
-                devices = AudioUtilities.GetSpeakers()
-                interface = devices.Activate(IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
-                volume = cast(interface, POINTER(IAudioEndpointVolume))
-                
-                # Convert from logarithmic scale to percentage
-                return int(volume.GetMasterVolumeLevelScalar() * 100)
-            except Exception:
-                return 50
-        
-        return 50  # Default fallback
-    
+                self.streams.handle_change()
+            except (OSError, ValueError):
+                self.streams._monitor_failed = True
+                self.streams.close()
+
+    def close(self):
+        with self.lock:
+            if self.handle:
+                self.lib.snd_mixer_close(self.handle)
+                self.handle = None
+        if self.streams:
+            self.streams.close()
+
+
+class AmixerBackend(MixerBackend):
+    """Runs amixer for every call; used when libasound cannot be loaded."""
+
+    name = "amixer"
+    forks = True
+
+    def __init__(self):
+        if not shutil.which("amixer"):
+            raise OSError("amixer is not installed")
+        self.monitor = None
+
+    def change_fds(self):
+        """Watch the mixer with a single long-running "alsactl monitor"."""
+        if self.monitor is None:
+            try:
+                self.monitor = subprocess.Popen(["alsactl", "monitor"], stdout=subprocess.PIPE,
+                                                stderr=subprocess.DEVNULL)
+            except OSError:
+                return []
+        if self.monitor.poll() is not None:
+            return []
+        return [self.monitor.stdout.fileno()]
+
+    def handle_change(self):
+        # One event line is enough; whatever else is pending wakes us again.
+        if not self.monitor.stdout.readline():
+            self.monitor.wait()
+
+    def close(self):
+        if self.monitor:
+            self.monitor.kill()
+            self.monitor.wait()
+            self.monitor.stdout.close()
+            self.monitor = None
+
+    def get_volume(self):
+        try:
+            output = subprocess.check_output(["amixer", "sget", "Master"]).decode()
+            return int(output.split("[")[1].split("%")[0])
+        except Exception:
+            return 50
+
+    def set_volume(self, value):
+        try:
+            subprocess.call(["amixer", "-q", "sset", "Master", f"{value}%"])
+            return True
+        except Exception:
+            return False
+
+    def is_muted(self):
+        try:
+            output = subprocess.check_output(["amixer", "sget", "Master"]).decode()
+            return "[off]" in output
+        except Exception:
+            return False
+
+    def set_muted(self, muted):
+        try:
+            subprocess.call(["amixer", "-q", "sset", "Master", "mute" if muted else "unmute"])
+            return True
+        except Exception:
+            return False
+
+    def toggle_mute(self):
+        try:
+            subprocess.call(["amixer", "-q", "set", "Master", "toggle"])
+            return True
+        except Exception:
+            return False
+
+
+class OsascriptBackend(MixerBackend):
+    """macOS volume through osascript."""
+
+    name = "osascript"
+    forks = True
+
+    def get_volume(self):
+        try:
+            output = subprocess.check_output(["osascript", "-e", "output volume of (get volume settings)"]).decode()
+            return int(output.strip())
+        except Exception:
+            return 50
+
+    def set_volume(self, value):
+        try:
+            subprocess.call(["osascript", "-e", f"set volume output volume {value}"])
+            return True
+        except Exception:
+            return False
+
+    def is_muted(self):
+        try:
+            current_mute = subprocess.check_output(["osascript", "-e",
+                "output muted of (get volume settings)"]).decode().strip()
+            return current_mute != "false"
+        except Exception:
+            return False
+
+    def set_muted(self, muted):
+        try:
+            if muted:
+                subprocess.call(["osascript", "-e", "set volume with output muted"])
+            else:
+                subprocess.call(["osascript", "-e", "set volume without output muted"])
+            return True
+        except Exception:
+            return False
+
+
+class PycawBackend(MixerBackend):
+    """Windows endpoint volume through pycaw, activated once and kept."""
+
+    name = "pycaw"
+    fine_volume = True
+
+    def __init__(self):
+        from ctypes import cast, POINTER
+        from comtypes import CLSCTX_ALL
+        from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
+
+        devices = AudioUtilities.GetSpeakers()
+        interface = devices.Activate(IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
+        self.volume = cast(interface, POINTER(IAudioEndpointVolume))
+
+    def get_volume(self):
+        try:
+            # Convert from logarithmic scale to percentage
+            return int(self.volume.GetMasterVolumeLevelScalar() * 100)
+        except Exception:
+            return 50
+
+    def set_volume(self, value):
+        try:
+            # Convert percentage to logarithmic scale
+            self.volume.SetMasterVolumeLevelScalar(value / 100, None)
+            return True
+        except Exception:
+            return False
+
+    def is_muted(self):
+        try:
+            return bool(self.volume.GetMute())
+        except Exception:
+            return False
+
+    def set_muted(self, muted):
+        try:
+            self.volume.SetMute(bool(muted), None)
+            return True
+        except Exception:
+            return False
+
+
+class PulseModel:
+    """In-memory copy of a PulseAudio or PipeWire server's sinks and streams.
+
+    Loaded from pactl's JSON listings and kept current by applying the
+    lines "pactl subscribe" prints, so recorded pactl output can drive it
+    in tests.
+    """
+
+    LISTS = {"sink": "sinks", "sink-input": "sink-inputs"}
+
+    def __init__(self):
+        self.objects = {"sink": {}, "sink-input": {}}
+        self.default_sink = None
+
     @staticmethod
-    def set_volume(value):
-        """Set system volume (0-100)."""
-        system = platform.system()
-        
-        if system == "Linux":
+    def _volume(entry):
+        levels = []
+        for channel in (entry.get("volume") or {}).values():
+            percent = str(channel.get("value_percent", "")).rstrip("%")
+            if percent.isdigit():
+                levels.append(int(percent))
+            elif "value" in channel:
+                levels.append(round(channel["value"] * 100 / 65536))
+        return max(levels, default=0)
+
+    def load(self, kind, text):
+        """Replace every sink or sink-input from "pactl -f json list" output."""
+        objects = {}
+        for entry in json.loads(text or "[]"):
+            properties = entry.get("properties") or {}
+            if kind == "sink":
+                label = entry.get("description") or entry.get("name", "")
+            else:
+                label = (properties.get("application.name") or properties.get("media.name")
+                         or f"Stream {entry['index']}")
+            objects[entry["index"]] = {
+                "kind": kind,
+                "index": entry["index"],
+                "name": entry.get("name", ""),
+                "label": label,
+                "volume": self._volume(entry),
+                "muted": bool(entry.get("mute")),
+                "sink": entry.get("sink"),
+            }
+        self.objects[kind] = objects
+
+    def load_info(self, text):
+        """Take the default sink from "pactl -f json info" output."""
+        self.default_sink = json.loads(text).get("default_sink_name")
+
+    def apply_event(self, line):
+        """Apply one line of "pactl subscribe".
+
+        Removals are applied directly; for anything else returns what has
+        to be listed again: "sink", "sink-input" or "server".
+        """
+        match = re.match(r"Event '(\w+)' on ([\w-]+)(?: #(\d+))?", line.strip())
+        if not match:
+            return None
+        action, kind, index = match.groups()
+        if kind == "server":
+            return "server"
+        if kind not in self.objects:
+            return None
+        if action == "remove":
+            self.objects[kind].pop(int(index), None)
+            return None
+        return kind
+
+    def default(self):
+        """The default sink, or the first one."""
+        sinks = self.objects["sink"]
+        for sink in sinks.values():
+            if sink["name"] == self.default_sink:
+                return sink
+        return next(iter(sinks.values()), None)
+
+    def channels(self):
+        return [dict(entry) for kind in ("sink", "sink-input")
+                for _, entry in sorted(self.objects[kind].items())]
+
+
+class PactlBackend(MixerBackend):
+    """PulseAudio or PipeWire through pactl, for every sink and stream.
+
+    The state is read with one listing per object type (not one call per
+    sink or stream) into a PulseModel, first when it is needed rather
+    than on construction. Once watched, a single "pactl subscribe" keeps
+    the model current: removals cost nothing and a burst of changes costs
+    one listing of the affected type. Unwatched, reading the master
+    volume lists only the sinks. Every write still starts pactl, so on
+    Linux this is the streams helper of AlsaBackend and only the master
+    backend when libasound is missing. run, which takes pactl's
+    arguments and returns its output, can be replaced to replay recorded
+    output.
+    """
+
+    name = "pactl"
+    forks = True
+
+    def __init__(self, run=None):
+        if run is None and not shutil.which("pactl"):
+            raise OSError("pactl is not installed")
+        self.run = run or self._pactl
+        self.model = PulseModel()
+        self.lock = threading.Lock()
+        self.monitor = None
+        self._monitor_failed = False
+        self._partial = b""
+
+    @staticmethod
+    def _pactl(*args):
+        try:
+            return subprocess.run(["pactl", *args], capture_output=True, text=True,
+                                  check=True, timeout=5).stdout
+        except subprocess.SubprocessError as e:
+            raise OSError(f"pactl {' '.join(args)} failed: {e}") from None
+
+    def refresh(self, kinds=("server", "sink", "sink-input")):
+        for kind in kinds:
+            if kind == "server":
+                text = self.run("-f", "json", "info")
+                with self.lock:
+                    self.model.load_info(text)
+            else:
+                text = self.run("-f", "json", "list", PulseModel.LISTS[kind])
+                with self.lock:
+                    self.model.load(kind, text)
+
+    @property
+    def watching(self):
+        return self.monitor is not None and self.monitor.poll() is None
+
+    def _current(self, kinds=("server", "sink", "sink-input")):
+        """The model, with kinds re-read first unless subscribe is keeping it current."""
+        if not self.watching:
             try:
-                subprocess.call(["amixer", "-q", "sset", "Master", f"{value}%"])
-                return True
-            except Exception:
-                return False
-                
-        elif system == "Darwin":  # macOS
+                self.refresh(kinds)
+            except (OSError, ValueError):
+                pass
+        return self.model
+
+    def _master(self):
+        # The default sink name only needs fetching once unwatched.
+        return self._current(("sink",) if self.model.default_sink else ("server", "sink")).default()
+
+    def _command(self, *args):
+        try:
+            self.run(*args)
+            return True
+        except OSError:
+            return False
+
+    def get_volume(self):
+        sink = self._master()
+        return sink["volume"] if sink else 50
+
+    def set_volume(self, value):
+        return self.set_channel_volume("sink", None, value)
+
+    def is_muted(self):
+        sink = self._master()
+        return bool(sink and sink["muted"])
+
+    def set_muted(self, muted):
+        return self._command("set-sink-mute", "@DEFAULT_SINK@", "1" if muted else "0")
+
+    def toggle_mute(self):
+        return self._command("set-sink-mute", "@DEFAULT_SINK@", "toggle")
+
+    def channels(self):
+        model = self._current()
+        with self.lock:
+            return model.channels()
+
+    def set_channel_volume(self, kind, index, value):
+        value = max(0, min(100, int(value)))
+        target = "@DEFAULT_SINK@" if index is None else str(index)
+        command = "set-sink-volume" if kind == "sink" else "set-sink-input-volume"
+        return self._command(command, target, f"{value}%")
+
+    def toggle_channel_mute(self, kind, index):
+        command = "set-sink-mute" if kind == "sink" else "set-sink-input-mute"
+        return self._command(command, str(index), "toggle")
+
+    def change_fds(self):
+        if self._monitor_failed or self.run != self._pactl:
+            return []
+        if self.monitor is None:
             try:
-                subprocess.call(["osascript", "-e", f"set volume output volume {value}"])
-                return True
-            except Exception:
-                return False
-                
-        elif system == "Windows":
+                self.monitor = subprocess.Popen(["pactl", "subscribe"], stdout=subprocess.PIPE,
+                                                stderr=subprocess.DEVNULL)
+            except OSError:
+                self._monitor_failed = True
+                return []
+            os.set_blocking(self.monitor.stdout.fileno(), False)
             try:
-                from ctypes import cast, POINTER
-                from comtypes import CLSCTX_ALL
-                from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
-                
-                devices = AudioUtilities.GetSpeakers()
-                interface = devices.Activate(IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
-                volume = cast(interface, POINTER(IAudioEndpointVolume))
-                
-                # Convert percentage to logarithmic scale
-                volume.SetMasterVolumeLevelScalar(value / 100, None)
-                return True
-            except Exception:
-                return False
-                
-        return False  # Could not set volume
+                # Events from before the subscription started are not replayed.
+                self.refresh()
+            except (OSError, ValueError):
+                # No server, or a pactl without JSON output: stay unwatched.
+                self._monitor_failed = True
+                self.close()
+                return []
+        return [self.monitor.stdout.fileno()]
 
-    @staticmethod
-    def toggle_mute():
-        """Toggle mute state."""
-        system = platform.system()
-        
-        if system == "Linux":
+    def handle_change(self):
+        try:
+            data = os.read(self.monitor.stdout.fileno(), 65536)
+        except BlockingIOError:
+            return
+        if not data:
+            # pactl subscribe exited (the server went away); fall back to polling.
+            self._monitor_failed = True
+            self.close()
+            return
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        self.apply_events(line.decode(errors="replace") for line in lines)
+
+    def apply_events(self, lines):
+        """Apply "pactl subscribe" lines, listing each changed type once."""
+        stale = []
+        with self.lock:
+            for line in lines:
+                kind = self.model.apply_event(line)
+                if kind and kind not in stale:
+                    stale.append(kind)
+        try:
+            self.refresh(stale)
+        except (OSError, ValueError):
+            pass
+
+    def close(self):
+        if self.monitor:
+            self.monitor.kill()
+            self.monitor.wait()
+            self.monitor.stdout.close()
+            self.monitor = None
+
+
+BACKENDS = {
+    "pactl": PactlBackend,
+    "alsa": AlsaBackend,
+    "amixer": AmixerBackend,
+    "osascript": OsascriptBackend,
+    "pycaw": PycawBackend,
+    "fake": FakeBackend,
+}
+
+
+def backend_class(spec):
+    """A BACKENDS name, or "module:Class" for a MixerBackend defined elsewhere."""
+    if spec in BACKENDS:
+        return BACKENDS[spec]
+    module, _, name = spec.partition(":")
+    if not name:
+        raise ValueError(f"unknown backend {spec!r}; use one of {', '.join(BACKENDS)} or module:Class")
+    backend = getattr(importlib.import_module(module), name)
+    if not (isinstance(backend, type) and issubclass(backend, MixerBackend)):
+        raise ValueError(f"{spec} is not a MixerBackend")
+    return backend
+
+
+def default_backend():
+    """The best backend for this system.
+
+    METHCONTROL_BACKEND names one explicitly, e.g. "fake" for tests.
+    """
+    name = os.environ.get("METHCONTROL_BACKEND")
+    if name in BACKENDS:
+        return BACKENDS[name]()
+
+    system = platform.system()
+    streams = None
+    if system == "Linux":
+        try:
+            streams = PactlBackend()  # runs nothing until streams are asked for
+        except OSError:
+            pass
+    candidates = {
+        # The master volume stays on one libasound session; pactl, which
+        # forks per call, only adds the sink and application sliders.
+        "Linux": [lambda: AlsaBackend(streams=streams), lambda: streams or PactlBackend(),
+                  AmixerBackend],
+        "Darwin": [OsascriptBackend],
+        "Windows": [PycawBackend],
+    }.get(system, [])
+    for backend in candidates:
+        try:
+            return backend()
+        except Exception:
+            continue
+    return MixerBackend()
+
+
+class MixerWatcher:
+    """Report mixer changes from a background thread.
+
+    Sleeps on the backend's change events, so an idle mixer costs no
+    wakeups and external changes are seen at once; backends without
+    events are polled every poll_interval seconds instead. on_change is
+    called with (volume, muted) on the watcher thread, only when either
+    differs from what was last reported. on_channels, if given, likewise
+    gets the backend's channels() whenever they change.
+    """
+
+    def __init__(self, backend, on_change, poll_interval=1.0, on_channels=None):
+        self.backend = backend
+        self.on_change = on_change
+        self.on_channels = on_channels
+        self.poll_interval = poll_interval
+        self.last = None
+        self.last_channels = None
+        self.events_failed = False  # the backend's events broke; poll from now on
+        self._wake = os.pipe()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def polling(self):
+        return self.events_failed or not self._change_fds()
+
+    def _change_fds(self):
+        if self.events_failed:
+            return []
+        try:
+            return self.backend.change_fds()
+        except Exception:
+            self.events_failed = True
+            return []
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        os.write(self._wake[1], b"x")
+        self._thread.join()
+        for fd in self._wake:
+            os.close(fd)
+
+    def _report(self):
+        state = (self.backend.get_volume(), self.backend.is_muted())
+        if state != self.last:
+            self.last = state
+            self.on_change(*state)
+        if self.on_channels:
+            channels = self.backend.channels()
+            if channels != self.last_channels:
+                self.last_channels = channels
+                self.on_channels(channels)
+
+    def _run(self):
+        self._report()
+        while not self._stop.is_set():
+            fds = self._change_fds()
+            if not fds:
+                if self._stop.wait(self.poll_interval):
+                    break
+                self._report()
+                continue
+            ready, _, _ = select.select(fds + [self._wake[0]], [], [])
+            if self._wake[0] in ready:
+                break
             try:
-                subprocess.call(["amixer", "-q", "set", "Master", "toggle"])
-                return True
+                self.backend.handle_change()
             except Exception:
+                self.events_failed = True
+            self._report()
+
+
+class VolumeWriter:
+    """Apply volume changes off the UI thread, coalesced and rate limited.
+
+    request() only records the value and returns at once. A writer
+    thread applies the most recent value, at most max_rate times a
+    second, so dragging a slider across 60 steps costs a handful of mixer
+    writes instead of 60 and the UI thread never waits for the mixer.
+    """
+
+    def __init__(self, backend, max_rate=20.0, settle=0.5):
+        self.backend = backend
+        self.interval = 1.0 / max_rate
+        self.settle = settle
+        self.target = None  # latest requested volume
+        self.pending = None  # requested but not yet applied
+        self.applied = 0  # mixer writes made, for tests and benchmarks
+        self.last_request = 0.0
+        self._next_write = 0.0
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, value):
+        with self._cond:
+            self.target = self.pending = value
+            self.last_request = time.monotonic()
+            self._cond.notify()
+
+    def is_stale(self, volume):
+        """Whether a reported volume is an echo of older writes.
+
+        While writes are pending, and for settle seconds after the last
+        request, the mixer reports the values the writes went through;
+        showing those would snap a slider back mid-drag.
+        """
+        with self._cond:
+            if self.target is None or volume == self.target:
                 return False
-                
-        elif system == "Darwin":  # macOS
+            return (self.pending is not None
+                    or time.monotonic() - self.last_request < self.settle)
+
+    def stop(self):
+        """Apply any pending value, then stop the writer thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self.pending is None and not self._stopped:
+                    self._cond.wait()
+                if self.pending is None:
+                    return
+                delay = self._next_write - time.monotonic()
+                if delay > 0 and not self._stopped:
+                    # Newer requests arriving meanwhile replace the value.
+                    self._cond.wait(delay)
+                    continue
+                value, self.pending = self.pending, None
+            self.backend.set_volume(value)
+            self.applied += 1
+            self._next_write = time.monotonic() + self.interval
+
+
+class ChannelTarget:
+    """Lets a VolumeWriter drive one sink or stream of a backend."""
+
+    def __init__(self, backend, kind, index):
+        self.backend = backend
+        self.kind = kind
+        self.index = index
+
+    def set_volume(self, value):
+        return self.backend.set_channel_volume(self.kind, self.index, value)
+
+
+def _perceptual(start, target, fraction):
+    # Interpolate in cube-root space: roughly even loudness steps over
+    # the linear percentages mixers take, instead of most of the audible
+    # change crowding into the quiet end.
+    a, b = (start / 100) ** (1 / 3), (target / 100) ** (1 / 3)
+    return 100 * (a + (b - a) * fraction) ** 3
+
+
+CURVES = {
+    "linear": lambda start, target, fraction: start + (target - start) * fraction,
+    "perceptual": _perceptual,
+}
+
+
+class Fade:
+    """One volume ramp scheduled on a Fader."""
+
+    def __init__(self, start, target, duration, curve):
+        self.start = start
+        self.target = target
+        self.duration = duration
+        self.curve = CURVES[curve]
+        self.cancelled = False
+        self.finished = False
+        self.done = threading.Event()
+        self.lateness = []  # seconds each step ran after its scheduled time
+        self.steps = 0
+        self.writes = 0
+
+    def level(self, fraction):
+        return self.curve(self.start, self.target, min(1.0, fraction))
+
+    def cancel(self):
+        """Stop where the ramp is; the volume stays at the last step."""
+        self.cancelled = True
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """Wait until the ramp ends; returns whether it reached its target."""
+        self.done.wait(timeout)
+        return self.finished
+
+
+class Fader:
+    """Volume ramps, stepped rate times a second on one timer thread.
+
+    Every written step is one backend call. On a backend with an open
+    session (alsa, pycaw, the daemon, fake) a fade starts no processes;
+    a backend that forks per call (amixer, pactl, osascript) starts one
+    per written step, so those are stepped at most FORKING_RATE times a
+    second. Steps are scheduled against the fade's start, so a late
+    wakeup does not push the rest of the ramp back; a step that finds it
+    has fallen more than one interval behind skips ahead. Backends
+    without fine_volume get whole percentages, and a step that would
+    repeat the last one is not written. Starting a fade cancels the one
+    running.
+    """
+
+    FORKING_RATE = 10.0
+
+    def __init__(self, backend, rate=100.0):
+        self.backend = backend
+        if backend.forks:
+            rate = min(rate, self.FORKING_RATE)
+        self.interval = 1.0 / rate
+        self.current = None
+        self.level = None  # last level written by a fade
+        self.ducked_from = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def fade(self, target, duration_ms, curve="linear"):
+        """Ramp from the current volume to target over duration_ms; returns the Fade."""
+        if curve not in CURVES:
+            raise ValueError(f"unknown fade curve: {curve}")
+        target = max(0, min(100, target))
+        with self._cond:
+            previous = self.current
+            if previous and self.level is not None:
+                start = self.level  # more precise than what the mixer reports
+            else:
+                start = self.backend.get_volume()
+            fade = self.current = Fade(start, target, max(0, duration_ms) / 1000, curve)
+            self._cond.notify()
+        if previous:
+            previous.cancel()
+        return fade
+
+    def cancel(self):
+        with self._cond:
+            fade, self.current = self.current, None
+        if fade:
+            fade.cancel()
+
+    def duck(self, level=20, duration_ms=300, curve="perceptual"):
+        """Fade down to level, remembering the volume for restore().
+
+        Ducking again while ducked keeps the first remembered volume.
+        """
+        if self.ducked_from is None:
+            with self._cond:
+                running = self.current and not self.current.cancelled
+                self.ducked_from = self.current.target if running else self.backend.get_volume()
+        return self.fade(level, duration_ms, curve)
+
+    def restore(self, duration_ms=300, curve="perceptual"):
+        """Fade back to the volume before duck(); None if not ducked."""
+        if self.ducked_from is None:
+            return None
+        target, self.ducked_from = self.ducked_from, None
+        return self.fade(target, duration_ms, curve)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self.cancel()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self.current is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                fade = self.current
+            self._play(fade)
+            with self._cond:
+                if self.current is fade:
+                    self.current = None
+
+    def _play(self, fade):
+        begin = time.monotonic()
+        step = 0
+        written = None
+        while not fade.cancelled:
+            scheduled = begin + step * self.interval
+            delay = scheduled - time.monotonic()
+            if delay > 0 and fade.done.wait(delay):
+                break
+            now = time.monotonic()
+            fade.lateness.append(max(0.0, now - scheduled))
+            fade.steps += 1
+            fraction = (now - begin) / fade.duration if fade.duration else 1.0
+            level = fade.level(fraction)
+            value = level if self.backend.fine_volume else round(level)
+            if value != written:
+                self.backend.set_volume(value)
+                fade.writes += 1
+                written = value
+            self.level = level
+            if fraction >= 1.0:
+                fade.finished = True
+                fade.done.set()
+                break
+            step = max(step + 1, int((now - begin) / self.interval))
+
+
+class VolumeControl:
+    """Handles system volume operations across different platforms.
+
+    All calls go through one shared backend, created on first use;
+    use_backend() swaps it, e.g. for a FakeBackend in tests. Fades run
+    on a Fader tied to that backend.
+    """
+
+    backend = None
+    fader = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_backend(cls):
+        with cls._lock:
+            if cls.backend is None:
+                cls.backend = default_backend()
+            return cls.backend
+
+    @classmethod
+    def use_backend(cls, backend):
+        """Replace the shared backend, closing the previous one."""
+        with cls._lock:
+            previous, cls.backend = cls.backend, backend
+            fader, cls.fader = cls.fader, None
+        if fader is not None:
+            fader.stop()
+        if previous is not None and previous is not backend:
+            previous.close()
+
+    @classmethod
+    def get_fader(cls):
+        backend = cls.get_backend()
+        with cls._lock:
+            if cls.fader is None:
+                cls.fader = Fader(backend)
+            return cls.fader
+
+    @classmethod
+    def fade_to(cls, value, duration_ms, curve="linear"):
+        """Ramp to value over duration_ms ("linear" or "perceptual"); returns the Fade."""
+        return cls.get_fader().fade(value, duration_ms, curve)
+
+    @classmethod
+    def duck(cls, level=20, duration_ms=300):
+        """Fade down to level until restore()."""
+        return cls.get_fader().duck(level, duration_ms)
+
+    @classmethod
+    def restore(cls, duration_ms=300):
+        """Fade back to the volume from before duck()."""
+        return cls.get_fader().restore(duration_ms)
+
+    @classmethod
+    def cancel_fade(cls):
+        if cls.fader is not None:
+            cls.fader.cancel()
+
+    @classmethod
+    def get_current_volume(cls):
+        """Get the current system volume level (0-100)."""
+        return cls.get_backend().get_volume()
+
+    @classmethod
+    def set_volume(cls, value):
+        """Set system volume (0-100), stopping any fade."""
+        cls.cancel_fade()
+        return cls.get_backend().set_volume(value)
+
+    @classmethod
+    def is_muted(cls):
+        """Whether the output is muted."""
+        return cls.get_backend().is_muted()
+
+    @classmethod
+    def toggle_mute(cls):
+        """Toggle mute state."""
+        return cls.get_backend().toggle_mute()
+
+def socket_path():
+    """Where the daemon listens: $METHCONTROL_SOCKET, else the user's runtime directory."""
+    runtime = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.environ.get("METHCONTROL_SOCKET") or os.path.join(runtime, f"methcontrol-{os.getuid()}.sock")
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        control = self.server.control
+        for raw in self.rfile:
+            line = raw.decode(errors="replace").strip()
+            if line == "watch":
+                # Updates are sent holding the daemon's lock; a client that
+                # stops reading is dropped rather than stalling everyone.
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                                           struct.pack("ll", control.SEND_TIMEOUT, 0))
+                control.subscribe(self.wfile)
+                try:
+                    # Nothing more is read; this returns when the client hangs up.
+                    self.rfile.read()
+                finally:
+                    control.unsubscribe(self.wfile)
+                return
             try:
-                current_mute = subprocess.check_output(["osascript", "-e", 
-                    "output muted of (get volume settings)"]).decode().strip()
-                
-                if current_mute == "false":
-                    subprocess.call(["osascript", "-e", "set volume with output muted"])
+                reply = control.command(line)
+            except (ValueError, OSError) as e:
+                reply = {"error": str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class ControlDaemon:
+    """Serve one warm mixer backend on a Unix socket.
+
+    Hotkeys then cost a socket round trip instead of starting Python and
+    Kivy and opening the mixer. Each request is one line, answered with
+    one line of JSON:
+
+        get | set N | up [N] | down [N] | mute [on|off] | channels
+        channel-set KIND INDEX N | channel-mute KIND INDEX | watch
+
+    Volume requests answer {"volume": N, "muted": bool}, failures
+    {"error": "..."}. A "watch" connection gets the current state and
+    channels, then every change the daemon sees; that is how the GUI
+    attaches (see DaemonBackend). Watchers are written to only while
+    holding lock, so each gets every update once, in order, and never
+    an older state after a newer one.
+    """
+
+    SEND_TIMEOUT = 2  # seconds a watcher may leave an update unread
+
+    def __init__(self, backend, path=None):
+        self.backend = backend
+        self.path = path or socket_path()
+        self.lock = threading.Lock()
+        self.state = None
+        self.channel_list = []
+        self.subscribers = []
+        self.server = None
+        self.watcher = None
+
+    def command(self, line):
+        words = line.split()
+        if not words:
+            raise ValueError("empty request")
+        verb, args = words[0], words[1:]
+        with self.lock:
+            state = self.state or self._read_state()
+            if verb == "get":
+                return dict(state)
+            if verb in ("set", "up", "down"):
+                if verb == "set" and not args:
+                    raise ValueError("set needs a volume")
+                amount = int(args[0]) if args else 5
+                volume = {"set": amount, "up": state["volume"] + amount,
+                          "down": state["volume"] - amount}[verb]
+                volume = max(0, min(100, volume))
+                self._check(self.backend.set_volume(volume))
+                state = dict(state, volume=volume)
+            elif verb == "mute":
+                if args and args[0] not in ("on", "off"):
+                    raise ValueError("mute takes on or off")
+                if args:
+                    muted = args[0] == "on"
+                    self._check(self.backend.set_muted(muted))
                 else:
-                    subprocess.call(["osascript", "-e", "set volume without output muted"])
-                return True
-            except Exception:
-                return False
-                
-        elif system == "Windows":
+                    muted = not state["muted"]
+                    self._check(self.backend.toggle_mute())
+                state = dict(state, muted=muted)
+            elif verb == "channels":
+                return {"channels": self.backend.channels()}
+            elif verb == "channel-set" and len(args) == 3:
+                self._check(self.backend.set_channel_volume(args[0], int(args[1]), int(args[2])))
+                return {"ok": True}
+            elif verb == "channel-mute" and len(args) == 2:
+                self._check(self.backend.toggle_channel_mute(args[0], int(args[1])))
+                return {"ok": True}
+            else:
+                raise ValueError(f"unknown request: {line.strip()}")
+            self.state = state
+            self._broadcast(state)
+        return dict(state)
+
+    @staticmethod
+    def _check(applied):
+        if not applied:
+            raise OSError("the mixer did not accept the change")
+
+    def _read_state(self):
+        return {"volume": self.backend.get_volume(), "muted": self.backend.is_muted()}
+
+    def _on_change(self, volume, muted):
+        with self.lock:
+            self.state = {"volume": volume, "muted": muted}
+            self._broadcast(self.state)
+
+    def _on_channels(self, channels):
+        with self.lock:
+            self.channel_list = channels
+            self._broadcast({"channels": channels})
+
+    def subscribe(self, wfile):
+        with self.lock:
+            state = self.state or self._read_state()
+            if self._send(wfile, state) and self._send(wfile, {"channels": self.channel_list}):
+                self.subscribers.append(wfile)
+
+    def unsubscribe(self, wfile):
+        with self.lock:
+            if wfile in self.subscribers:
+                self.subscribers.remove(wfile)
+
+    def _broadcast(self, message):
+        """Send message to every watcher; the caller holds lock."""
+        for wfile in list(self.subscribers):
+            if not self._send(wfile, message):
+                self.subscribers.remove(wfile)
+
+    @staticmethod
+    def _send(wfile, message):
+        try:
+            wfile.write(json.dumps(message).encode() + b"\n")
+            return True
+        except OSError:
+            return False
+
+    def _bind(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             try:
-                from ctypes import cast, POINTER
-                from comtypes import CLSCTX_ALL
-                from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
-                
-                devices = AudioUtilities.GetSpeakers()
-                interface = devices.Activate(IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
-                volume = cast(interface, POINTER(IAudioEndpointVolume))
-                
-                current_mute = volume.GetMute()
-                volume.SetMute(not current_mute, None)
-                return True
-            except Exception:
-                return False
-                
-        return False  # Could not toggle mute
-
-class VolumeControlApp(App):
-    def build(self):
-        # Set window properties
-        self.title = 'NOX Volume Control'
-        Window.size = (400, 300)
-        Window.clearcolor = (0.1, 0.1, 0.1, 1)
-        
-        # Create main layout
-        layout = BoxLayout(orientation='vertical', padding=20, spacing=10)
-        
-        # Add title label
-        title_layout = BoxLayout(size_hint_y=0.2)
-        title_label = Label(
-            text='NOX Volume Control',
-            font_size='24sp',
-            bold=True,
-            color=(0.9, 0.9, 0.9, 1)
-        )
-        title_layout.add_widget(title_label)
-        layout.add_widget(title_layout)
-        
-        # Volume slider
-        slider_layout = BoxLayout(orientation='horizontal', size_hint_y=0.4)
-        
-        # Volume icon
-        volume_icon = Image(
-            source='',  # No source needed, we'll draw it programmatically
-            size_hint_x=0.15
-        )
-        slider_layout.add_widget(volume_icon)
-        
-        # Slider
-        self.volume_slider = Slider(
-            min=0,
-            max=100,
-            value=VolumeControl.get_current_volume(),
-            step=1,
-            cursor_size=(20, 20),
-            size_hint_x=0.7
-        )
-        self.volume_slider.bind(value=self.on_volume_change)
-        slider_layout.add_widget(self.volume_slider)
-        
-        # Volume percentage label
-        self.volume_label = Label(
-            text=f"{int(self.volume_slider.value)}%",
-            size_hint_x=0.15,
-            font_size='18sp'
-        )
-        slider_layout.add_widget(self.volume_label)
-        layout.add_widget(slider_layout)
-        
-        # Buttons layout
-        buttons_layout = BoxLayout(size_hint_y=0.3, spacing=10)
-        
-        # Mute toggle button
-        self.mute_button = Button(
-            text="Mute",
-            background_color=(0.8, 0.2, 0.2, 1),
-            background_normal='',
-            bold=True
-        )
-        self.mute_button.bind(on_release=self.toggle_mute)
-        buttons_layout.add_widget(self.mute_button)
-        
-        # Quick volume buttons
-        for vol in [0, 25, 50, 75, 100]:
-            btn = Button(
-                text=f"{vol}%",
-                background_color=(0.2, 0.4, 0.8, 1),
-                background_normal='',
-                bold=True
-            )
-            btn.bind(on_release=lambda instance, v=vol: self.set_quick_volume(v))
-            buttons_layout.add_widget(btn)
-        
-        layout.add_widget(buttons_layout)
-        
-        # System info
-        system_info = Label(
-            text=f"System: {platform.system()} {platform.release()}",
-            size_hint_y=0.1,
-            color=(0.7, 0.7, 0.7, 1)
-        )
-        layout.add_widget(system_info)
-        
-        # Schedule periodic volume updates
-        Clock.schedule_interval(self.update_volume_display, 1)
-        
-        return layout
-    
-    def on_volume_change(self, instance, value):
-        """Handle volume slider changes."""
-        volume = int(value)
-        VolumeControl.set_volume(volume)
-        self.volume_label.text = f"{volume}%"
-    
-    def set_quick_volume(self, volume):
-        """Set volume to a specific level quickly."""
-        self.volume_slider.value = volume
-        VolumeControl.set_volume(volume)
-        self.volume_label.text = f"{volume}%"
-    
-    def toggle_mute(self, instance):
-        """Toggle mute state."""
-        VolumeControl.toggle_mute()
-        # Update the UI after a slight delay to reflect system state
-        Clock.schedule_once(self.update_volume_display, 0.1)
-    
-    def update_volume_display(self, dt):
-        """Update the volume display to match system volume."""
-        current_volume = VolumeControl.get_current_volume()
-        if int(self.volume_slider.value) != current_volume:
-            self.volume_slider.value = current_volume
-            self.volume_label.text = f"{current_volume}%"
+                probe.connect(self.path)
+            except OSError:
+                os.unlink(self.path)  # left behind by a daemon that died
+            else:
+                raise OSError(f"a methcontrol daemon is already listening on {self.path}")
+            finally:
+                probe.close()
+        previous = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.path, _ControlHandler)
+        finally:
+            os.umask(previous)
+        self.server.daemon_threads = True
+        self.server.control = self
 
-if __name__ == '__main__':
+    def serve_forever(self):
+        self._bind()
+        self.watcher = MixerWatcher(self.backend, self._on_change,
+                                    on_channels=self._on_channels).start()
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stop serve_forever(); call from another thread."""
+        if self.server:
+            self.server.shutdown()
+
+    def close(self):
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        if self.server:
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+class DaemonBackend(MixerBackend):
+    """The mixer of a running "methcontrol --daemon", reached over its socket.
+
+    Construction fails with OSError when no daemon is listening. Requests
+    share one connection; once watched, a second "watch" connection keeps
+    the state and channels current without asking.
+    """
+
+    name = "daemon"
+
+    def __init__(self, path=None):
+        self.path = path or socket_path()
+        self.lock = threading.Lock()
+        self.conn = self._connect()
+        self.reader = self.conn.makefile("rb")
+        self.watch = None
+        self._watch_failed = False
+        self._partial = b""
+        self.state = None
+        self.channel_list = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def request(self, line):
+        with self.lock:
+            self.conn.sendall(line.encode() + b"\n")
+            reply = self.reader.readline()
+        if not reply:
+            raise OSError("the methcontrol daemon went away")
+        reply = json.loads(reply)
+        if "error" in reply:
+            raise OSError(reply["error"])
+        return reply
+
+    def _send(self, line):
+        try:
+            self.request(line)
+            return True
+        except OSError:
+            return False
+
+    def _state(self):
+        if self.watch is None or self.state is None:
+            try:
+                self.state = self.request("get")
+            except OSError:
+                pass
+        return self.state or {"volume": 50, "muted": False}
+
+    def get_volume(self):
+        return self._state()["volume"]
+
+    def set_volume(self, value):
+        return self._send(f"set {int(value)}")
+
+    def is_muted(self):
+        return self._state()["muted"]
+
+    def set_muted(self, muted):
+        return self._send("mute on" if muted else "mute off")
+
+    def toggle_mute(self):
+        return self._send("mute")
+
+    def channels(self):
+        if self.watch is not None and self.channel_list is not None:
+            return self.channel_list
+        try:
+            return self.request("channels")["channels"]
+        except OSError:
+            return []
+
+    def set_channel_volume(self, kind, index, value):
+        return self._send(f"channel-set {kind} {index} {int(value)}")
+
+    def toggle_channel_mute(self, kind, index):
+        return self._send(f"channel-mute {kind} {index}")
+
+    def change_fds(self):
+        if self.watch is None and not self._watch_failed:
+            try:
+                self.watch = self._connect()
+                self.watch.sendall(b"watch\n")
+            except OSError:
+                self._watch_failed = True
+                return []
+            self.watch.setblocking(False)
+        return [self.watch.fileno()] if self.watch else []
+
+    def handle_change(self):
+        try:
+            data = self.watch.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._watch_failed = True
+            self.watch.close()
+            self.watch = None
+            return
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            message = json.loads(line)
+            if "channels" in message:
+                self.channel_list = message["channels"]
+            else:
+                self.state = message
+
+    def close(self):
+        for sock in (self.watch, self.conn):
+            if sock:
+                sock.close()
+        self.watch = None
+
+
+def run_daemon(path=None):
+    """Serve the default backend until interrupted or sent SIGTERM."""
+    daemon = ControlDaemon(VolumeControl.get_backend(), path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def bench_latency(presses=10):
+    """Time a volume keypress from process start to the mixer write returning.
+
+    Compares running "methcontrol set" per keypress with no daemon
+    (start-up plus opening the mixer) with methcontrol-ctl against a warm
+    daemon, and with the bare socket round trip the ctl pays once Python
+    is up. Uses the same backend the GUI would, so
+    METHCONTROL_BACKEND=fake keeps the real mixer alone.
+    """
+    here = os.path.dirname(os.path.realpath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get("PYTHONPATH")])))
+    results = {}
+
+    def timed(name, press):
+        samples = []
+        for i in range(presses):
+            start = time.perf_counter()
+            press(40 + i % 2)
+            samples.append((time.perf_counter() - start) * 1000)
+        results[name] = samples
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.sock")
+        cold = [sys.executable, os.path.realpath(__file__), "--socket", path, "set"]
+        timed("launch per keypress",
+              lambda volume: subprocess.run(cold + [str(volume)], env=env, check=True,
+                                            stdout=subprocess.DEVNULL))
+
+        daemon = subprocess.Popen([sys.executable, os.path.realpath(__file__), "--daemon", "--socket", path])
+        try:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    backend = DaemonBackend(path)
+                    break
+                except OSError:
+                    if daemon.poll() is not None or time.monotonic() > deadline:
+                        raise OSError("the benchmark daemon did not start")
+                    time.sleep(0.05)
+            ctl = [sys.executable, os.path.join(here, "methcontrol_ctl.py"), "set"]
+            ctl_env = dict(env, METHCONTROL_SOCKET=path)
+            timed("methcontrol-ctl + daemon",
+                  lambda volume: subprocess.run(ctl + [str(volume)], env=ctl_env, check=True,
+                                                stdout=subprocess.DEVNULL))
+            timed("daemon round trip", backend.set_volume)
+            backend.close()
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+    print(f"{'':28}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for name, samples in results.items():
+        print(f"{name:28}{_percentile(samples, 0.5):10.2f}{_percentile(samples, 0.99):10.2f}"
+              f"{sum(samples) / len(samples):10.2f}")
+
+
+def bench_startup(runs=10, max_wall_ms=250.0, max_import_ms=100.0):
+    """Time "methcontrol get" from process start to its answer, CI style.
+
+    Each run is a fresh interpreter under -X importtime, after one
+    untimed run to write the bytecode caches. Prints the wall time, the
+    total import time and the slowest top-level imports, and returns 1
+    when either median exceeds its threshold or Kivy was imported at all.
+    """
+    command = [sys.executable, "-X", "importtime", os.path.realpath(__file__), "get"]
+    subprocess.run(command, capture_output=True)
+    walls, imports, modules = [], [], {}
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(command, capture_output=True, text=True)
+        walls.append((time.perf_counter() - start) * 1000)
+        if proc.returncode:
+            print(proc.stderr.strip().splitlines()[-1], file=sys.stderr)
+            return 1
+        total = 0
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line.rsplit("|", 2)
+            if name[1:2] == " ":  # nested imports are indented under their importer
+                modules.setdefault(name.strip(), 0)
+                continue
+            total += int(cumulative)
+            modules[name.strip()] = max(modules.get(name.strip(), 0), int(cumulative))
+        imports.append(total / 1000)
+
+    wall, imported = _percentile(walls, 0.5), _percentile(imports, 0.5)
+    kivy = sorted(name for name in modules if name.split(".")[0] == "kivy")
+    print(f"wall time to first result  p50 {wall:8.2f} ms  p99 {_percentile(walls, 0.99):8.2f} ms"
+          f"  (limit {max_wall_ms:g} ms)")
+    print(f"import time                p50 {imported:8.2f} ms  (limit {max_import_ms:g} ms)")
+    print("slowest top-level imports:")
+    for name, cumulative in sorted(modules.items(), key=lambda item: -item[1])[:8]:
+        print(f"  {name:24}{cumulative / 1000:8.2f} ms")
+    failures = []
+    if wall > max_wall_ms:
+        failures.append(f"wall time {wall:.1f} ms over {max_wall_ms:g} ms")
+    if imported > max_import_ms:
+        failures.append(f"import time {imported:.1f} ms over {max_import_ms:g} ms")
+    if kivy:
+        failures.append(f"the command line imported Kivy ({kivy[0]})")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("PASS")
+    return 1 if failures else 0
+
+
+def bench_fade(runs=5, duration_ms=1000, rate=100.0):
+    """Measure fade step timing on a FakeBackend.
+
+    Runs alternating full-range fades with each curve and reports the
+    step rate achieved against the one asked for, how late steps ran
+    (jitter), the mixer writes made and the CPU the fader used.
+    """
+    fader = Fader(FakeBackend(volume=0), rate)
+    print(f"{runs} fades of {duration_ms} ms per curve at {rate:g} steps/s")
+    print(f"{'curve':12}{'steps/s':>9}{'writes/s':>10}{'jitter p50':>12}{'p99':>8}{'max':>8}{'cpu':>7}")
+    for curve in CURVES:
+        lateness, steps, writes, elapsed = [], 0, 0, 0.0
+        cpu = time.process_time()
+        for i in range(runs):
+            start = time.monotonic()
+            fade = fader.fade(100 if i % 2 == 0 else 0, duration_ms, curve)
+            if not fade.wait(duration_ms / 1000 + 5):
+                print(f"{curve}: fade did not finish", file=sys.stderr)
+                return 1
+            elapsed += time.monotonic() - start
+            lateness += fade.lateness
+            steps += fade.steps
+            writes += fade.writes
+        cpu = time.process_time() - cpu
+        late = [value * 1000 for value in lateness]
+        print(f"{curve:12}{steps / elapsed:9.1f}{writes / elapsed:10.1f}{_percentile(late, 0.5):10.2f}ms"
+              f"{_percentile(late, 0.99):6.2f}ms{max(late):6.2f}ms{100 * cpu / elapsed:6.1f}%")
+    fader.stop()
+    return 0
+
+
+def bench_backends(names, iterations=200, as_json=False):
+    """Time get, set and toggle on each backend named.
+
+    Names are BACKENDS keys or module:Class (see backend_class()). A
+    backend that cannot be opened here is reported with its error
+    instead of failing the run, so the suite still runs with only "fake"
+    on a machine without a sound card. The mixer is left as it was
+    found: set alternates between the current volume and one step away,
+    and mute is toggled an even number of times. Prints a table, or with
+    as_json the whole report for regression tracking.
+    """
+    iterations += iterations % 2
+    report = {"iterations": iterations, "system": platform.system(),
+              "python": platform.python_version(), "backends": {}}
+    for name in names:
+        try:
+            backend = backend_class(name)()
+        except Exception as e:
+            report["backends"][name] = {"error": str(e) or type(e).__name__}
+            continue
+        try:
+            volume = backend.get_volume()
+            other = volume + 1 if volume < 100 else volume - 1
+            operations = {
+                "get": lambda i: backend.get_volume(),
+                "set": lambda i: backend.set_volume(other if i % 2 == 0 else volume),
+                "toggle": lambda i: backend.toggle_mute(),
+            }
+            results = {}
+            for operation, call in operations.items():
+                samples = []
+                for i in range(iterations):
+                    start = time.perf_counter()
+                    call(i)
+                    samples.append(time.perf_counter() - start)
+                results[operation] = {
+                    "p50_ms": round(_percentile(samples, 0.5) * 1000, 4),
+                    "p99_ms": round(_percentile(samples, 0.99) * 1000, 4),
+                    "mean_ms": round(sum(samples) / len(samples) * 1000, 4),
+                    "ops_per_s": round(len(samples) / sum(samples), 1),
+                }
+            report["backends"][name] = results
+        finally:
+            backend.close()
+
+    if as_json:
+        print(json.dumps(report, indent=2))
+        return 0
+    width = max(12, *(len(name) + 2 for name in report["backends"]))
+    print(f"{iterations} calls per operation")
+    print(f"{'backend':{width}}{'op':8}{'p50 ms':>10}{'p99 ms':>10}{'ops/s':>12}")
+    for name, results in report["backends"].items():
+        if "error" in results:
+            print(f"{name:{width}}unavailable: {results['error']}")
+            continue
+        for operation, stats in results.items():
+            print(f"{name:{width}}{operation:8}{stats['p50_ms']:10.3f}{stats['p99_ms']:10.3f}"
+                  f"{stats['ops_per_s']:12.1f}")
+    return 0
+
+
+def run_command(args):
+    """Answer a command-line request, through the daemon when one is running."""
+    line = {"get": "get", "set": f"set {getattr(args, 'volume', '')}",
+            "up": f"up {getattr(args, 'step', '')}", "down": f"down {getattr(args, 'step', '')}",
+            "mute": f"mute {getattr(args, 'state', None) or ''}"}[args.command]
+    try:
+        try:
+            daemon = DaemonBackend(args.socket)
+        except OSError:
+            # Same request handling as the daemon, on a mixer opened just for this.
+            reply = ControlDaemon(VolumeControl.get_backend()).command(line)
+        else:
+            with contextlib.closing(daemon):
+                reply = daemon.request(line)
+    except (ValueError, OSError) as e:
+        print(f"methcontrol: {e}", file=sys.stderr)
+        return 1
+    print(f"{reply['volume']}%" + (" (muted)" if reply["muted"] else ""))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="methcontrol", description="NOX Volume Control",
+                                     epilog="Without a command, opens the window.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep the mixer open and serve it on a Unix socket for "
+                             "methcontrol-ctl and the window, instead of opening a window")
+    parser.add_argument("--socket", default=None,
+                        help=f"daemon socket (default: {socket_path()})")
+    parser.add_argument("--bench-latency", action="store_true",
+                        help="time volume keypresses with and without the daemon")
+    parser.add_argument("--presses", type=int, default=10,
+                        help="keypresses per --bench-latency case (default: 10)")
+    parser.add_argument("--bench-startup", action="store_true",
+                        help="time 'methcontrol get' start-up and imports; exit 1 over the limits")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="runs for --bench-startup and fades per curve for --bench-fade (default: 10)")
+    parser.add_argument("--max-startup-ms", type=float, default=250.0,
+                        help="--bench-startup limit on median wall time (default: 250)")
+    parser.add_argument("--max-import-ms", type=float, default=100.0,
+                        help="--bench-startup limit on median import time (default: 100)")
+    parser.add_argument("--bench-fade", action="store_true",
+                        help="measure fade step rate and jitter against the fake backend")
+    parser.add_argument("--fade-ms", type=int, default=1000,
+                        help="length of each --bench-fade fade (default: 1000)")
+    parser.add_argument("--fade-rate", type=float, default=100.0,
+                        help="--bench-fade steps per second (default: 100)")
+    parser.add_argument("--bench-backends", nargs="?", const="amixer,alsa,pactl,fake", metavar="NAMES",
+                        help="time get/set/toggle on each comma-separated backend, briefly "
+                             "changing the real mixer (default: amixer,alsa,pactl,fake)")
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="calls per operation for --bench-backends (default: 200)")
+    parser.add_argument("--json", action="store_true",
+                        help="print the --bench-backends report as JSON")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.add_parser("get", help="print the volume")
+    set_parser = commands.add_parser("set", help="set the volume (0-100)")
+    set_parser.add_argument("volume", type=int)
+    for verb in ("up", "down"):
+        step = commands.add_parser(verb, help=f"turn the volume {verb} by STEP (default: 5)")
+        step.add_argument("step", type=int, nargs="?", default=5)
+    mute = commands.add_parser("mute", help="toggle mute, or set it with on or off")
+    mute.add_argument("state", nargs="?", choices=["on", "off"])
+    args = parser.parse_args(argv)
+    # Run as a script this module is __main__; register it under its own
+    # name so the window and plugged-in backends share these classes
+    # instead of importing a second copy.
+    sys.modules.setdefault("methcontrol", sys.modules[__name__])
+
+    if args.daemon:
+        return run_daemon(args.socket)
+    if args.bench_latency:
+        return bench_latency(args.presses)
+    if args.bench_startup:
+        return bench_startup(args.runs, args.max_startup_ms, args.max_import_ms)
+    if args.bench_backends:
+        return bench_backends(args.bench_backends.split(","), args.iterations, args.json)
+    if args.bench_fade:
+        return bench_fade(args.runs, args.fade_ms, args.fade_rate)
+    if args.command:
+        return run_command(args)
+    # The window shares a running daemon's mixer session when there is one.
+    try:
+        VolumeControl.use_backend(DaemonBackend(args.socket))
+    except OSError:
+        pass
+    from methcontrol_gui import VolumeControlApp
     VolumeControlApp().run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+methcontrol-ctl - control a running "methcontrol --daemon".
+Meant for media-key bindings: only the standard library is imported, so
+a keypress costs a Python start-up and one socket round trip.
+"""
+
+import os
+import sys
+import json
+import socket
+import tempfile
+
+USAGE = ("usage: methcontrol-ctl get | set N | up [N] | down [N] | mute [on|off] | channels\n"
+         "                       channel-set KIND INDEX N | channel-mute KIND INDEX")
+
+
+def socket_path():
+    """Same location as methcontrol.socket_path()."""
+    runtime = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.environ.get("METHCONTROL_SOCKET") or os.path.join(runtime, f"methcontrol-{os.getuid()}.sock")
+
+
+def request(line, path=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path or socket_path())
+        sock.sendall(line.encode() + b"\n")
+        reply = sock.makefile("rb").readline()
+    if not reply:
+        raise OSError("the daemon closed the connection without answering")
+    return json.loads(reply)
+
+
+def main(argv):
+    if not argv or argv[0] in ("-h", "--help"):
+        print(USAGE)
+        return 0 if argv else 2
+    try:
+        reply = request(" ".join(argv))
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"methcontrol-ctl: no daemon on {socket_path()}; start one with 'methcontrol --daemon'",
+              file=sys.stderr)
+        return 1
+    except (ValueError, OSError) as e:
+        print(f"methcontrol-ctl: {e}", file=sys.stderr)
+        return 1
+    if "error" in reply:
+        print(f"methcontrol-ctl: {reply['error']}", file=sys.stderr)
+        return 1
+    if "channels" in reply:
+        for channel in reply["channels"]:
+            print(f"{channel['kind']} {channel['index']} {channel['volume']}%"
+                  + (" (muted)" if channel["muted"] else "") + f" {channel['label']}")
+    elif "volume" in reply:
+        print(f"{reply['volume']}%" + (" (muted)" if reply["muted"] else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
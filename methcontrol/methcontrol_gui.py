@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+NOX - Volume Control window.
+The Kivy side of methcontrol, imported only when the window is opened so
+the command line never pays for Kivy.
+"""
+
+import os
+import platform
+
+# Kivy parses sys.argv on import unless told not to; the options are methcontrol's.
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+from kivy.app import App
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.slider import Slider
+from kivy.uix.label import Label
+from kivy.uix.button import Button
+from kivy.core.window import Window
+from kivy.uix.image import Image
+from kivy.clock import Clock
+
+from methcontrol import VolumeControl, MixerWatcher, VolumeWriter, ChannelTarget
+
+class VolumeControlApp(App):
+    # Most mixer writes per second while the slider is dragged.
+    max_write_rate = 20
+    # Set while the slider is moved to show the mixer, so that move is not written back.
+    showing_mixer = False
+
+    def build(self):
+        # Set window properties
+        self.title = 'NOX Volume Control'
+        Window.size = (400, 300)
+        Window.clearcolor = (0.1, 0.1, 0.1, 1)
+        
+        # Create main layout
+        layout = BoxLayout(orientation='vertical', padding=20, spacing=10)
+        
+        # Add title label
+        title_layout = BoxLayout(size_hint_y=0.2)
+        title_label = Label(
+            text='NOX Volume Control',
+            font_size='24sp',
+            bold=True,
+            color=(0.9, 0.9, 0.9, 1)
+        )
+        title_layout.add_widget(title_label)
+        layout.add_widget(title_layout)
+        
+        # Volume slider
+        slider_layout = BoxLayout(orientation='horizontal', size_hint_y=0.4)
+        
+        # Volume icon
+        volume_icon = Image(
+            source='',  # No source needed, we'll draw it programmatically
+            size_hint_x=0.15
+        )
+        slider_layout.add_widget(volume_icon)
+        
+        # Slider
+        self.volume_slider = Slider(
+            min=0,
+            max=100,
+            value=VolumeControl.get_current_volume(),
+            step=1,
+            cursor_size=(20, 20),
+            size_hint_x=0.7
+        )
+        self.volume_slider.bind(value=self.on_volume_change)
+        slider_layout.add_widget(self.volume_slider)
+        
+        # Volume percentage label
+        self.volume_label = Label(
+            text=f"{int(self.volume_slider.value)}%",
+            size_hint_x=0.15,
+            font_size='18sp'
+        )
+        slider_layout.add_widget(self.volume_label)
+        layout.add_widget(slider_layout)
+        
+        # Buttons layout
+        buttons_layout = BoxLayout(size_hint_y=0.3, spacing=10)
+        
+        # Mute toggle button
+        self.mute_button = Button(
+            text="Mute",
+            background_color=(0.8, 0.2, 0.2, 1),
+            background_normal='',
+            bold=True
+        )
+        self.mute_button.bind(on_release=self.toggle_mute)
+        buttons_layout.add_widget(self.mute_button)
+        
+        # Quick volume buttons
+        for vol in [0, 25, 50, 75, 100]:
+            btn = Button(
+                text=f"{vol}%",
+                background_color=(0.2, 0.4, 0.8, 1),
+                background_normal='',
+                bold=True
+            )
+            btn.bind(on_release=lambda instance, v=vol: self.set_quick_volume(v))
+            buttons_layout.add_widget(btn)
+        
+        layout.add_widget(buttons_layout)
+        
+        # One row per sink and application stream, where the backend has them
+        self.channels_layout = BoxLayout(orientation='vertical', size_hint_y=None, height=0, spacing=5)
+        self.channel_rows = {}
+        layout.add_widget(self.channels_layout)
+        
+        # System info
+        system_info = Label(
+            text=f"System: {platform.system()} {platform.release()}",
+            size_hint_y=0.1,
+            color=(0.7, 0.7, 0.7, 1)
+        )
+        layout.add_widget(system_info)
+        
+        # Slider moves are written from a background thread, and changes
+        # made elsewhere are followed; the watcher only polls when the
+        # backend has no change events.
+        self.writer = VolumeWriter(VolumeControl.get_backend(), self.max_write_rate)
+        self.watcher = MixerWatcher(VolumeControl.get_backend(), self.on_mixer_change,
+                                    on_channels=self.on_channels_change).start()
+        
+        return layout
+
+    def on_stop(self):
+        self.watcher.stop()
+        self.writer.stop()
+        for row in self.channel_rows.values():
+            row["writer"].stop()
+
+    def on_channels_change(self, channels):
+        """Called on the watcher thread; hand the new channels to the UI thread."""
+        Clock.schedule_once(lambda dt: self.show_channels(channels))
+
+    def show_channels(self, channels):
+        """Keep one slider row per sink and stream, rebuilding only when the set changes."""
+        keys = [(channel["kind"], channel["index"]) for channel in channels]
+        if keys != list(self.channel_rows):
+            for row in self.channel_rows.values():
+                row["writer"].stop()
+            self.channels_layout.clear_widgets()
+            self.channel_rows = {key: self.channel_row(channel) for key, channel in zip(keys, channels)}
+            self.channels_layout.height = 40 * len(channels)
+            Window.size = (400, 300 + 40 * len(channels))
+        for key, channel in zip(keys, channels):
+            row = self.channel_rows[key]
+            row["label"].text = channel["label"]
+            row["mute"].text = "Unmute" if channel["muted"] else "Mute"
+            if not row["writer"].is_stale(channel["volume"]):
+                row["showing_mixer"] = True
+                try:
+                    row["slider"].value = channel["volume"]
+                finally:
+                    row["showing_mixer"] = False
+                row["percent"].text = f"{channel['volume']}%"
+
+    def channel_row(self, channel):
+        backend = VolumeControl.get_backend()
+        kind, index = channel["kind"], channel["index"]
+        row = {"writer": VolumeWriter(ChannelTarget(backend, kind, index), self.max_write_rate),
+               "showing_mixer": False}
+        layout = BoxLayout(orientation='horizontal', size_hint_y=None, height=35, spacing=5)
+        row["label"] = Label(text=channel["label"], size_hint_x=0.3, shorten=True,
+                             color=(0.9, 0.9, 0.9, 1) if kind == "sink" else (0.7, 0.7, 0.7, 1))
+        row["slider"] = Slider(min=0, max=100, value=channel["volume"], step=1, size_hint_x=0.4)
+        row["percent"] = Label(text=f"{channel['volume']}%", size_hint_x=0.1)
+        row["mute"] = Button(text="Unmute" if channel["muted"] else "Mute", size_hint_x=0.2,
+                             background_color=(0.8, 0.2, 0.2, 1), background_normal='')
+
+        def on_slide(instance, value):
+            if not row["showing_mixer"]:
+                row["writer"].request(int(value))
+            row["percent"].text = f"{int(value)}%"
+
+        row["slider"].bind(value=on_slide)
+        row["mute"].bind(on_release=lambda instance: backend.toggle_channel_mute(kind, index))
+        for widget in (row["label"], row["slider"], row["percent"], row["mute"]):
+            layout.add_widget(widget)
+        self.channels_layout.add_widget(layout)
+        return row
+
+    def on_mixer_change(self, volume, muted):
+        """Called on the watcher thread; hand the new state to the UI thread."""
+        Clock.schedule_once(lambda dt: self.show_state(volume, muted))
+
+    def show_state(self, volume, muted):
+        self.mute_button.text = "Unmute" if muted else "Mute"
+        if self.writer.is_stale(volume):
+            return
+        if int(self.volume_slider.value) != volume:
+            self.showing_mixer = True
+            try:
+                self.volume_slider.value = volume
+            finally:
+                self.showing_mixer = False
+        self.volume_label.text = f"{volume}%"
+    
+    def on_volume_change(self, instance, value):
+        """Handle volume slider changes."""
+        volume = int(value)
+        if not self.showing_mixer:
+            self.writer.request(volume)
+        self.volume_label.text = f"{volume}%"
+    
+    def set_quick_volume(self, volume):
+        """Set volume to a specific level quickly."""
+        self.volume_slider.value = volume
+        self.writer.request(volume)
+        self.volume_label.text = f"{volume}%"
+    
+    def toggle_mute(self, instance):
+        """Toggle mute state."""
+        VolumeControl.toggle_mute()
+        # The watcher reports the new state once the mixer has it.
+    
+    def update_volume_display(self, dt):
+        """Update the volume display to match system volume."""
+        self.show_state(VolumeControl.get_current_volume(), VolumeControl.is_muted())
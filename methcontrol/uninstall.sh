@@ -10,15 +10,20 @@ if [ "$(id -u)" != "0" ]; then
    exit 1
 fi
 
-# Remove symlink
-if [ -L /usr/local/bin/nox ]; then
-    rm /usr/local/bin/nox
+# Remove symlinks
+if [ -L /usr/local/bin/methcontrol ]; then
+    rm /usr/local/bin/methcontrol
     echo "Removed symlink from PATH"
 fi
 
+if [ -L /usr/local/bin/methcontrol-ctl ]; then
+    rm /usr/local/bin/methcontrol-ctl
+    echo "Removed methcontrol-ctl from PATH"
+fi
+
 # Remove package directory
 if [ -d /usr/local/share/meth-packages/methcontrol ]; then
-    rm -rf /usr/local/share/meth-packages/nox
+    rm -rf /usr/local/share/meth-packages/methcontrol
     echo "Removed application files"
 fi
 